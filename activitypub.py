@@ -4,34 +4,86 @@ import json
 from datetime import datetime
 from enum import Enum
 from typing import Any
+from typing import Callable
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Tuple
+from urllib.parse import urldefrag
 
 from bson.objectid import ObjectId
-from cachetools import LRUCache
 from feedgen.feed import FeedGenerator
+from flask import has_request_context
 from html2text import html2text
 from little_boxes import activitypub as ap
 from little_boxes import strtobool
 from little_boxes.activitypub import _to_list
 from little_boxes.backend import Backend
 from little_boxes.errors import ActivityGoneError
+from little_boxes.errors import ActivityNotFoundError
 from little_boxes.errors import Error
 from little_boxes.errors import NotAnActivityError
+from little_boxes.urlutils import check_url
+from pymongo.errors import DuplicateKeyError
 
+from config import ACTORS_CACHE_SIZE
+from config import ACTORS_CACHE_TTL
 from config import BASE_URL
+from config import BLOCKED_DOMAINS
 from config import DB
 from config import EXTRA_INBOXES
+from config import HEADERS
+from config import HTTP_CLIENT
 from config import ID
 from config import ME
 from config import USER_AGENT
 from config import USERNAME
+from utils.actorcache import ActorCache
+from utils.actordeletion import delete_actors_activities
+from utils.blocklist import Blocklist
+from utils.httpsig import PublicKeyStore
+from utils.memo import Memo
+from utils.objectcache import ObjectCache
+from utils.objectcache import conditional_get
+from utils.objectcache import response_validators
+from utils.recipients import Recipients
+from utils.singleflight import SingleFlight
+from utils.threads import find_thread_root
 
 logger = logging.getLogger(__name__)
 
 
-ACTORS_CACHE = LRUCache(maxsize=256)
+ACTORS_CACHE = ActorCache(DB.actors, ACTORS_CACHE_SIZE, ACTORS_CACHE_TTL)
+try:
+    ACTORS_CACHE.warm()
+except Exception:
+    logger.exception("failed to warm the actors cache")
+
+# Fetched objects, with their `ETag`/`Last-Modified`
+OBJECTS_CACHE = ObjectCache(DB.objects)
+
+# Remote documents and parsed activities, for the current request/task
+MEMO = Memo()
+
+# Concurrent remote fetches of the same IRI (within the process and across processes) are only done once
+FETCHES = SingleFlight(DB.fetch_leases)
+# Seconds a web request waits for the same fetch in progress before fetching the IRI itself
+FETCH_MAX_WAIT_IN_REQUEST = 2
+
+# Blocked actors/domains, checked before doing any work on inbox requests
+BLOCKLIST = Blocklist(
+    lambda: ap.get_backend().blocked_actors(),
+    BLOCKED_DOMAINS,
+    generations=DB.cache_generations,
+)
+
+# Inboxes of the followers
+RECIPIENTS = Recipients(DB.recipients, DB.migrations)
+
+# Public keys used for verifying the HTTP signatures of the inbox requests
+KEY_STORE = PublicKeyStore(
+    DB.actors, lambda key_id: ap.get_backend().fetch_iri(key_id, no_cache=True)
+)
 
 
 def _actor_to_meta(actor: ap.BaseActivity, with_inbox=False) -> Dict[str, Any]:
@@ -54,6 +106,25 @@ def _actor_to_meta(actor: ap.BaseActivity, with_inbox=False) -> Dict[str, Any]:
     return meta
 
 
+def parse_activity(data: ap.ObjectType) -> ap.BaseActivity:
+    """`ap.parse_activity`, memoized by ID for the current request/task."""
+    key = ("activity", data.get("id"))
+    activity = MEMO.get(key) if data.get("id") else None
+    if not activity:
+        activity = ap.parse_activity(data)
+        if data.get("id"):
+            MEMO.set(key, activity)
+    return activity
+
+
+def get_object_id(data: ap.ObjectType) -> Optional[str]:
+    """Returns the ID of the object of a raw activity (without parsing it)."""
+    obj = data.get("object")
+    if isinstance(obj, dict):
+        return obj.get("id")
+    return obj
+
+
 def _remove_id(doc: ap.ObjectType) -> ap.ObjectType:
     """Helper for removing MongoDB's `_id` field."""
     doc = doc.copy()
@@ -79,9 +150,16 @@ class Box(Enum):
     REPLIES = "replies"
 
 
+# Max number of ancestors resolved for a reply
+MAX_ANCESTORS = 50
+
+
 class MicroblogPubBackend(Backend):
     """Implements a Little Boxes backend, backed by MongoDB."""
 
+    # Resolves the ancestors of a reply in the background (set by the tasks)
+    resolve_ancestors_cb: Optional[Callable[[str, str], None]] = None
+
     def debug_mode(self) -> bool:
         return strtobool(os.getenv("MICROBLOGPUB_DEBUG", "false"))
 
@@ -125,18 +203,30 @@ class MicroblogPubBackend(Backend):
         return [doc["activity"]["actor"] for doc in DB.activities.find(q)]
 
     def followers_as_recipients(self) -> List[str]:
+        """Inboxes of the followers (read from the `recipients` collection), one shared inbox per instance."""
+        if not RECIPIENTS.is_built():
+            # Instance upgraded from a version without the `recipients` collection
+            logger.warning("the recipients collection was never built, building it")
+            self.rebuild_recipients()
+
+        return RECIPIENTS.inboxes()
+
+    def add_recipient(self, follow_id: str, actor: Dict[str, Any]) -> None:
+        RECIPIENTS.add(follow_id, actor)
+
+    def rebuild_recipients(self) -> int:
+        """Rebuild the `recipients` collection from the inbox Follows, returns the number of followers."""
         q = {
             "box": Box.INBOX.value,
             "type": ap.ActivityType.FOLLOW.value,
             "meta.undo": False,
         }
-        recipients = []
-        for doc in DB.activities.find(q):
-            recipients.append(
-                doc["meta"]["actor"]["sharedInbox"] or doc["meta"]["actor"]["inbox"]
-            )
-
-        return list(set(recipients))
+        return RECIPIENTS.rebuild(
+            DB.activities.find(q).sort("_id", 1),
+            lambda doc: _actor_to_meta(
+                ap.parse_activity(doc["activity"]).get_actor(), with_inbox=True
+            ),
+        )
 
     def following(self) -> List[str]:
         q = {
@@ -158,18 +248,46 @@ class MicroblogPubBackend(Backend):
 
         return super().parse_collection(payload, url)
 
+    def blocked_actors(self) -> List[str]:
+        q = {
+            "box": Box.OUTBOX.value,
+            "type": ap.ActivityType.BLOCK.value,
+            "meta.undo": False,
+        }
+        return [doc["activity"]["object"] for doc in DB.activities.find(q)]
+
     @ensure_it_is_me
     def outbox_is_blocked(self, as_actor: ap.Person, actor_id: str) -> bool:
-        return bool(
-            DB.activities.find_one(
+        return BLOCKLIST.is_blocked(actor_id)
+
+    def is_known_actor(self, actor_id: str) -> bool:
+        """Returns True if the actor interacted with us (cached actor, follower or following)."""
+        if DB.actors.find_one({"remote_id": actor_id}, projection=["_id"]):
+            return True
+
+        q = {
+            "$or": [
+                {
+                    "box": Box.INBOX.value,
+                    "type": ap.ActivityType.FOLLOW.value,
+                    "activity.actor": actor_id,
+                },
                 {
                     "box": Box.OUTBOX.value,
-                    "type": ap.ActivityType.BLOCK.value,
+                    "type": ap.ActivityType.FOLLOW.value,
                     "activity.object": actor_id,
-                    "meta.undo": False,
-                }
-            )
-        )
+                },
+            ]
+        }
+        return bool(DB.activities.find_one(q, projection=["_id"]))
+
+    def delete_actors(self, actor_ids: List[str]) -> None:
+        """Cleanup after the deletion of remote actors (their notes are deleted, follows/likes/boosts are undone)."""
+        delete_actors_activities(DB.activities, actor_ids)
+        RECIPIENTS.remove_actors(actor_ids)
+        DB.actors.delete_many({"remote_id": {"$in": actor_ids}})
+        for actor_id in actor_ids:
+            ACTORS_CACHE.pop(actor_id)
 
     def _fetch_iri(self, iri: str) -> ap.ObjectType:
         if iri == ME["id"]:
@@ -198,35 +316,79 @@ class MicroblogPubBackend(Backend):
 
         # Fetch the URL via HTTP
         logger.info(f"dereference {iri} via HTTP")
-        return super().fetch_iri(iri)
+        # The web requests only wait briefly for a fetch in progress (the workers wait for the whole lease)
+        max_wait = FETCH_MAX_WAIT_IN_REQUEST if has_request_context() else None
+        return FETCHES.do(iri, lambda: self._fetch_remote_iri(iri), max_wait=max_wait)
+
+    def _fetch_remote_iri(self, iri: str) -> ap.ObjectType:
+        """Fetch the IRI via HTTP, revalidating the cached actor/object if we have its `ETag`/`Last-Modified`."""
+        if not self.debug_mode():
+            check_url(iri)
+
+        cached = ACTORS_CACHE.get_validators(iri) or OBJECTS_CACHE.get_validators(iri)
+        resp, cached_data = conditional_get(
+            lambda headers: HTTP_CLIENT.get(
+                iri, headers={"Accept": HEADERS[1], **headers}, allow_redirects=False
+            ),
+            cached,
+        )
+        if cached_data:
+            logger.info(f"{iri} not modified")
+            if ap._has_type(cached_data["type"], ap.ACTOR_TYPES):
+                ACTORS_CACHE.touch(iri, cached_data)
+            else:
+                OBJECTS_CACHE.touch(iri)
+            return cached_data
+        elif resp.status_code == 404:
+            raise ActivityNotFoundError(f"{iri} is not found")
+        elif resp.status_code == 410:
+            raise ActivityGoneError(f"{iri} is gone")
+        resp.raise_for_status()
+
+        try:
+            data = resp.json()
+        except ValueError:
+            raise NotAnActivityError(f"{iri} is not JSON")
+
+        validators = response_validators(resp.headers)
+        if ap._has_type(data.get("type"), ap.ACTOR_TYPES):
+            # Actors fetched by their key ID (i.e. `#main-key`) are cached under their own ID
+            actor_id = urldefrag(iri)[0]
+            if actor_id == iri or data.get("id") == actor_id:
+                logger.debug(f"caching actor {actor_id}")
+                ACTORS_CACHE.set(actor_id, data, validators or None)
+        elif validators:
+            OBJECTS_CACHE.set(iri, data, validators)
+
+        return data
 
-    def fetch_iri(self, iri: str) -> ap.ObjectType:
+    def fetch_iri(self, iri: str, no_cache: bool = False) -> ap.ObjectType:
         if iri == ME["id"]:
             return ME
 
-        if iri in ACTORS_CACHE:
-            logger.info(f"{iri} found in cache")
-            return ACTORS_CACHE[iri]
+        # Remote documents are memoized for the current request/task (local ones may be updated by the task)
+        memoize = not iri.startswith(BASE_URL)
+        if not no_cache:
+            data = MEMO.get(iri) if memoize else None
+            if isinstance(data, Exception):
+                raise data
+            if not data and memoize:
+                # Only remote actors are cached
+                data = ACTORS_CACHE.get(iri)
+            if data:
+                logger.info(f"{iri} found in cache")
+                return data
 
-        # data = DB.actors.find_one({"remote_id": iri})
-        # if data:
-        #    if ap._has_type(data["type"], ap.ACTOR_TYPES):
-        #        logger.info(f"{iri} found in DB cache")
-        #        ACTORS_CACHE[iri] = data["data"]
-        #    return data["data"]
+        try:
+            data = self._fetch_iri(iri)
+        except (ActivityGoneError, ActivityNotFoundError) as err:
+            if memoize:
+                MEMO.set(iri, err)
+            raise
 
-        data = self._fetch_iri(iri)
         logger.debug(f"_fetch_iri({iri!r}) == {data!r}")
-        if ap._has_type(data["type"], ap.ACTOR_TYPES):
-            logger.debug(f"caching actor {iri}")
-            # Cache the actor
-            DB.actors.update_one(
-                {"remote_id": iri},
-                {"$set": {"remote_id": iri, "data": data}},
-                upsert=True,
-            )
-            ACTORS_CACHE[iri] = data
-
+        if memoize:
+            MEMO.set(iri, data)
         return data
 
     @ensure_it_is_me
@@ -236,11 +398,16 @@ class MicroblogPubBackend(Backend):
     def set_post_to_remote_inbox(self, cb):
         self.post_to_remote_inbox_cb = cb
 
+    @ensure_it_is_me
+    def new_follower(self, as_actor: ap.Person, follow: ap.Follow) -> None:
+        self.add_recipient(follow.id, _actor_to_meta(follow.get_actor(), True))
+
     @ensure_it_is_me
     def undo_new_follower(self, as_actor: ap.Person, follow: ap.Follow) -> None:
         DB.activities.update_one(
             {"remote_id": follow.id}, {"$set": {"meta.undo": True}}
         )
+        RECIPIENTS.remove_follow(follow.id)
 
     @ensure_it_is_me
     def undo_new_following(self, as_actor: ap.Person, follow: ap.Follow) -> None:
@@ -296,17 +463,26 @@ class MicroblogPubBackend(Backend):
             )
             return
 
-        DB.activities.update_one(
-            {"remote_id": announce.id},
+        self.inbox_announces(as_actor, obj, [announce.id])
+
+    @ensure_it_is_me
+    def inbox_announces(
+        self, as_actor: ap.Person, obj: ap.BaseActivity, announce_ids: List[str]
+    ) -> None:
+        """Process several Announce of the same (already resolved) object at once."""
+        DB.activities.update_many(
+            {"box": Box.INBOX.value, "remote_id": {"$in": announce_ids}},
             {
                 "$set": {
+                    "meta.stream": True,
                     "meta.object": obj.to_dict(embed=True),
                     "meta.object_actor": _actor_to_meta(obj.get_actor()),
                 }
             },
         )
         DB.activities.update_one(
-            {"activity.object.id": obj.id}, {"$inc": {"meta.count_boost": 1}}
+            {"activity.object.id": obj.id},
+            {"$inc": {"meta.count_boost": len(announce_ids)}},
         )
 
     @ensure_it_is_me
@@ -347,6 +523,11 @@ class MicroblogPubBackend(Backend):
             {"remote_id": announce.id}, {"$set": {"meta.undo": True}}
         )
 
+    @ensure_it_is_me
+    def outbox_undo_block(self, as_actor: ap.Person, block: ap.Block) -> None:
+        DB.activities.update_one({"remote_id": block.id}, {"$set": {"meta.undo": True}})
+        BLOCKLIST.invalidate()
+
     @ensure_it_is_me
     def inbox_delete(self, as_actor: ap.Person, delete: ap.Delete) -> None:
         obj = delete.get_object()
@@ -357,12 +538,9 @@ class MicroblogPubBackend(Backend):
 
         logger.info(f"inbox_delete handle_replies obj={obj!r}")
         in_reply_to = obj.inReplyTo
-        if delete.get_object().ACTIVITY_TYPE != ap.ActivityType.NOTE:
+        if obj.ACTIVITY_TYPE != ap.ActivityType.NOTE:
             in_reply_to = DB.activities.find_one(
-                {
-                    "activity.object.id": delete.get_object().id,
-                    "type": ap.ActivityType.CREATE.value,
-                }
+                {"activity.object.id": obj.id, "type": ap.ActivityType.CREATE.value}
             )["activity"]["object"].get("inReplyTo")
 
         # Fake a Undo so any related Like/Announce doesn't appear on the web UI
@@ -375,27 +553,23 @@ class MicroblogPubBackend(Backend):
 
     @ensure_it_is_me
     def outbox_delete(self, as_actor: ap.Person, delete: ap.Delete) -> None:
+        obj = delete.get_object()
         DB.activities.update_one(
-            {"activity.object.id": delete.get_object().id},
-            {"$set": {"meta.deleted": True}},
+            {"activity.object.id": obj.id}, {"$set": {"meta.deleted": True}}
         )
-        obj = delete.get_object()
-        if delete.get_object().ACTIVITY_TYPE != ap.ActivityType.NOTE:
-            obj = ap.parse_activity(
-                DB.activities.find_one(
-                    {
-                        "activity.object.id": delete.get_object().id,
-                        "type": ap.ActivityType.CREATE.value,
-                    }
-                )["activity"]
-            ).get_object()
+        obj_id, in_reply_to = obj.id, obj.inReplyTo
+        if obj.ACTIVITY_TYPE != ap.ActivityType.NOTE:
+            note = DB.activities.find_one(
+                {"activity.object.id": obj.id, "type": ap.ActivityType.CREATE.value}
+            )["activity"]["object"]
+            obj_id, in_reply_to = note["id"], note.get("inReplyTo")
 
         DB.activities.update(
-            {"meta.object.id": obj.id},
+            {"meta.object.id": obj_id},
             {"$set": {"meta.undo": True, "meta.exta": "object deleted"}},
         )
 
-        self._handle_replies_delete(as_actor, obj.inReplyTo)
+        self._handle_replies_delete(as_actor, in_reply_to)
 
     @ensure_it_is_me
     def inbox_update(self, as_actor: ap.Person, update: ap.Update) -> None:
@@ -453,45 +627,90 @@ class MicroblogPubBackend(Backend):
             {"$inc": {"meta.count_reply": -1, "meta.count_direct_reply": -1}},
         )
 
+    def _save_reply(self, reply: ap.BaseActivity) -> None:
+        try:
+            self.save(Box.REPLIES, reply)
+        except DuplicateKeyError:
+            # Already saved by a concurrent task
+            logger.info(f"{reply!r} is already in the replies box")
+
     @ensure_it_is_me
     def _handle_replies(self, as_actor: ap.Person, create: ap.Create) -> None:
-        """Go up to the root reply, store unknown replies in the `threads` DB and set the "meta.thread_root_parent"
-        key to make it easy to query a whole thread."""
+        """Update the replies counter of the parent and set the "meta.thread_root_parent" key to make it easy to query
+        a whole thread.
+
+        The root is found from the local ancestors, if an ancestor is unknown, the thread is resolved in the background
+        (see `resolve_ancestors`)."""
         in_reply_to = create.get_object().inReplyTo
         if not in_reply_to:
             return
 
-        new_threads = []
-        root_reply = in_reply_to
-        reply = ap.fetch_remote_activity(root_reply)
-
-        creply = DB.activities.find_one_and_update(
+        DB.activities.update_one(
             {"activity.object.id": in_reply_to},
             {"$inc": {"meta.count_reply": 1, "meta.count_direct_reply": 1}},
         )
-        if not creply:
-            # It means the activity is not in the inbox, and not in the outbox, we want to save it
-            self.save(Box.REPLIES, reply)
-            new_threads.append(reply.id)
-
-        while reply is not None:
-            in_reply_to = reply.inReplyTo
-            if not in_reply_to:
-                break
-            root_reply = in_reply_to
-            reply = ap.fetch_remote_activity(root_reply)
-            q = {"activity.object.id": root_reply}
-            if not DB.activities.count(q):
-                self.save(Box.REPLIES, reply)
-                new_threads.append(reply.id)
 
-        DB.activities.update_one(
-            {"remote_id": create.id}, {"$set": {"meta.thread_root_parent": root_reply}}
+        if self.resolve_ancestors(create.id, in_reply_to, fetch=False):
+            return
+
+        if self.resolve_ancestors_cb:
+            self.resolve_ancestors_cb(create.id, in_reply_to)
+        else:
+            self.resolve_ancestors(create.id, in_reply_to)
+
+    def set_resolve_ancestors(self, cb):
+        self.resolve_ancestors_cb = cb
+
+    def resolve_ancestors(
+        self, create_id: str, in_reply_to: str, fetch: bool = True
+    ) -> bool:
+        """Go up the thread until an ancestor with a known root (or the root itself, or `MAX_ANCESTORS`), and store
+        the unknown ancestors in the replies box.
+
+        Returns False if an unknown ancestor was reached and `fetch` is not set."""
+
+        def lookup(iri: str) -> Optional[Tuple[Optional[str], Optional[str]]]:
+            doc = DB.activities.find_one(
+                {
+                    "$or": [
+                        {"activity.object.id": iri},
+                        {"box": Box.REPLIES.value, "remote_id": iri},
+                    ]
+                },
+                projection=["box", "activity", "meta.thread_root_parent"],
+            )
+            if not doc:
+                return None
+            note = doc["activity"]
+            if doc["box"] != Box.REPLIES.value:
+                note = note["object"]
+            return doc["meta"].get("thread_root_parent"), note.get("inReplyTo")
+
+        def fetch_reply(iri: str) -> Optional[Tuple[str, Optional[str]]]:
+            try:
+                reply = ap.fetch_remote_activity(iri)
+            except (ActivityGoneError, ActivityNotFoundError):
+                logger.info(f"{iri} is gone, stopping the thread of {create_id}")
+                return None
+            self._save_reply(reply)
+            return reply.id, reply.inReplyTo
+
+        res = find_thread_root(
+            in_reply_to, lookup, fetch_reply if fetch else None, MAX_ANCESTORS
         )
-        DB.activities.update(
-            {"box": Box.REPLIES.value, "remote_id": {"$in": new_threads}},
-            {"$set": {"meta.thread_root_parent": root_reply}},
+        if not res:
+            return False
+
+        root, new_threads = res
+        DB.activities.update_one(
+            {"remote_id": create_id}, {"$set": {"meta.thread_root_parent": root}}
         )
+        if new_threads:
+            DB.activities.update_many(
+                {"box": Box.REPLIES.value, "remote_id": {"$in": new_threads}},
+                {"$set": {"meta.thread_root_parent": root}},
+            )
+        return True
 
     def post_to_outbox(self, activity: ap.BaseActivity) -> None:
         if activity.has_type(ap.CREATE_TYPES):
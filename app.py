@@ -1,16 +1,19 @@
 import binascii
 import json
 import logging
+import math
 import mimetypes
 import os
 import traceback
 import urllib
 from datetime import datetime
+from datetime import timedelta
 from datetime import timezone
 from functools import wraps
 from io import BytesIO
 from typing import Any
 from typing import Dict
+from typing import List
 from typing import Optional
 from typing import Tuple
 from urllib.parse import urlencode
@@ -46,7 +49,6 @@ from little_boxes.errors import ActivityNotFoundError
 from little_boxes.errors import Error
 from little_boxes.errors import NotFromOutboxError
 from little_boxes.httpsig import HTTPSigAuth
-from little_boxes.httpsig import verify_request
 from little_boxes.webfinger import get_actor_url
 from little_boxes.webfinger import get_remote_follow_template
 from passlib.hash import bcrypt
@@ -56,6 +58,7 @@ from werkzeug.utils import secure_filename
 import activitypub
 import config
 import tasks
+from activitypub import BLOCKLIST
 from activitypub import Box
 from activitypub import embed_collection
 from config import ADMIN_API_KEY
@@ -64,16 +67,22 @@ from config import DB
 from config import DEBUG_MODE
 from config import DOMAIN
 from config import HEADERS
+from config import HTTP_CLIENT
 from config import ICON_URL
 from config import ID
+from config import INBOX_FAST_ACK
+from config import INBOX_RATE_LIMITER
 from config import JWT
 from config import KEY
 from config import ME
+from config import MAX_INBOX_BODY_SIZE
 from config import MEDIA_CACHE
+from config import PAGE_CACHE
 from config import PASS
 from config import USERNAME
 from config import VERSION
 from config import _drop_db
+from utils.dedup import SeenFilter
 from utils.key import get_secret_key
 from utils.lookup import lookup
 from utils.media import Kind
@@ -102,6 +111,9 @@ else:
 
 SIG_AUTH = HTTPSigAuth(KEY)
 
+# IDs of the activities recently received in the inbox (to drop retried/relayed deliveries without any DB query)
+INBOX_SEEN = SeenFilter()
+
 
 def verify_pass(pwd):
     return bcrypt.verify(pwd, PASS)
@@ -154,6 +166,21 @@ def inject_config():
     )
 
 
+@app.before_request
+def start_memo():
+    activitypub.MEMO.start()
+
+
+@app.teardown_request
+def end_memo(exc):
+    activitypub.MEMO.end()
+
+
+@app.teardown_request
+def end_page_cache(exc):
+    PAGE_CACHE.end()
+
+
 @app.after_request
 def set_x_powered_by(response):
     response.headers["X-Powered-By"] = "microblog.pub"
@@ -750,7 +777,11 @@ def tmp_migrate4():
 @login_required
 def tmp_migrate5():
     for activity in DB.activities.find():
-        tasks.cache_actor.delay(activity["remote_id"], also_cache_attachments=False)
+        tasks.cache_actor.apply_async(
+            args=[activity["remote_id"]],
+            kwargs={"also_cache_attachments": False},
+            priority=tasks.BACKFILL_PRIORITY,
+        )
 
     return "Done"
 
@@ -780,6 +811,20 @@ def tmp_migrate6():
     return "Done"
 
 
+@app.route("/migration6")
+@login_required
+def tmp_migrate7():
+    count = back.rebuild_recipients()
+    return f"Done, {count} followers"
+
+
+@app.route("/migration7")
+@login_required
+def tmp_migrate8():
+    count = config.remove_duplicate_activities()
+    return f"Done, {count} duplicate activities removed"
+
+
 def paginated_query(db, q, limit=25, sort_key="_id"):
     older_than = newer_than = None
     query_sort = -1
@@ -824,25 +869,30 @@ def _get_cached(type_="html", arg=None):
         return None
     logged_in = session.get("logged_in")
     if not logged_in:
-        cached = DB.cache2.find_one({"path": request.path, "type": type_, "arg": arg})
+        cached = PAGE_CACHE.get((request.path, type_, arg))
         if cached:
             app.logger.info("from cache")
-            return cached['response_data']
+            return cached
     return None
 
-def _cache(resp, type_="html", arg=None):
+def _cache(resp, type_="html", arg=None, deps=None):
+    """Cache the response, `deps` are the IDs of the objects/collections it depends on (see `tasks.cache_deps`)."""
     if not CACHING:
         return None
     logged_in = session.get("logged_in")
     if not logged_in:
-        DB.cache2.update_one(
-            {"path": request.path, "type": type_, "arg": arg},
-            {"$set": {"response_data": resp, "date": datetime.now(timezone.utc)}},
-            upsert=True,
-        )
+        PAGE_CACHE.set((request.path, type_, arg), resp, deps or [])
     return None
 
 
+def _notes_deps(docs):
+    """Dependencies of a page listing notes: the notes (and their counters), the header counters and the profile."""
+    deps = ["outbox", "followers", "following", "liked", ID]
+    for doc in docs:
+        deps.append(activitypub.get_object_id(doc["activity"]))
+    return deps
+
+
 @app.route("/")
 def index():
     if is_api_request():
@@ -884,7 +934,7 @@ def index():
         newer_than=newer_than,
         pinned=pinned,
     )
-    _cache(resp, "html", cache_arg)
+    _cache(resp, "html", cache_arg, _notes_deps(pinned + outbox_data))
     return resp
 
 
@@ -1060,7 +1110,7 @@ def nodeinfo():
             )
 
     if not cached:
-        _cache(response, "api")
+        _cache(response, "api", deps=["outbox"])
     return Response(
         headers={
             "Content-Type": "application/json; profile=http://nodeinfo.diaspora.software/ns/schema/2.0#"
@@ -1200,7 +1250,7 @@ def outbox_detail(item_id):
         abort(404)
 
     if doc["meta"].get("deleted", False):
-        obj = ap.parse_activity(doc["activity"])
+        obj = activitypub.parse_activity(doc["activity"])
         resp = jsonify(**obj.get_tombstone().to_dict())
         resp.status_code = 410
         return resp
@@ -1216,7 +1266,7 @@ def outbox_activity(item_id):
         abort(404)
     obj = activity_from_doc(data)
     if data["meta"].get("deleted", False):
-        obj = ap.parse_activity(data["activity"])
+        obj = activitypub.parse_activity(data["activity"])
         resp = jsonify(**obj.get_object().get_tombstone().to_dict())
         resp.status_code = 410
         return resp
@@ -1239,14 +1289,14 @@ def outbox_activity_replies(item_id):
     )
     if not data:
         abort(404)
-    obj = ap.parse_activity(data["activity"])
-    if obj.ACTIVITY_TYPE != ActivityType.CREATE:
+    if not has_type(data["activity"], ActivityType.CREATE.value):
         abort(404)
+    object_id = activitypub.get_object_id(data["activity"])
 
     q = {
         "meta.deleted": False,
         "type": ActivityType.CREATE.value,
-        "activity.object.inReplyTo": obj.get_object().id,
+        "activity.object.inReplyTo": object_id,
     }
 
     return jsonify(
@@ -1274,16 +1324,16 @@ def outbox_activity_likes(item_id):
     )
     if not data:
         abort(404)
-    obj = ap.parse_activity(data["activity"])
-    if obj.ACTIVITY_TYPE != ActivityType.CREATE:
+    if not has_type(data["activity"], ActivityType.CREATE.value):
         abort(404)
+    object_id = activitypub.get_object_id(data["activity"])
 
     q = {
         "meta.undo": False,
         "type": ActivityType.LIKE.value,
         "$or": [
-            {"activity.object.id": obj.get_object().id},
-            {"activity.object": obj.get_object().id},
+            {"activity.object.id": object_id},
+            {"activity.object": object_id},
         ],
     }
 
@@ -1312,16 +1362,16 @@ def outbox_activity_shares(item_id):
     )
     if not data:
         abort(404)
-    obj = ap.parse_activity(data["activity"])
-    if obj.ACTIVITY_TYPE != ActivityType.CREATE:
+    if not has_type(data["activity"], ActivityType.CREATE.value):
         abort(404)
+    object_id = activitypub.get_object_id(data["activity"])
 
     q = {
         "meta.undo": False,
         "type": ActivityType.ANNOUNCE.value,
         "$or": [
-            {"activity.object.id": obj.get_object().id},
-            {"activity.object": obj.get_object().id},
+            {"activity.object.id": object_id},
+            {"activity.object": object_id},
         ],
     }
 
@@ -1350,7 +1400,15 @@ def admin():
 
     return render_template(
         "admin.html",
-        instances=list(DB.instances.find()),
+        instances=[
+            dict(
+                doc,
+                requests_per_minute=INBOX_RATE_LIMITER.requests_per_minute(doc),
+            )
+            for doc in DB.instances.find({"instance": {"$exists": True}}).sort(
+                "ingress.last_seen", -1
+            )
+        ],
         inbox_size=DB.activities.count({"box": Box.INBOX.value}),
         outbox_size=DB.activities.count({"box": Box.OUTBOX.value}),
         col_liked=col_liked,
@@ -1371,6 +1429,42 @@ def admin():
     )
 
 
+@app.route("/admin/deliveries", methods=["GET"])
+@login_required
+def admin_deliveries():
+    since = datetime.utcnow() - timedelta(hours=24)
+    stats = DB.deliveries.aggregate(
+        [
+            {"$match": {"created_at": {"$gte": since}}},
+            {
+                "$group": {
+                    "_id": "$host",
+                    "deliveries": {"$sum": 1},
+                    "done": {"$sum": {"$cond": [{"$eq": ["$status", "done"]}, 1, 0]}},
+                    "failed": {
+                        "$sum": {"$cond": [{"$eq": ["$status", "failed"]}, 1, 0]}
+                    },
+                    "attempts": {"$sum": "$attempts"},
+                    "total_duration": {"$sum": "$total_duration"},
+                    "max_duration": {"$max": "$duration"},
+                }
+            },
+            {"$sort": {"total_duration": -1}},
+        ]
+    )
+
+    q = {}
+    for arg in ["host", "status", "activity_id"]:
+        if request.args.get(arg):
+            q[arg] = request.args.get(arg)
+
+    return render_template(
+        "deliveries.html",
+        stats=list(stats),
+        deliveries=DB.deliveries.find(q).sort("created_at", -1).limit(100),
+    )
+
+
 @app.route("/admin/lookup", methods=["GET", "POST"])
 @login_required
 def admin_lookup():
@@ -1378,7 +1472,7 @@ def admin_lookup():
     meta = None
     if request.method == "POST":
         if request.form.get("url"):
-            data = lookup(request.form.get("url"))
+            data = lookup(request.form.get("url"), HTTP_CLIENT)
             if data.has_type(ActivityType.ANNOUNCE):
                 meta = dict(
                     object=data.get_object().to_dict(),
@@ -1425,7 +1519,7 @@ def admin_new():
     if request.args.get("reply"):
         data = DB.activities.find_one({"activity.object.id": request.args.get("reply")})
         if data:
-            reply = ap.parse_activity(data["activity"])
+            reply = activitypub.parse_activity(data["activity"])
         else:
             data = dict(
                 meta={},
@@ -1433,7 +1527,7 @@ def admin_new():
                     object=get_backend().fetch_iri(request.args.get("reply"))
                 ),
             )
-            reply = ap.parse_activity(data["activity"]["object"])
+            reply = activitypub.parse_activity(data["activity"]["object"])
 
         reply_id = reply.id
         if reply.ACTIVITY_TYPE == ActivityType.CREATE:
@@ -1645,6 +1739,20 @@ def admin_stream():
     )
 
 
+def _read_inbox_body() -> bytes:
+    """Read the body of an inbox request, up to `MAX_INBOX_BODY_SIZE` (a chunked request has no Content-Length)."""
+    chunks: List[bytes] = []
+    size = 0
+    while True:
+        chunk = request.stream.read(64 * 1024)
+        if not chunk:
+            return b"".join(chunks)
+        size += len(chunk)
+        if size > MAX_INBOX_BODY_SIZE:
+            abort(413)
+        chunks.append(chunk)
+
+
 @app.route("/inbox", methods=["GET", "POST"])
 def inbox():
     if request.method == "GET":
@@ -1665,56 +1773,75 @@ def inbox():
             )
         )
 
-    data = request.get_json(force=True)
-    logger.debug(f"req_headers={request.headers}")
-    logger.debug(f"raw_data={data}")
+    if request.content_length and request.content_length > MAX_INBOX_BODY_SIZE:
+        abort(413)
+
+    if tasks.is_blocked_request(request.headers):
+        logger.info("dropping inbox request signed by a blocked actor")
+        return Response(status=201)
+
+    body = _read_inbox_body()
     try:
-        if not verify_request(
-            request.method, request.path, request.headers, request.data
-        ):
-            raise Exception("failed to verify request")
-    except Exception:
-        logger.exception(
-            "failed to verify request, trying to verify the payload by fetching the remote"
-        )
-        try:
-            data = get_backend().fetch_iri(data["id"])
-        except ActivityGoneError:
-            # XXX Mastodon sends Delete activities that are not dereferencable, it's the actor url with #delete
-            # appended, so an `ActivityGoneError` kind of ensure it's "legit"
-            if data["type"] == ActivityType.DELETE.value and data["id"].startswith(
-                data["object"]
-            ):
-                logger.info(f"received a Delete for an actor {data!r}")
-                if get_backend().inbox_check_duplicate(MY_PERSON, data["id"]):
-                    # The activity is already in the inbox
-                    logger.info(f"received duplicate activity {data!r}, dropping it")
-
-                DB.activities.insert_one(
-                    {
-                        "box": Box.INBOX.value,
-                        "activity": data,
-                        "type": _to_list(data["type"]),
-                        "remote_id": data["id"],
-                        "meta": {"undo": False, "deleted": False},
-                    }
-                )
-                # TODO(tsileo): write the callback the the delete external actor event
-                return Response(status=201)
-        except Exception:
-            logger.exception(f'failed to fetch remote id at {data["id"]}')
+        data = json.loads(body)
+    except ValueError:
+        abort(400)
+    if isinstance(data, dict) and tasks.is_unknown_actor_delete(data):
+        # Account deletions are sent to every known instance
+        logger.info(f"dropping Delete for unknown actor {data['actor']}")
+        return Response(status=201)
+
+    if isinstance(data, dict) and data.get("id") in INBOX_SEEN:
+        # Retried/relayed delivery of an activity we already have
+        logger.info(f"received duplicate activity {data['id']}, dropping it")
+        return Response(status=201)
+
+    # Only the requests signed by a known key are rate limited (an unverified keyId may be spoofed to get the
+    # deliveries of a legit instance throttled)
+    host = tasks.request_host(request.headers)
+    verified = bool(host) and activitypub.KEY_STORE.verify_cached(
+        request.method, request.path, request.headers, body
+    )
+    if verified:
+        retry_after = INBOX_RATE_LIMITER.hit(host)
+        if retry_after:
+            logger.info(f"{host} is rate limited, retry after {retry_after:.1f}s")
             return Response(
-                status=422,
-                headers={"Content-Type": "application/json"},
-                response=json.dumps(
-                    {
-                        "error": "failed to verify request (using HTTP signatures or fetching the IRI)"
-                    }
-                ),
+                status=429, headers={"Retry-After": str(math.ceil(retry_after))}
             )
-    activity = ap.parse_activity(data)
-    logger.debug(f"inbox activity={activity}/{data}")
-    tasks.post_to_inbox(activity)
+
+    if INBOX_FAST_ACK:
+        if not isinstance(data, dict) or not isinstance(data.get("id"), str):
+            abort(400)
+        # Verification and processing are deferred to a worker
+        tasks.enqueue_inbox_request(
+            request.method, request.path, request.headers, body, verified
+        )
+        # Only marked as seen if signed by the instance of the activity (a forged request reusing the ID of an
+        # activity must not get the genuine one dropped)
+        if verified and urlparse(data["id"]).hostname == host:
+            INBOX_SEEN.add(data["id"])
+        return Response(status=202)
+
+    logger.debug(f"req_headers={request.headers}")
+    logger.debug(f"raw_data={data}")
+
+    if isinstance(data, dict) and tasks.is_blocked_request(request.headers, data):
+        logger.info(f"actor {data.get('actor')} is blocked, dropping {data.get('id')}")
+        return Response(status=201)
+
+    if not tasks.post_raw_to_inbox(
+        request.method, request.path, request.headers, body, verified
+    ):
+        return Response(
+            status=422,
+            headers={"Content-Type": "application/json"},
+            response=json.dumps(
+                {
+                    "error": "failed to verify request (using HTTP signatures or fetching the IRI)"
+                }
+            ),
+        )
+    INBOX_SEEN.add(data["id"])
 
     return Response(status=201)
 
@@ -1736,6 +1863,11 @@ def api_debug():
         return flask_jsonify(message="DEBUG_MODE is off")
 
     if request.method == "DELETE":
+        if request.args.get("recipients"):
+            # Simulates an instance upgraded from a version without the `recipients` collection
+            activitypub.RECIPIENTS.drop()
+            return flask_jsonify(message="recipients dropped")
+
         _drop_db()
         return flask_jsonify(message="DB dropped")
 
@@ -1834,6 +1966,7 @@ def api_block():
 
     block = ap.Block(actor=MY_PERSON.id, object=actor)
     block_id = tasks.post_to_outbox(block)
+    BLOCKLIST.invalidate()
 
     return _user_api_response(activity=block_id)
 
@@ -0,0 +1,443 @@
+"""Inbox ingestion benchmark.
+
+Generates (or replays) a corpus of signed Create/Like/Announce/Follow/Delete activities and posts them to the Flask
+app `/inbox`, with Celery tasks executed eagerly and the remote fetches (HTTP GET) served from the corpus. The Announce
+batches are deferred (as with their countdown) and flushed once all the requests are sent. Reports the throughput, the
+latency percentiles of the requests and of each inbox stage, the number of Announce batches, and the MongoDB
+operations count.
+
+It requires a local MongoDB and runs in debug mode only, as **the DB is dropped**:
+
+    MICROBLOGPUB_DEBUG=1 python -m benchmarks.inbox_bench -n 1000
+
+A recorded corpus (one JSON document per line, activities and the remote objects/actors they reference) can be
+replayed with `--corpus`, activities are re-signed with generated keys.
+"""
+
+import argparse
+import json
+import random
+import time
+from collections import Counter
+from collections import defaultdict
+from datetime import datetime
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Set
+from typing import Tuple
+from unittest import mock
+
+import pymongo.monitoring
+
+
+class _MongoCounter(pymongo.monitoring.CommandListener):
+    def __init__(self) -> None:
+        self.ops: Counter = Counter()
+
+    def started(self, event):
+        col = event.command.get(event.command_name)
+        if isinstance(col, str):
+            self.ops[(event.command_name, col)] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# Must be registered before the MongoDB client is created (when importing config)
+MONGO_OPS = _MongoCounter()
+pymongo.monitoring.register(MONGO_OPS)
+
+import requests  # noqa: E402
+from celery.signals import task_failure  # noqa: E402
+from little_boxes import activitypub as ap  # noqa: E402
+from little_boxes.activitypub import DEFAULT_CTX  # noqa: E402
+from little_boxes.httpsig import HTTPSigAuth  # noqa: E402
+from little_boxes.key import Key  # noqa: E402
+
+import app  # noqa: E402
+import config  # noqa: E402
+import tasks  # noqa: E402
+from config import BASE_URL  # noqa: E402
+from config import DB  # noqa: E402
+from config import ID  # noqa: E402
+from utils import opengraph  # noqa: E402
+
+TIMINGS: Dict[str, List[float]] = defaultdict(list)
+TASK_FAILURES: Counter = Counter()
+
+# Remote objects (actors, notes) served by the stubbed HTTP GET, and the IRIs returning a 410
+REMOTE: Dict[str, Dict[str, Any]] = {}
+GONE: Set[str] = set()
+
+# Objects whose Announce batch was scheduled (the countdown is ignored by the eager tasks)
+DEFERRED_BATCHES: List[str] = []
+# Number of Announce processed by each batch
+BATCH_SIZES: List[int] = []
+
+
+def _stub_get(url, *args, **kwargs):
+    """Serves the remote objects from the corpus (going through the fetch caches, like real HTTP fetches)."""
+    resp = requests.Response()
+    resp.url = url
+    resp._content = b""
+    iri = url.split("#")[0]
+    if iri in GONE:
+        resp.status_code = 410
+    elif iri not in REMOTE:
+        resp.status_code = 404
+    else:
+        resp.status_code = 200
+        resp.headers["Content-Type"] = "application/activity+json"
+        resp.encoding = "utf-8"
+        resp._content = json.dumps(REMOTE[iri]).encode("utf-8")
+    return resp
+
+
+def _stub_post(url, *args, **kwargs):
+    resp = requests.Response()
+    resp.status_code = 202
+    resp.url = url
+    resp._content = b""
+    return resp
+
+
+def _defer_batch(args, countdown=None, **kwargs):
+    DEFERRED_BATCHES.append(args[0])
+
+
+def _counted(inbox_announces: Callable) -> Callable:
+    def wrapper(as_actor, obj, announce_ids):
+        BATCH_SIZES.append(len(announce_ids))
+        return inbox_announces(as_actor, obj, announce_ids)
+
+    return wrapper
+
+
+def _timed(name: str, f: Callable) -> Callable:
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            TIMINGS[name].append(time.perf_counter() - start)
+
+    return wrapper
+
+
+@task_failure.connect
+def _on_task_failure(sender=None, **kwargs):
+    TASK_FAILURES[sender.name] += 1
+
+
+def setup() -> None:
+    if not config.DEBUG_MODE:
+        raise SystemExit("the benchmark drops the DB, run it with MICROBLOGPUB_DEBUG=1")
+
+    config._drop_db()
+    config.create_indexes()
+
+    tasks.app.conf.task_always_eager = True
+    # All the generated actors share a few hosts
+    config.INBOX_RATE_LIMITER.rate = 0
+
+    for i, (name, stage) in enumerate(tasks.INBOX_STAGES):
+        tasks.INBOX_STAGES[i] = (name, _timed(f"stage.{name}", stage))
+
+    # Patched for the whole run
+    patches: List[Any] = [
+        mock.patch.object(config.HTTP_CLIENT, "get", _timed("fetch", _stub_get)),
+        mock.patch.object(config.HTTP_CLIENT, "post", _stub_post),
+        mock.patch.object(opengraph, "fetch_og_metadata", lambda client, links: []),
+        mock.patch.object(config.MEDIA_CACHE, "cache", lambda *args, **kwargs: None),
+        mock.patch.object(
+            tasks.KEY_STORE,
+            "verify_request",
+            _timed("verify_request", tasks.KEY_STORE.verify_request),
+        ),
+        mock.patch.object(
+            tasks.back,
+            "inbox_announces",
+            _timed("announce_batch", _counted(tasks.back.inbox_announces)),
+        ),
+        mock.patch.object(tasks.process_announce_batch, "apply_async", _defer_batch),
+    ]
+    for patch in patches:
+        patch.start()
+
+
+def _actor(actor_id: str, key: Key) -> Dict[str, Any]:
+    return {
+        "@context": DEFAULT_CTX,
+        "type": ap.ActivityType.PERSON.value,
+        "id": actor_id,
+        "preferredUsername": actor_id.rsplit("/", 1)[-1],
+        "name": actor_id.rsplit("/", 1)[-1],
+        "url": actor_id,
+        "inbox": f"{actor_id}/inbox",
+        "outbox": f"{actor_id}/outbox",
+        "followers": f"{actor_id}/followers",
+        "following": f"{actor_id}/following",
+        "publicKey": key.to_dict(),
+    }
+
+
+def _note(actor_id: str, note_id: str, content: str) -> Dict[str, Any]:
+    return {
+        "type": ap.ActivityType.NOTE.value,
+        "id": note_id,
+        "attributedTo": actor_id,
+        "content": content,
+        "to": [ap.AS_PUBLIC],
+        "cc": [f"{actor_id}/followers"],
+        "published": datetime.utcnow().replace(microsecond=0).isoformat() + "Z",
+    }
+
+
+def generate_corpus(n: int, actors_count: int) -> List[Dict[str, Any]]:
+    """Generates the activities (the referenced remote objects are added to `REMOTE`)."""
+    create_id = tasks.post_to_outbox(
+        ap.Note(
+            attributedTo=ID,
+            to=[ap.AS_PUBLIC],
+            cc=[ID + "/followers"],
+            content="benchmark",
+        )
+    )
+    create = DB.activities.find_one({"remote_id": create_id})
+    assert create is not None
+    local_note = create["activity"]["object"]["id"]
+
+    actors = [
+        f"https://instance{i % 5}.example/users/user{i}" for i in range(actors_count)
+    ]
+    popular = []
+    for i, actor_id in enumerate(actors[:5]):
+        note = _note(actor_id, f"{actor_id}/statuses/popular", f"popular note {i}")
+        REMOTE[note["id"]] = note
+        popular.append(note["id"])
+
+    notes: List[Tuple[str, str]] = []
+    corpus = []
+    for i in range(n):
+        actor_id = random.choice(actors)
+        activity_id = f"{actor_id}/statuses/{i}/activity"
+        kind = random.choices(
+            ["create", "like", "announce", "follow", "delete", "delete_actor"],
+            weights=[50, 15, 20, 5, 5, 5],
+        )[0]
+        if kind == "create":
+            note = _note(actor_id, f"{actor_id}/statuses/{i}", f"note {i}")
+            notes.append((actor_id, note["id"]))
+            activity = {
+                "type": ap.ActivityType.CREATE.value,
+                "actor": actor_id,
+                "object": note,
+            }
+        elif kind == "like":
+            activity = {
+                "type": ap.ActivityType.LIKE.value,
+                "actor": actor_id,
+                "object": local_note,
+            }
+        elif kind == "announce":
+            activity = {
+                "type": ap.ActivityType.ANNOUNCE.value,
+                "actor": actor_id,
+                "object": random.choice(popular),
+            }
+        elif kind == "follow":
+            activity = {
+                "type": ap.ActivityType.FOLLOW.value,
+                "actor": actor_id,
+                "object": ID,
+            }
+        elif kind == "delete" and notes:
+            actor_id, note_id = notes.pop(random.randrange(len(notes)))
+            GONE.add(note_id)
+            activity_id = f"{note_id}#delete"
+            activity = {
+                "type": ap.ActivityType.DELETE.value,
+                "actor": actor_id,
+                "object": {"type": ap.ActivityType.TOMBSTONE.value, "id": note_id},
+            }
+        else:
+            # Account deletion sent by an instance we don't know
+            actor_id = f"https://unknown.example/users/user{i}"
+            activity_id = f"{actor_id}#delete"
+            activity = {
+                "type": ap.ActivityType.DELETE.value,
+                "actor": actor_id,
+                "object": actor_id,
+            }
+
+        activity.update(
+            {"@context": DEFAULT_CTX, "id": activity_id, "to": [ap.AS_PUBLIC]}
+        )
+        corpus.append(activity)
+
+    return corpus
+
+
+def load_corpus(path: str) -> List[Dict[str, Any]]:
+    """Loads a recorded corpus, documents without an actor are served by the stubbed HTTP GET."""
+    corpus = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            doc = json.loads(line)
+            if "actor" in doc and "id" in doc:
+                corpus.append(doc)
+            else:
+                REMOTE[doc["id"]] = doc
+
+    return corpus
+
+
+def _actor_id(activity: Dict[str, Any]) -> str:
+    if isinstance(activity["actor"], dict):
+        return activity["actor"]["id"]
+    return activity["actor"]
+
+
+def sign_corpus(
+    corpus: List[Dict[str, Any]], keys_count: int
+) -> Dict[str, HTTPSigAuth]:
+    """Generates a key for each actor (sharing `keys_count` RSA keys) and publishes it in the remote actor."""
+    keys = []
+    for _ in range(keys_count):
+        k = Key("")
+        k.new()
+        keys.append(k)
+
+    auths = {}
+    for i, activity in enumerate(corpus):
+        actor_id = _actor_id(activity)
+        if actor_id in auths:
+            continue
+
+        k = Key(actor_id)
+        k.load(keys[i % keys_count].privkey_pem)
+        auths[actor_id] = HTTPSigAuth(k)
+        if tasks.get_deleted_actor(activity):
+            GONE.add(actor_id)
+        elif actor_id in REMOTE:
+            REMOTE[actor_id]["publicKey"] = k.to_dict()
+        else:
+            REMOTE[actor_id] = _actor(actor_id, k)
+
+    return auths
+
+
+def run(corpus: List[Dict[str, Any]], auths: Dict[str, HTTPSigAuth]) -> Counter:
+    client = app.app.test_client()
+    statuses: Counter = Counter()
+    for activity in corpus:
+        body = json.dumps(activity)
+        req = requests.Request(
+            "POST",
+            f"{BASE_URL}/inbox",
+            data=body,
+            headers={
+                "Content-Type": "application/activity+json",
+                "User-Agent": "microblogpub-bench",
+            },
+        ).prepare()
+        auths[_actor_id(activity)](req)
+
+        start = time.perf_counter()
+        resp = client.post(
+            "/inbox", base_url=BASE_URL, data=body, headers=dict(req.headers)
+        )
+        TIMINGS[f"request.{activity['type']}"].append(time.perf_counter() - start)
+        statuses[resp.status_code] += 1
+
+    return statuses
+
+
+def flush_batches() -> None:
+    """Process the deferred Announce batches, as the workers would once their countdown elapsed (a failed batch is
+    scheduled again, and left deferred)."""
+    object_ids, DEFERRED_BATCHES[:] = list(DEFERRED_BATCHES), []
+    for object_id in object_ids:
+        tasks.process_announce_batch(object_id)
+
+
+def _percentile(values: List[float], p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def report(n: int, elapsed: float, statuses: Counter) -> None:
+    print(f"{n} activities in {elapsed:.2f}s ({n / elapsed:.1f} activities/s)")
+    print(f"status codes: {dict(statuses)}")
+    if TASK_FAILURES:
+        print(f"task failures: {dict(TASK_FAILURES)}")
+
+    print()
+    print(
+        f"{'latency (ms)':<24}{'count':>8}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}"
+    )
+    for name, values in sorted(TIMINGS.items()):
+        values = sorted(values)
+        print(
+            f"{name:<24}{len(values):>8}"
+            + "".join(
+                f"{_percentile(values, p) * 1000:>10.2f}" for p in [0.5, 0.9, 0.99]
+            )
+            + f"{values[-1] * 1000:>10.2f}"
+        )
+
+    print()
+    print(
+        f"announce batches: {len(BATCH_SIZES)} for {sum(BATCH_SIZES)} Announce "
+        f"({len(DEFERRED_BATCHES)} still deferred)"
+    )
+
+    total = sum(MONGO_OPS.ops.values())
+    print()
+    print(f"mongo ops: {total} ({total / n:.1f} per activity)")
+    for (op, col), count in MONGO_OPS.ops.most_common():
+        print(f"  {op:<16}{col:<20}{count:>8}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-n", type=int, default=500, help="activities to generate")
+    parser.add_argument("--actors", type=int, default=50)
+    parser.add_argument("--keys", type=int, default=4, help="distinct RSA keys")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus", help="replay a recorded corpus (JSON lines)")
+    parser.add_argument("--dump", help="save the generated corpus (JSON lines)")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    setup()
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+    else:
+        corpus = generate_corpus(args.n, args.actors)
+    auths = sign_corpus(corpus, args.keys)
+
+    if args.dump:
+        with open(args.dump, "w") as f:
+            for doc in list(REMOTE.values()) + corpus:
+                f.write(json.dumps(doc) + "\n")
+
+    # Only measure the ingestion
+    TIMINGS.clear()
+    MONGO_OPS.ops.clear()
+    BATCH_SIZES.clear()
+
+    start = time.perf_counter()
+    statuses = run(corpus, auths)
+    _timed("flush_batches", flush_batches)()
+    report(len(corpus), time.perf_counter() - start, statuses)
+
+
+if __name__ == "__main__":
+    main()
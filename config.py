@@ -1,3 +1,4 @@
+import logging
 import mimetypes
 import os
 import subprocess
@@ -11,12 +12,22 @@ from itsdangerous import JSONWebSignatureSerializer
 from little_boxes import strtobool
 from little_boxes.activitypub import DEFAULT_CTX
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
 import pymongo
 
 from utils.key import KEY_DIR
 from utils.key import get_key
 from utils.key import get_secret_key
+from utils.announcebatch import AnnounceBatches
+from utils.circuitbreaker import CircuitBreaker
+from utils.httpclient import HTTPClient
+from utils.ledger import DeliveryLedger
+from utils.ledger import DeliveryStatus  # noqa: F401
 from utils.media import MediaCache
+from utils.pagecache import PageCache
+from utils.ratelimit import RateLimiter
+
+logger = logging.getLogger(__name__)
 
 
 class ThemeStyle(Enum):
@@ -48,6 +59,33 @@ VERSION = (
 
 DEBUG_MODE = strtobool(os.getenv("MICROBLOGPUB_DEBUG", "false"))
 
+# When enabled, /inbox only stores the raw request and answers 202, the verification is done by a worker
+INBOX_FAST_ACK = strtobool(os.getenv("MICROBLOGPUB_INBOX_FAST_ACK", "false"))
+MAX_INBOX_BODY_SIZE = int(os.getenv("MICROBLOGPUB_MAX_INBOX_BODY_SIZE", 1024 * 1024))
+# Per-instance inbox rate limit (requests per second, and burst size), 0 to disable it
+INBOX_RATE = float(os.getenv("MICROBLOGPUB_INBOX_RATE", 10))
+INBOX_BURST = int(os.getenv("MICROBLOGPUB_INBOX_BURST", 200))
+# Number of inbox queues (`inbox.0`...`inbox.N-1`, each consumed by a single worker process), 0 to process the
+# inbox activities in the `inbox` queue
+INBOX_SHARDS = int(os.getenv("MICROBLOGPUB_INBOX_SHARDS", 0))
+# Announce of the same object received within the window (in seconds) are processed at once
+ANNOUNCE_BATCH_WINDOW = int(os.getenv("MICROBLOGPUB_ANNOUNCE_BATCH_WINDOW", 10))
+# When enabled, the deliveries are queued in the DB and sent by the async delivery worker (`delivery.py`)
+ASYNC_DELIVERY = strtobool(os.getenv("MICROBLOGPUB_ASYNC_DELIVERY", "false"))
+DELIVERY_CONCURRENCY = int(os.getenv("MICROBLOGPUB_DELIVERY_CONCURRENCY", 200))
+DELIVERY_HOST_CONCURRENCY = int(os.getenv("MICROBLOGPUB_DELIVERY_HOST_CONCURRENCY", 4))
+# Number of delivery queues (`delivery.0`...`delivery.N-1`), the deliveries are dispatched by destination host, 0 to
+# use the `delivery` queue
+DELIVERY_SHARDS = int(os.getenv("MICROBLOGPUB_DELIVERY_SHARDS", 0))
+# Actors cache: in-process size (per process), and how long (in seconds) a fetched actor is used before fetching it
+# again (it's refreshed in the background when it's about to expire)
+ACTORS_CACHE_SIZE = int(os.getenv("MICROBLOGPUB_ACTORS_CACHE_SIZE", 1024))
+ACTORS_CACHE_TTL = int(os.getenv("MICROBLOGPUB_ACTORS_CACHE_TTL", 3600 * 24))
+# Number of rendered pages cached in each process (in front of the `cache2` collection)
+PAGE_CACHE_SIZE = int(os.getenv("MICROBLOGPUB_PAGE_CACHE_SIZE", 256))
+# Rendered pages expire after 12 hours (they show relative times)
+PAGE_CACHE_TTL = 3600 * 12
+
 HEADERS = [
     "application/activity+json",
     "application/ld+json;profile=https://www.w3.org/ns/activitystreams",
@@ -69,6 +107,8 @@ with open(os.path.join(KEY_DIR, "me.yml")) as f:
     ICON_URL = conf["icon_url"]
     PASS = conf["pass"]
     EXTRA_INBOXES = conf.get("extra_inboxes", [])
+    # Activities from these domains (and their subdomains) are dropped
+    BLOCKED_DOMAINS = conf.get("blocked_domains", [])
 
     HIDE_FOLLOWING = conf.get("hide_following", True)
 
@@ -99,18 +139,135 @@ mongo_client = MongoClient(
 DB_NAME = "{}_{}".format(USERNAME, DOMAIN.replace(".", "_"))
 DB = mongo_client[DB_NAME]
 GRIDFS = mongo_client[f"{DB_NAME}_gridfs"]
-MEDIA_CACHE = MediaCache(GRIDFS, USER_AGENT)
+HTTP_CLIENT = HTTPClient(USER_AGENT, DB.instances)
+MEDIA_CACHE = MediaCache(GRIDFS, HTTP_CLIENT)
+DELIVERY_BREAKER = CircuitBreaker(DB.instances)
+LEDGER = DeliveryLedger(DB.payloads, DB.deliveries)
+INBOX_RATE_LIMITER = RateLimiter(DB.instances, INBOX_RATE, INBOX_BURST)
+ANNOUNCE_BATCHES = AnnounceBatches(DB.announce_batches, ANNOUNCE_BATCH_WINDOW)
+PAGE_CACHE = PageCache(
+    DB.cache2,
+    DB.cache_generations,
+    DB.cache_invalidations,
+    maxsize=PAGE_CACHE_SIZE,
+    ttl=PAGE_CACHE_TTL,
+)
+
+
+def _create_activities_unique_index():
+    DB.activities.create_index(
+        [("box", pymongo.ASCENDING), ("remote_id", pymongo.ASCENDING)], unique=True
+    )
+
+
+def remove_duplicate_activities():
+    """Keeps only the first copy of the activities stored more than once in the same box (then creates the unique
+    index), returns the number of activities removed."""
+    dups = DB.activities.aggregate(
+        [
+            {
+                "$group": {
+                    "_id": {"box": "$box", "remote_id": "$remote_id"},
+                    "ids": {"$push": "$_id"},
+                    "count": {"$sum": 1},
+                }
+            },
+            {"$match": {"count": {"$gt": 1}}},
+        ],
+        allowDiskUse=True,
+    )
+    removed = 0
+    for dup in dups:
+        keep, *extra = sorted(dup["ids"])
+        logger.info(
+            f"removing the duplicates of {dup['_id']} (keeping {keep}): {extra}"
+        )
+        removed += DB.activities.delete_many({"_id": {"$in": extra}}).deleted_count
+
+    _create_activities_unique_index()
+    return removed
 
 
 def create_indexes():
     DB.activities.create_index([("remote_id", pymongo.ASCENDING)])
+
+    # Activities are stored only once per box (duplicate deliveries are rejected on insert)
+    try:
+        _create_activities_unique_index()
+    except OperationFailure:
+        # Stored more than once by a previous version, see `/migration7`
+        logger.warning(
+            "duplicate activities found, the unique index will be created by /migration7"
+        )
     DB.activities.create_index([("activity.object.id", pymongo.ASCENDING)])
     DB.activities.create_index([
         ("activity.object.id", pymongo.ASCENDING),
         ("meta.deleted", pymongo.ASCENDING),
     ])
+    # Index for requeuing the pending inbox requests
+    DB.inbox_intake.create_index(
+        [("status", pymongo.ASCENDING), ("next_attempt_at", pymongo.ASCENDING)]
+    )
+    # The requests that failed too many times are kept a week
+    DB.inbox_intake.create_index("received_at", expireAfterSeconds=3600 * 24 * 7)
+
+    # Index for the actors cache and the public key store
+    DB.actors.create_index([("remote_id", pymongo.ASCENDING)])
+    DB.actors.create_index([("public_key.id", pymongo.ASCENDING)])
+    DB.actors.create_index([("hits", pymongo.DESCENDING)])
+    # Actors not fetched for a month are removed
+    DB.actors.create_index("fetched_at", expireAfterSeconds=3600 * 24 * 30)
+    # Objects fetched with an ETag/Last-Modified (removed as the actors)
+    DB.objects.create_index("remote_id", unique=True)
+    DB.objects.create_index("fetched_at", expireAfterSeconds=3600 * 24 * 30)
+
+    # Pending actor deletions (one per actor)
+    DB.actor_deletions.create_index([("actor_id", pymongo.ASCENDING)], unique=True)
+
+    # Signed payloads of the outgoing activities (kept while the deliveries may be retried)
+    DB.payloads.create_index("created_at", expireAfterSeconds=3600 * 24 * 7)
+    DB.payloads.create_index([("activity_id", pymongo.ASCENDING)])
+
+    # Index for claiming the pending deliveries
+    DB.deliveries.create_index(
+        [("status", pymongo.ASCENDING), ("next_attempt_at", pymongo.ASCENDING)]
+    )
+    # Index for replaying the parked deliveries
+    DB.deliveries.create_index(
+        [("host", pymongo.ASCENDING), ("status", pymongo.ASCENDING)]
+    )
+    # Deliveries ledger (kept as long as the payloads)
+    DB.deliveries.create_index("created_at", expireAfterSeconds=3600 * 24 * 7)
+    DB.deliveries.create_index([("activity_id", pymongo.ASCENDING)])
+    # A recipient is only delivered once per payload (the deliveries are enqueued again when the task is retried)
+    DB.deliveries.create_index(
+        [("payload_id", pymongo.ASCENDING), ("to", pymongo.ASCENDING)], unique=True
+    )
+
+    # Leases of the remote fetches in progress
+    DB.fetch_leases.create_index("expires_at", expireAfterSeconds=0)
+
+    # Actors whose inbox activities wait for an activity being retried
+    DB.inbox_holds.create_index([("actor_id", pymongo.ASCENDING)], unique=True)
+
+    # Pending Announce batches (one per announced object)
+    DB.announce_batches.create_index([("object_id", pymongo.ASCENDING)], unique=True)
+    DB.announce_batches.create_index([("scheduled_at", pymongo.ASCENDING)])
+
+    # Materialized inboxes of the followers (one document per follower)
+    DB.recipients.create_index([("actor_id", pymongo.ASCENDING)], unique=True)
+    DB.recipients.create_index([("follow_id", pymongo.ASCENDING)])
+    DB.recipients.create_index([("host", pymongo.ASCENDING)])
+
+    # Index for the rate limiter (one document per instance)
+    DB.instances.create_index(
+        [("instance", pymongo.ASCENDING)], unique=True, sparse=True
+    )
     DB.cache2.create_index([("path", pymongo.ASCENDING), ("type", pymongo.ASCENDING), ("arg", pymongo.ASCENDING)])
-    DB.cache2.create_index("date", expireAfterSeconds=3600*12)
+    DB.cache2.create_index("date", expireAfterSeconds=PAGE_CACHE_TTL)
+    # Targeted invalidations of the cached pages
+    DB.cache2.create_index([("deps", pymongo.ASCENDING)])
+    DB.cache_invalidations.create_index("at", expireAfterSeconds=3600)
 
     # Index for the block query
     DB.activities.create_index(
@@ -0,0 +1,323 @@
+"""Async delivery worker.
+
+Sends the deliveries queued in the `deliveries` collection (when `MICROBLOGPUB_ASYNC_DELIVERY` is enabled), with
+many concurrent requests in a single process (and a per-host concurrency limit).
+
+    $ python delivery.py
+
+With `MICROBLOGPUB_DELIVERY_SHARDS`, each shard is sent by its own worker:
+
+    $ python delivery.py --queue delivery.0
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+import uuid
+from datetime import datetime
+from datetime import timedelta
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import TypeVar
+
+import aiohttp
+from pymongo import UpdateOne
+
+from config import DB
+from config import DELIVERY_BREAKER
+from config import DELIVERY_CONCURRENCY
+from config import DELIVERY_HOST_CONCURRENCY
+from config import HEADERS
+from config import KEY
+from config import USER_AGENT
+from config import DeliveryStatus
+from utils.httpsig import HTTPSigDigestAuth
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+BATCH_SIZE = 500
+MAX_ATTEMPTS = 10
+# Deliveries claimed by a worker that died are retried after this delay
+CLAIM_TIMEOUT = timedelta(minutes=10)
+# Only the beginning of the response body is read (the inboxes don't return anything useful)
+MAX_RESPONSE_BODY_SIZE = 64 * 1024
+# Timeout of each delivery request (a slow instance doesn't hold the rest of the batch), without any total timeout:
+# it would include the wait for a connection of the pool (i.e. behind the other deliveries to the same host)
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=30)
+# The outcomes of the deliveries are written by chunks (or once this delay since the last write elapsed)
+OUTCOMES_FLUSH_SIZE = 100
+OUTCOMES_FLUSH_INTERVAL = 1.0
+
+
+def claim_batch(worker_id: str, queue: Optional[str] = None) -> List[Dict[str, Any]]:
+    now = datetime.utcnow()
+    q: Dict[str, Any] = {
+        "$or": [
+            {
+                "status": DeliveryStatus.PENDING.value,
+                "next_attempt_at": {"$lte": now},
+            },
+            {
+                "status": DeliveryStatus.PROCESSING.value,
+                "claimed_at": {"$lt": now - CLAIM_TIMEOUT},
+            },
+        ]
+    }
+    if queue:
+        q["queue"] = queue
+    ids = [
+        doc["_id"]
+        for doc in DB.deliveries.find(q, projection=["_id"])
+        .sort("next_attempt_at", 1)
+        .limit(BATCH_SIZE)
+    ]
+    if not ids:
+        return []
+
+    # Another worker may have claimed some of them in between
+    DB.deliveries.update_many(
+        {"$and": [{"_id": {"$in": ids}}, q]},
+        {
+            "$set": {
+                "status": DeliveryStatus.PROCESSING.value,
+                "worker": worker_id,
+                "claimed_at": now,
+            }
+        },
+    )
+    return list(
+        DB.deliveries.find(
+            {"worker": worker_id, "status": DeliveryStatus.PROCESSING.value}
+        )
+    )
+
+
+def release_batch(worker_id: str) -> None:
+    """Release the deliveries claimed by the worker (after an error), so they're retried without waiting for the
+    claim timeout."""
+    try:
+        DB.deliveries.update_many(
+            {"worker": worker_id, "status": DeliveryStatus.PROCESSING.value},
+            {
+                "$set": {
+                    "status": DeliveryStatus.PENDING.value,
+                    "next_attempt_at": datetime.utcnow() + timedelta(seconds=30),
+                }
+            },
+        )
+    except Exception:
+        logger.exception("failed to release the claimed deliveries")
+
+
+async def _blocking(func: Callable[..., T], *args: Any) -> T:
+    """Run a blocking call (DB queries, signing...) in the default executor, off the event loop."""
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+def _signed_headers(
+    delivery: Dict[str, Any], payload: Dict[str, Any]
+) -> Dict[str, str]:
+    headers = {
+        "Content-Type": HEADERS[1],
+        "Accept": HEADERS[1],
+        "User-Agent": USER_AGENT,
+    }
+    auth = HTTPSigDigestAuth(KEY, payload["digest"])
+    headers.update(auth.signed_headers("POST", delivery["to"], headers))
+    return headers
+
+
+async def deliver(
+    session: aiohttp.ClientSession, delivery: Dict[str, Any], payload: Dict[str, Any]
+) -> Tuple[int, float]:
+    """Returns the response status code (0 if the request failed) and the duration."""
+    headers = await _blocking(_signed_headers, delivery, payload)
+    start = time.monotonic()
+    try:
+        async with session.post(
+            delivery["to"],
+            data=payload["body"],
+            headers=headers,
+            timeout=REQUEST_TIMEOUT,
+        ) as resp:
+            await resp.content.read(MAX_RESPONSE_BODY_SIZE)
+            return resp.status, time.monotonic() - start
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception(f"failed to deliver to {delivery['to']}")
+        return 0, time.monotonic() - start
+
+
+def _outcome(delivery: Dict[str, Any], status_code: int, duration: float) -> UpdateOne:
+    now = datetime.utcnow()
+    attempts = delivery["attempts"] + 1
+    update: Dict[str, Any] = {
+        "attempts": attempts,
+        "status_code": status_code,
+        "duration": duration,
+        "last_attempt_at": now,
+    }
+    if 200 <= status_code < 300:
+        update["status"] = DeliveryStatus.DONE.value
+    elif (400 <= status_code < 500 and status_code != 429) or attempts >= MAX_ATTEMPTS:
+        # Client errors are not retried
+        update["status"] = DeliveryStatus.FAILED.value
+    else:
+        update["status"] = DeliveryStatus.PENDING.value
+        update["next_attempt_at"] = datetime.utcnow() + timedelta(
+            seconds=int(random.uniform(2, 4) ** attempts)
+        )
+
+    attempt = {"at": now, "status_code": status_code, "duration": duration}
+    return UpdateOne(
+        {"_id": delivery["_id"]},
+        {
+            "$set": update,
+            "$inc": {"total_duration": duration},
+            "$push": {"history": {"$each": [attempt], "$slice": -MAX_ATTEMPTS}},
+        },
+    )
+
+
+def _is_alive(status_code: int) -> bool:
+    """Returns True if the instance answered (client errors included)."""
+    return 200 <= status_code < 500 and status_code != 429
+
+
+def _record_health(deliveries: List[Dict[str, Any]], status_codes: List[int]) -> None:
+    """Update the circuit breaker of each instance, replaying the parked deliveries of the recovered ones."""
+    outcomes: List[Tuple[str, Optional[bool]]] = []
+    for delivery, code in zip(deliveries, status_codes):
+        if _is_alive(code):
+            outcomes.append((delivery["host"], True))
+        elif code == 0 or code >= 500:
+            outcomes.append((delivery["host"], False))
+
+    for host in DELIVERY_BREAKER.record_batch(outcomes):
+        DB.deliveries.update_many(
+            {"host": host, "status": DeliveryStatus.PARKED.value},
+            {
+                "$set": {
+                    "status": DeliveryStatus.PENDING.value,
+                    "next_attempt_at": datetime.utcnow(),
+                }
+            },
+        )
+
+
+def _find_payloads(deliveries: List[Dict[str, Any]]) -> Dict[Any, Dict[str, Any]]:
+    payload_ids = list({d["payload_id"] for d in deliveries})
+    return {p["_id"]: p for p in DB.payloads.find({"_id": {"$in": payload_ids}})}
+
+
+def _write_outcomes(outcomes: List[UpdateOne]) -> None:
+    DB.deliveries.bulk_write(outcomes, ordered=False)
+
+
+async def process_batch(
+    session: aiohttp.ClientSession, deliveries: List[Dict[str, Any]]
+) -> None:
+    payloads = await _blocking(_find_payloads, deliveries)
+
+    outcomes = []
+    sendable = []
+    for delivery in deliveries:
+        if delivery["payload_id"] in payloads:
+            sendable.append(delivery)
+            continue
+        logger.warning(f"payload {delivery['payload_id']} not found")
+        outcomes.append(
+            UpdateOne(
+                {"_id": delivery["_id"]},
+                {"$set": {"status": DeliveryStatus.FAILED.value}},
+            )
+        )
+
+    # Only a single delivery is sent to probe a half-open instance, the other ones are parked
+    todo = []
+    admitted = await _blocking(DELIVERY_BREAKER.admit, [d["host"] for d in sendable])
+    for delivery, ok in zip(sendable, admitted):
+        if ok:
+            todo.append(delivery)
+            continue
+        outcomes.append(
+            UpdateOne(
+                {"_id": delivery["_id"]},
+                {"$set": {"status": DeliveryStatus.PARKED.value}},
+            )
+        )
+
+    async def send(
+        delivery: Dict[str, Any],
+    ) -> Tuple[Dict[str, Any], Tuple[int, float]]:
+        return delivery, await deliver(
+            session, delivery, payloads[delivery["payload_id"]]
+        )
+
+    # The outcomes are written while the slowest deliveries are still in flight
+    sent = []
+    status_codes = []
+    flushed_at = time.monotonic()
+    for fut in asyncio.as_completed([send(d) for d in todo]):
+        delivery, (code, duration) = await fut
+        outcomes.append(_outcome(delivery, code, duration))
+        sent.append(delivery)
+        status_codes.append(code)
+        if (
+            len(outcomes) >= OUTCOMES_FLUSH_SIZE
+            or time.monotonic() - flushed_at > OUTCOMES_FLUSH_INTERVAL
+        ):
+            await _blocking(_write_outcomes, outcomes)
+            outcomes = []
+            flushed_at = time.monotonic()
+
+    if outcomes:
+        await _blocking(_write_outcomes, outcomes)
+
+    await _blocking(_record_health, sent, status_codes)
+    logger.info(
+        f"{len(deliveries)} deliveries processed, "
+        f"{sum(1 for code in status_codes if 200 <= code < 300)} succeeded"
+    )
+
+
+async def run(queue: Optional[str] = None) -> None:
+    worker_id = uuid.uuid4().hex
+    connector = aiohttp.TCPConnector(
+        limit=DELIVERY_CONCURRENCY,
+        limit_per_host=DELIVERY_HOST_CONCURRENCY,
+        ttl_dns_cache=300,
+    )
+    async with aiohttp.ClientSession(connector=connector) as session:
+        while True:
+            try:
+                deliveries = await _blocking(claim_batch, worker_id, queue)
+                if not deliveries:
+                    await asyncio.sleep(1)
+                    continue
+
+                await process_batch(session, deliveries)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("failed to process the deliveries")
+                await _blocking(release_batch, worker_id)
+                await asyncio.sleep(5)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Async delivery worker")
+    parser.add_argument("--queue", help="only send the deliveries of this shard")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.get_event_loop().run_until_complete(run(args.queue))
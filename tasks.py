@@ -2,162 +2,461 @@ import json
 import logging
 import os
 import random
+import time
+from datetime import datetime
+from datetime import timedelta
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from urllib.parse import urlparse
 
 import requests
+from bson.objectid import ObjectId
 from celery import Celery
+from celery.signals import task_postrun
+from celery.signals import task_prerun
+from kombu import Queue
 from little_boxes import activitypub as ap
 from little_boxes.errors import BadActivityError
 from little_boxes.errors import ActivityGoneError
 from little_boxes.errors import ActivityNotFoundError
 from little_boxes.errors import NotAnActivityError
-from little_boxes.httpsig import HTTPSigAuth
+from little_boxes.httpsig import _body_digest
+from little_boxes.httpsig import _parse_sig_header
 from little_boxes.linked_data_sig import generate_signature
+from pymongo.errors import DuplicateKeyError
 from requests.exceptions import HTTPError
+from requests.structures import CaseInsensitiveDict
 
 import activitypub
+from activitypub import BLOCKLIST
+from activitypub import KEY_STORE
 from activitypub import Box
 from config import DB
+from config import DELIVERY_BREAKER
+from config import DELIVERY_SHARDS
 from config import HEADERS
+from config import HTTP_CLIENT
+from config import INBOX_SHARDS
 from config import ME
 from config import ID
 from config import KEY
+from config import LEDGER
+from config import DeliveryStatus
 from config import MEDIA_CACHE
-from config import USER_AGENT
+from config import PAGE_CACHE
+from config import ANNOUNCE_BATCHES
+from config import ASYNC_DELIVERY
 from config import BASE_URL
 from utils import opengraph
+from utils.cachedeps import activity_deps
+from utils.hashring import HashRing
+from utils.httpclient import ResponseTooLargeError
+from utils.httpsig import HTTPSigDigestAuth
+from utils.inboxholds import InboxHolds
+from utils.intake import InboxIntake
+from utils.intake import parse_body
 from utils.media import Kind
+from utils.recipients import resolve_inboxes
+from utils.stages import run_stages
 
 log = logging.getLogger(__name__)
 app = Celery(
     "tasks", broker=os.getenv("MICROBLOGPUB_AMQP_BROKER", "pyamqp://guest@localhost//")
 )
-SigAuth = HTTPSigAuth(KEY)
+app.conf.beat_schedule = {
+    "requeue-inbox-intake": {"task": "tasks.requeue_inbox_intake", "schedule": 60.0},
+    "process-actor-deletions": {
+        "task": "tasks.process_actor_deletions",
+        "schedule": 60.0,
+    },
+    "flush-announce-batches": {
+        "task": "tasks.flush_announce_batches",
+        "schedule": 60.0,
+    },
+    "probe-open-circuits": {"task": "tasks.probe_open_circuits", "schedule": 300.0},
+}
+
+# Tasks are routed by priority: the outbox (the actions a user is waiting on), the inbox, the deliveries and the
+# media/metadata fetching. Each queue has its own workers (see `docker-compose.yml`), so a backlog of media
+# downloads never delays a note being posted.
+app.conf.task_queues = [
+    Queue("celery"),
+    Queue("outbox"),
+    Queue("inbox"),
+    Queue("delivery"),
+    Queue("media", queue_arguments={"x-max-priority": 10}),
+]
+app.conf.task_routes = {
+    "tasks.finish_post_to_outbox": {"queue": "outbox"},
+    "tasks.process_inbox": {"queue": "inbox"},
+    "tasks.process_inbox_intake": {"queue": "inbox"},
+    "tasks.process_announce_batch": {"queue": "inbox"},
+    "tasks.forward_activity": {"queue": "delivery"},
+    "tasks.post_to_remote_inbox": {"queue": "delivery"},
+    "tasks.replay_parked_deliveries": {"queue": "delivery"},
+    "tasks.probe_open_circuits": {"queue": "delivery"},
+    "tasks.fetch_og_metadata": {"queue": "media", "priority": 5},
+    "tasks.cache_object": {"queue": "media", "priority": 5},
+    "tasks.cache_actor": {"queue": "media", "priority": 5},
+    "tasks.cache_attachments": {"queue": "media", "priority": 5},
+    "tasks.refresh_actor": {"queue": "media", "priority": 5},
+    "tasks.resolve_ancestors": {"queue": "media", "priority": 5},
+}
+# Only reserve one task at a time, so the priorities are respected (and a long download doesn't hold other tasks)
+app.conf.worker_prefetch_multiplier = 1
+
+# Priority of the media tasks spawned by the backfills (lower than the new activities)
+BACKFILL_PRIORITY = 0
 
 
 back = activitypub.MicroblogPubBackend()
 ap.use_backend(back)
 
 
+@task_prerun.connect
+def start_memo(**kwargs):
+    activitypub.MEMO.start()
+
+
+@task_postrun.connect
+def end_memo(**kwargs):
+    activitypub.MEMO.end()
+
+
 MY_PERSON = ap.Person(**ME)
 
 MAX_RETRIES = 9
 
+# The inbox activities are sharded by actor, each shard queue is consumed by a single worker process, so the
+# activities of an actor are processed in order (while the shards are processed in parallel)
+INBOX_RING = (
+    HashRing([f"inbox.{i}" for i in range(INBOX_SHARDS)]) if INBOX_SHARDS else None
+)
 
-@app.task(bind=True, max_retries=MAX_RETRIES)  # noqa: C901
-def process_new_activity(self, iri: str) -> None:
-    """Process an activity received in the inbox"""
-    try:
-        activity = ap.fetch_remote_activity(iri)
-        log.info(f"activity={activity!r}")
+# An actor whose activity failed for longer than an hour is no longer held (its activities are processed out of order)
+INBOX_HOLDS = InboxHolds(DB.inbox_holds, timeout=timedelta(hours=1))
+
+# Raw inbox requests of the fast-ack mode (requests not picked up by a worker within 5 minutes are spawned again)
+INBOX_INTAKE = InboxIntake(
+    DB.inbox_intake, grace=timedelta(minutes=5), max_retries=MAX_RETRIES
+)
+
+# The deliveries are sharded by destination host, so the connections to an instance are kept alive by a few workers
+DELIVERY_RING = (
+    HashRing([f"delivery.{i}" for i in range(DELIVERY_SHARDS)])
+    if DELIVERY_SHARDS
+    else None
+)
+
+
+def _skip_caching(activity: ap.BaseActivity, meta: Dict[str, Any]) -> bool:
+    """Returns True if the actor/object/media of the activity should not be cached."""
+    return meta.get("deleted", False) or activity.has_type(ap.ActivityType.DELETE)
 
-        # Is the activity expected?
-        # following = ap.get_backend().following()
-        should_forward = False
-        should_delete = False
 
-        tag_stream = False
-        if activity.has_type(ap.ActivityType.ANNOUNCE):
+def _inbox_process_stage(  # noqa: C901
+    activity: ap.BaseActivity, meta: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Tag the activity (stream/forwarded/deleted) and forward it if needed."""
+    # Is the activity expected?
+    # following = ap.get_backend().following()
+    should_forward = False
+    should_delete = False
+
+    tag_stream = False
+    # Announce are tagged once their object is resolved (see `process_announce_batch`)
+    if activity.has_type(ap.ActivityType.CREATE):
+        note = activity.get_object()
+        # Make the note part of the stream if it's not a reply, or if it's a local reply
+        if not note.inReplyTo or note.inReplyTo.startswith(ID):
+            tag_stream = True
+
+        if note.inReplyTo:
             try:
-                activity.get_object()
-                tag_stream = True
-            except (NotAnActivityError, BadActivityError):
-                log.exception(f"failed to get announce object for {activity!r}")
-                # Most likely on OStatus notice
-                tag_stream = False
-                should_delete = True
-            except (ActivityGoneError, ActivityNotFoundError):
-                # The announced activity is deleted/gone, drop it
+                reply = ap.fetch_remote_activity(note.inReplyTo)
+                if (
+                    reply.id.startswith(ID) or reply.has_mention(ID)
+                ) and activity.is_public():
+                    # The reply is public "local reply", forward the reply (i.e. the original activity) to the
+                    # original recipients
+                    should_forward = True
+            except NotAnActivityError:
+                # Most likely a reply to an OStatus notce
                 should_delete = True
 
-        elif activity.has_type(ap.ActivityType.CREATE):
-            note = activity.get_object()
-            # Make the note part of the stream if it's not a reply, or if it's a local reply
-            if not note.inReplyTo or note.inReplyTo.startswith(ID):
-                tag_stream = True
-
-            if note.inReplyTo:
-                try:
-                    reply = ap.fetch_remote_activity(note.inReplyTo)
-                    if (
-                        reply.id.startswith(ID) or reply.has_mention(ID)
-                    ) and activity.is_public():
-                        # The reply is public "local reply", forward the reply (i.e. the original activity) to the
-                        # original recipients
-                        should_forward = True
-                except NotAnActivityError:
-                    # Most likely a reply to an OStatus notce
-                    should_delete = True
-
-            # (partial) Ghost replies handling
-            # [X] This is the first time the server has seen this Activity.
+        # (partial) Ghost replies handling
+        # [X] This is the first time the server has seen this Activity.
+        should_forward = False
+        local_followers = ID + "/followers"
+        for field in ["to", "cc"]:
+            if field in activity._data:
+                if local_followers in activity._data[field]:
+                    # [X] The values of to, cc, and/or audience contain a Collection owned by the server.
+                    should_forward = True
+
+        # [X] The values of inReplyTo, object, target and/or tag are objects owned by the server
+        if not (note.inReplyTo and note.inReplyTo.startswith(ID)):
             should_forward = False
-            local_followers = ID + "/followers"
-            for field in ["to", "cc"]:
-                if field in activity._data:
-                    if local_followers in activity._data[field]:
-                        # [X] The values of to, cc, and/or audience contain a Collection owned by the server.
-                        should_forward = True
-
-            # [X] The values of inReplyTo, object, target and/or tag are objects owned by the server
-            if not (note.inReplyTo and note.inReplyTo.startswith(ID)):
-                should_forward = False
-
-        elif activity.has_type(ap.ActivityType.DELETE):
-            note = DB.activities.find_one(
-                {"activity.object.id": activity.get_object().id}
-            )
-            if note and note["meta"].get("forwarded", False):
-                # If the activity was originally forwarded, forward the delete too
-                should_forward = True
 
-        elif activity.has_type(ap.ActivityType.LIKE):
-            if not activity.get_object_id().startswith(BASE_URL):
-                # We only want to keep a like if it's a like for a local activity
-                # (Pleroma relay the likes it received, we don't want to store them)
-                should_delete = True
+    elif activity.has_type(ap.ActivityType.DELETE):
+        note = DB.activities.find_one({"activity.object.id": activity.get_object().id})
+        if note and note["meta"].get("forwarded", False):
+            # If the activity was originally forwarded, forward the delete too
+            should_forward = True
+
+    elif activity.has_type(ap.ActivityType.LIKE):
+        if not activity.get_object_id().startswith(BASE_URL):
+            # We only want to keep a like if it's a like for a local activity
+            # (Pleroma relay the likes it received, we don't want to store them)
+            should_delete = True
+
+    if should_forward:
+        log.info(f"will forward {activity!r} to followers")
+        forward_activity.delay(activity.id)
+
+    if should_delete:
+        log.info(f"will soft delete {activity!r}")
+
+    log.info(f"{activity.id} tag_stream={tag_stream}")
+    return {"stream": tag_stream, "forwarded": should_forward, "deleted": should_delete}
+
+
+def _inbox_finish_stage(
+    activity: ap.BaseActivity, meta: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Apply the side effects of the activity (counters, follow/accept, undo, delete...)."""
+    if activity.has_type(ap.ActivityType.DELETE):
+        back.inbox_delete(MY_PERSON, activity)
+    elif activity.has_type(ap.ActivityType.UPDATE):
+        back.inbox_update(MY_PERSON, activity)
+    elif activity.has_type(ap.ActivityType.CREATE):
+        back.inbox_create(MY_PERSON, activity)
+    elif activity.has_type(ap.ActivityType.ANNOUNCE):
+        # The object is resolved (and the cache invalidated) once for all the Announce received in the window
+        queue_announce(activity)
+        return {}
+    elif activity.has_type(ap.ActivityType.LIKE):
+        back.inbox_like(MY_PERSON, activity)
+    elif activity.has_type(ap.ActivityType.FOLLOW):
+        # Reply to a Follow with an Accept
+        accept = ap.Accept(actor=ID, object=activity.to_dict(embed=True))
+        post_to_outbox(accept)
+    elif activity.has_type(ap.ActivityType.UNDO):
+        obj = activity.get_object()
+        if obj.has_type(ap.ActivityType.LIKE):
+            back.inbox_undo_like(MY_PERSON, obj)
+        elif obj.has_type(ap.ActivityType.ANNOUNCE):
+            back.inbox_undo_announce(MY_PERSON, obj)
+        elif obj.has_type(ap.ActivityType.FOLLOW):
+            back.undo_new_follower(MY_PERSON, obj)
+    try:
+        invalidate_cache(activity)
+    except Exception:
+        log.exception("failed to invalidate cache")
 
-        if should_forward:
-            log.info(f"will forward {activity!r} to followers")
-            forward_activity.delay(activity.id)
+    return {}
 
-        if should_delete:
-            log.info(f"will soft delete {activity!r}")
 
-        log.info(f"{iri} tag_stream={tag_stream}")
-        DB.activities.update_one(
-            {"remote_id": activity.id},
-            {
-                "$set": {
-                    "meta.stream": tag_stream,
-                    "meta.forwarded": should_forward,
-                    "meta.deleted": should_delete,
-                }
-            },
+def _inbox_actor_stage(
+    activity: ap.BaseActivity, meta: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Cache the actor info (with its inbox if it's a new follower)."""
+    if _skip_caching(activity, meta):
+        return {}
+
+    actor = activity.get_actor()
+    return {
+        "actor": activitypub._actor_to_meta(
+            actor, activity.has_type(ap.ActivityType.FOLLOW)
         )
+    }
+
+
+def _inbox_object_stage(
+    activity: ap.BaseActivity, meta: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Cache the object of a Like (Announce objects are cached by `process_announce_batch`)."""
+    if _skip_caching(activity, meta) or not activity.has_type(ap.ActivityType.LIKE):
+        return {}
+
+    try:
+        obj = activity.get_object()
+        return {
+            "object": obj.to_dict(embed=True),
+            "object_actor": activitypub._actor_to_meta(obj.get_actor()),
+        }
+    except (ActivityGoneError, ActivityNotFoundError, NotAnActivityError):
+        log.exception(f"flagging activity {activity.id} as deleted, no object caching")
+        return {"deleted": True}
+
+
+def _inbox_media_stage(
+    activity: ap.BaseActivity, meta: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Spawn the tasks caching the OG metadata and the attachments of a Create (the media download runs
+    in separate tasks, using the already parsed note/actor)."""
+    if _skip_caching(activity, meta) or not activity.has_type(ap.ActivityType.CREATE):
+        return {}
+
+    note = activity.get_object().to_dict(embed=True)
+    fetch_og_metadata.delay(activity.id, note)
+    cache_attachments.delay(activity.id, activity.get_actor().to_dict(embed=True), note)
+    return {}
+
+
+INBOX_STAGES = [
+    ("process", _inbox_process_stage),
+    ("finish", _inbox_finish_stage),
+    ("actor", _inbox_actor_stage),
+    ("object", _inbox_object_stage),
+    ("media", _inbox_media_stage),
+]
+
+
+def _activity_actor(data: Dict[str, Any]) -> Optional[str]:
+    actor = data.get("actor")
+    if isinstance(actor, dict):
+        return actor.get("id")
+    return actor
+
+
+@app.task(bind=True, max_retries=MAX_RETRIES)
+def process_inbox(self, iri: str) -> None:
+    """Inbox ingestion pipeline.
+
+    The activity is read from the DB and parsed once, the parsed activity (along with its resolved actor/object)
+    is then handed to each stage. Stages already done are skipped when the task is retried.
+
+    With `INBOX_SHARDS`, the later activities of an actor wait while an activity is retried (so an `Undo` is never
+    processed before its `Like`).
+    """
+    actor_id = None
+    try:
+        doc = DB.activities.find_one({"box": Box.INBOX.value, "remote_id": iri})
+        if not doc:
+            log.info(f"{iri} is not in the inbox, skip processing")
+            return
 
+        if INBOX_RING:
+            actor_id = _activity_actor(doc["activity"])
+            if actor_id and INBOX_HOLDS.is_held(actor_id, iri):
+                return
+
+        activity = activitypub.parse_activity(doc["activity"])
+        log.info(f"activity={activity!r}")
+
+        run_stages(
+            DB.activities,
+            doc,
+            activity,
+            INBOX_STAGES,
+            drop_errors=(ActivityGoneError, ActivityNotFoundError, NotAnActivityError),
+        )
         log.info(f"new activity {iri} processed")
-        if not should_delete and not activity.has_type(ap.ActivityType.DELETE):
-            cache_actor.delay(iri)
-    except (ActivityGoneError, ActivityNotFoundError):
+    except (ActivityGoneError, ActivityNotFoundError, NotAnActivityError):
         log.exception(f"dropping activity {iri}, skip processing")
     except Exception as err:
         log.exception(f"failed to process new activity {iri}")
-        self.retry(exc=err, countdown=int(random.uniform(2, 4) ** self.request.retries))
+        if not actor_id or self.request.retries < self.max_retries:
+            if actor_id:
+                INBOX_HOLDS.hold(actor_id, iri)
+            self.retry(
+                exc=err, countdown=int(random.uniform(2, 4) ** self.request.retries)
+            )
+        # The retries are exhausted, let the next activities of the actor go through
+        log.warning(f"giving up on {iri}")
+
+    if actor_id:
+        INBOX_HOLDS.release(actor_id, iri)
+
+
+INBOX_HOLDS.spawn = lambda actor_id, iri: process_inbox.apply_async(
+    args=[iri], queue=inbox_queue(actor_id)
+)
+
+
+def queue_announce(announce: ap.BaseActivity) -> None:
+    """Add the Announce to the batch of its object, the batch is processed after `ANNOUNCE_BATCH_WINDOW` seconds."""
+    object_id = announce.get_object_id()
+    if ANNOUNCE_BATCHES.add(object_id, announce.id):
+        process_announce_batch.apply_async(
+            args=[object_id], countdown=ANNOUNCE_BATCHES.window
+        )
+
+
+def _drop_announces(announce_ids: List[str]) -> None:
+    DB.activities.update_many(
+        {"box": Box.INBOX.value, "remote_id": {"$in": announce_ids}},
+        {"$set": {"meta.deleted": True}},
+    )
+
+
+@app.task
+def process_announce_batch(object_id: str) -> None:
+    """Process a batch of Announce, a failed batch is scheduled again (with a backoff) up to `MAX_RETRIES` times."""
+    batch = ANNOUNCE_BATCHES.take(object_id)
+    if not batch:
+        return
+
+    announce_ids = batch["activities"]
+    log.info(f"processing {len(announce_ids)} Announce of {object_id}")
+    try:
+        obj = ap.fetch_remote_activity(object_id)
+        back.inbox_announces(MY_PERSON, obj, announce_ids)
+        if obj.id.startswith(BASE_URL):
+            PAGE_CACHE.invalidate([obj.id])
+    except (
+        ActivityGoneError,
+        ActivityNotFoundError,
+        NotAnActivityError,
+        BadActivityError,
+    ):
+        # The announced activity is deleted/gone (or most likely an OStatus notice), drop the Announce
+        log.exception(f"failed to get announce object {object_id}")
+        _drop_announces(announce_ids)
+    except Exception:
+        log.exception(f"failed to process the Announce of {object_id}")
+        attempts = batch.get("attempts", 0) + 1
+        if attempts > MAX_RETRIES:
+            log.warning(f"giving up on the Announce of {object_id}")
+            _drop_announces(announce_ids)
+            return
+
+        # Put back the Announce in the batch (merged with the ones received since) before retrying
+        countdown = int(random.uniform(2, 4) ** attempts)
+        ANNOUNCE_BATCHES.put_back(batch, attempts, countdown)
+        process_announce_batch.apply_async(args=[object_id], countdown=countdown)
+
+
+@app.task
+def flush_announce_batches() -> None:
+    """Spawn the processing of the Announce batches whose task was lost (i.e. overdue, the worker died)."""
+    for object_id in ANNOUNCE_BATCHES.overdue():
+        process_announce_batch.delay(object_id)
 
 
 @app.task(bind=True, max_retries=MAX_RETRIES)  # noqa: C901
-def fetch_og_metadata(self, iri: str) -> None:
+def fetch_og_metadata(self, iri: str, note: Optional[Dict[str, Any]] = None) -> None:
     try:
-        activity = ap.fetch_remote_activity(iri)
-        log.info(f"activity={activity!r}")
-        if activity.has_type(ap.ActivityType.CREATE):
-            note = activity.get_object()
-            links = opengraph.links_from_note(note.to_dict())
-            og_metadata = opengraph.fetch_og_metadata(USER_AGENT, links)
+        if note is None:
+            activity = ap.fetch_remote_activity(iri)
+            log.info(f"activity={activity!r}")
+            if activity.has_type(ap.ActivityType.CREATE):
+                note = activity.get_object().to_dict()
+
+        if note:
+            links = opengraph.links_from_note(note)
+            og_metadata = opengraph.fetch_og_metadata(HTTP_CLIENT, links)
             for og in og_metadata:
                 if not og.get("image"):
                     continue
-                MEDIA_CACHE.cache_og_image(og["image"])
+                try:
+                    MEDIA_CACHE.cache_og_image(og["image"])
+                except (ValueError, ResponseTooLargeError):
+                    # Not an image or too large, no retry
+                    log.exception(f"failed to cache {og['image']}")
 
             log.debug(f"OG metadata {og_metadata!r}")
             DB.activities.update_one(
@@ -260,34 +559,73 @@ def cache_actor(self, iri: str, also_cache_attachments: bool = True) -> None:
         self.retry(exc=err, countdown=int(random.uniform(2, 4) ** self.request.retries))
 
 
+@app.task
+def refresh_actor(iri: str) -> None:
+    """Fetch an actor about to expire from the cache (scheduled by the actors cache)."""
+    try:
+        back.fetch_iri(iri, no_cache=True)
+    except Exception:
+        # The actor will be fetched again once expired
+        log.exception(f"failed to refresh {iri}")
+
+
+activitypub.ACTORS_CACHE.refresh = refresh_actor.delay
+
+
 @app.task(bind=True, max_retries=MAX_RETRIES)
-def cache_attachments(self, iri: str) -> None:
+def resolve_ancestors(self, create_id: str, in_reply_to: str) -> None:
     try:
-        activity = ap.fetch_remote_activity(iri)
-        log.info(f"activity={activity!r}")
-        # Generates thumbnails for the actor's icon and the attachments if any
+        back.resolve_ancestors(create_id, in_reply_to)
+    except (ActivityGoneError, ActivityNotFoundError, NotAnActivityError):
+        log.exception(f"failed to resolve the thread of {create_id}")
+    except Exception as err:
+        log.exception(f"failed to resolve the thread of {create_id}")
+        self.retry(exc=err, countdown=int(random.uniform(2, 4) ** self.request.retries))
+
+
+back.set_resolve_ancestors(resolve_ancestors.delay)
 
-        actor = activity.get_actor()
+
+@app.task(bind=True, max_retries=MAX_RETRIES)
+def cache_attachments(
+    self,
+    iri: str,
+    actor: Optional[Dict[str, Any]] = None,
+    note: Optional[Dict[str, Any]] = None,
+) -> None:
+    try:
+        if actor is None:
+            activity = ap.fetch_remote_activity(iri)
+            log.info(f"activity={activity!r}")
+            actor = activity.get_actor().to_dict(embed=True)
+            if activity.has_type(ap.ActivityType.CREATE):
+                note = activity.get_object().to_dict()
+
+        # Generates thumbnails for the actor's icon and the attachments if any
 
         # Update the cached actor
         DB.actors.update_one(
-            {"remote_id": iri},
-            {"$set": {"remote_id": iri, "data": actor.to_dict(embed=True)}},
+            {"remote_id": actor["id"]},
+            {"$set": {"remote_id": actor["id"], "data": actor}},
             upsert=True,
         )
 
-        if actor.icon:
-            MEDIA_CACHE.cache(actor.icon["url"], Kind.ACTOR_ICON)
+        if actor.get("icon"):
+            try:
+                MEDIA_CACHE.cache(actor["icon"]["url"], Kind.ACTOR_ICON)
+            except (ValueError, ResponseTooLargeError):
+                log.exception(f"failed to cache {actor['icon']}")
 
-        if activity.has_type(ap.ActivityType.CREATE):
-            for attachment in activity.get_object()._data.get("attachment", []):
+        if note:
+            for attachment in note.get("attachment", []):
                 if (
                     attachment.get("mediaType", "").startswith("image/")
                     or attachment.get("type") == ap.ActivityType.IMAGE.value
                 ):
                     try:
                         MEDIA_CACHE.cache(attachment["url"], Kind.ATTACHMENT)
-                    except ValueError:
+                    except (ValueError, ResponseTooLargeError):
+                        # Not an image or larger than MAX_MEDIA_SIZE, no retry
                         log.exception(f"failed to cache {attachment}")
 
         log.info(f"attachments cached for {iri}")
@@ -299,83 +637,260 @@ def cache_attachments(self, iri: str) -> None:
         self.retry(exc=err, countdown=int(random.uniform(2, 4) ** self.request.retries))
 
 
+def get_deleted_actor(data: Dict[str, Any]) -> Optional[str]:
+    """Returns the actor ID if the activity is the deletion of its own actor (i.e. an account deletion)."""
+    if data.get("type") != ap.ActivityType.DELETE.value:
+        return None
+
+    actor_id = data.get("actor")
+    obj = data.get("object")
+    if isinstance(obj, dict):
+        obj = obj.get("id")
+    if not isinstance(actor_id, str) or obj != actor_id:
+        return None
+
+    return actor_id
+
+
+def is_unknown_actor_delete(data: Dict[str, Any]) -> bool:
+    """Returns True for the deletion of an actor that never interacted with us (sent to every known instance)."""
+    actor_id = get_deleted_actor(data)
+    if not actor_id:
+        return False
+    return not back.is_known_actor(actor_id)
+
+
+def schedule_actor_deletion(actor_id: str) -> None:
+    """Record the deletion of a known actor, the cleanup is done in batch by `process_actor_deletions`."""
+    try:
+        DB.actor_deletions.update_one(
+            {"actor_id": actor_id},
+            {
+                "$setOnInsert": {
+                    "actor_id": actor_id,
+                    "received_at": datetime.utcnow(),
+                    "attempts": 0,
+                }
+            },
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        pass
+
+
+def post_raw_to_inbox(
+    method: str, path: str, headers: Any, body: bytes, verified: bool = False
+) -> bool:
+    """Verify a raw inbox request (using HTTP signatures or by fetching the activity) and post it to the inbox.
+
+    `verified` is set when the signature was already verified (with `KEY_STORE.verify_cached`). Returns False if the
+    request cannot be verified.
+    """
+    data = parse_body(body)
+    if not data:
+        return False
+
+    # Account deletions cannot be verified (the key is gone), the deletion is confirmed later by fetching the actor
+    actor_id = get_deleted_actor(data)
+    if actor_id:
+        if back.is_known_actor(actor_id):
+            log.info(f"received a Delete for actor {actor_id}")
+            schedule_actor_deletion(actor_id)
+        else:
+            log.info(f"dropping Delete for unknown actor {actor_id}")
+        return True
+
+    try:
+        if not verified and not KEY_STORE.verify_request(method, path, headers, body):
+            raise Exception("failed to verify request")
+    except Exception:
+        log.exception(
+            "failed to verify request, trying to verify the payload by fetching the remote"
+        )
+        try:
+            data = back.fetch_iri(data["id"])
+        except Exception:
+            log.exception(f'failed to fetch remote id at {data["id"]}')
+            return False
+
+    activity = ap.parse_activity(data)
+    log.debug(f"inbox activity={activity}/{data}")
+    post_to_inbox(activity)
+    return True
+
+
+def enqueue_inbox_request(
+    method: str, path: str, headers: Any, body: bytes, verified: bool = False
+) -> None:
+    """Store the raw inbox request in the intake queue, it will be verified (unless `verified` is set) and processed
+    by a worker."""
+    intake_id = INBOX_INTAKE.enqueue(method, path, headers, body, verified)
+    try:
+        process_inbox_intake.apply_async(
+            args=[intake_id], queue=inbox_queue(request_actor(headers))
+        )
+    except Exception:
+        # The request will be picked up by `requeue_inbox_intake`
+        log.exception(f"failed to spawn the task for intake {intake_id}")
+
+
+def _post_intake_to_inbox(doc: Dict[str, Any]) -> bool:
+    return post_raw_to_inbox(
+        doc["method"],
+        doc["path"],
+        CaseInsensitiveDict(doc["headers"]),
+        doc["body"],
+        doc.get("verified", False),
+    )
+
+
+@app.task
+def process_inbox_intake(intake_id: str) -> None:
+    """Process an intake request, failed requests are retried by `requeue_inbox_intake` (with a backoff)."""
+    INBOX_INTAKE.process(ObjectId(intake_id), _post_intake_to_inbox)
+
+
+@app.task
+def requeue_inbox_intake() -> None:
+    """Spawn the processing of the intake requests that are due for a retry, that were never picked up (or whose
+    worker died)."""
+    for doc in INBOX_INTAKE.due():
+        process_inbox_intake.apply_async(
+            args=[str(doc["_id"])],
+            queue=inbox_queue(request_actor(CaseInsensitiveDict(doc["headers"]))),
+        )
+
+
+ACTOR_DELETIONS_BATCH_SIZE = 100
+ACTOR_DELETION_MAX_ATTEMPTS = 5
+
+
+@app.task
+def process_actor_deletions() -> None:
+    """Confirm the pending actor deletions (the actor must be gone) and cleanup the deleted actors in batch."""
+    gone = []
+    alive = []
+    failed = []
+    for doc in (
+        DB.actor_deletions.find()
+        .sort("received_at", 1)
+        .limit(ACTOR_DELETIONS_BATCH_SIZE)
+    ):
+        actor_id = doc["actor_id"]
+        try:
+            back.fetch_iri(actor_id, no_cache=True)
+            alive.append(actor_id)
+        except (ActivityGoneError, ActivityNotFoundError):
+            gone.append(actor_id)
+        except Exception:
+            log.exception(f"failed to check if {actor_id} is deleted")
+            failed.append(actor_id)
+
+    if alive:
+        log.warning(f"ignoring Delete for actors still available: {alive}")
+        DB.actor_deletions.delete_many({"actor_id": {"$in": alive}})
+
+    if failed:
+        DB.actor_deletions.update_many(
+            {"actor_id": {"$in": failed}}, {"$inc": {"attempts": 1}}
+        )
+        DB.actor_deletions.delete_many(
+            {"attempts": {"$gte": ACTOR_DELETION_MAX_ATTEMPTS}}
+        )
+
+    if gone:
+        log.info(f"cleaning up deleted actors: {gone}")
+        back.delete_actors(gone)
+        DB.actor_deletions.delete_many({"actor_id": {"$in": gone}})
+        PAGE_CACHE.invalidate()
+
+
+def is_blocked_request(headers: Any, data: Optional[Dict[str, Any]] = None) -> bool:
+    """Check the keyId of the HTTP signature (and the actor of the activity, if already decoded) against the
+    blocklist, without parsing the activity."""
+    if BLOCKLIST.is_blocked(request_actor(headers)):
+        return True
+
+    if data and isinstance(data.get("actor"), str):
+        return BLOCKLIST.is_blocked(data["actor"])
+
+    return False
+
+
+def request_host(headers: Any) -> Optional[str]:
+    """Returns the instance that sent the request (using the keyId of the HTTP signature)."""
+    hsig = _parse_sig_header(headers.get("Signature"))
+    if not hsig or not hsig.get("keyId"):
+        return None
+
+    return urlparse(hsig["keyId"]).hostname
+
+
+def request_actor(headers: Any) -> Optional[str]:
+    """Returns the actor that signed the request (the keyId of the HTTP signature without the fragment)."""
+    hsig = _parse_sig_header(headers.get("Signature"))
+    if not hsig or not hsig.get("keyId"):
+        return None
+
+    return hsig["keyId"].split("#")[0]
+
+
+def inbox_queue(actor_id: Optional[str]) -> Optional[str]:
+    """Returns the queue processing the inbox activities of the actor (None for the `inbox` queue)."""
+    if not INBOX_RING or not actor_id:
+        return None
+
+    return INBOX_RING.get_node(actor_id)
+
+
+def delivery_queue(host: Optional[str]) -> Optional[str]:
+    """Returns the queue of the deliveries to the host (None for the `delivery` queue)."""
+    if not DELIVERY_RING or not host:
+        return None
+
+    return DELIVERY_RING.get_node(host)
+
+
 def post_to_inbox(activity: ap.BaseActivity) -> None:
     # Check for Block activity
-    actor = activity.get_actor()
-    if back.outbox_is_blocked(MY_PERSON, actor.id):
+    actor_id = activity._data.get("actor")
+    if isinstance(actor_id, dict):
+        actor_id = actor_id.get("id")
+    if back.outbox_is_blocked(MY_PERSON, actor_id):
         log.info(
-            f"actor {actor!r} is blocked, dropping the received activity {activity!r}"
+            f"actor {actor_id} is blocked, dropping the received activity {activity!r}"
         )
         return
 
-    if back.inbox_check_duplicate(MY_PERSON, activity.id):
+    try:
+        back.save(Box.INBOX, activity)
+    except DuplicateKeyError:
         # The activity is already in the inbox
         log.info(f"received duplicate activity {activity!r}, dropping it")
-
-    back.save(Box.INBOX, activity)
-    process_new_activity.delay(activity.id)
+        return
 
     log.info(f"spawning task for {activity!r}")
-    finish_post_to_inbox.delay(activity.id)
+    process_inbox.apply_async(args=[activity.id], queue=inbox_queue(actor_id))
 
 
-def invalidate_cache(activity):
-    if activity.has_type(ap.ActivityType.LIKE):
-        if activity.get_object().id.startswith(BASE_URL):
-            DB.cache2.remove()
-    elif activity.has_type(ap.ActivityType.ANNOUNCE):
-        if activity.get_object().id.startswith(BASE_URL):
-            DB.cache2.remove()
-    elif activity.has_type(ap.ActivityType.UNDO):
-        DB.cache2.remove()
-    elif activity.has_type(ap.ActivityType.DELETE):
-        # TODO(tsileo): only invalidate if it's a delete of a reply
-        DB.cache2.remove()
-    elif activity.has_type(ap.ActivityType.UPDATE):
-        DB.cache2.remove()
-    elif activity.has_type(ap.ActivityType.CREATE):
-        note = activity.get_object()
-        if not note.inReplyTo or note.inReplyTo.startswith(ID):
-            DB.cache2.remove()
-        # FIXME(tsileo): check if it's a reply of a reply
+def _note_deps(object_id: str) -> List[str]:
+    """Returns the note and its parent (for the replies counter), if the note is known."""
+    doc = DB.activities.find_one(
+        {"activity.object.id": object_id, "type": ap.ActivityType.CREATE.value},
+        projection=["activity.object.inReplyTo"],
+    )
+    if not doc:
+        return []
+    return [object_id, doc["activity"]["object"].get("inReplyTo")]
 
-@app.task(bind=True, max_retries=MAX_RETRIES)  # noqa: C901
-def finish_post_to_inbox(self, iri: str) -> None:
-    try:
-        activity = ap.fetch_remote_activity(iri)
-        log.info(f"activity={activity!r}")
 
-        if activity.has_type(ap.ActivityType.DELETE):
-            back.inbox_delete(MY_PERSON, activity)
-        elif activity.has_type(ap.ActivityType.UPDATE):
-            back.inbox_update(MY_PERSON, activity)
-        elif activity.has_type(ap.ActivityType.CREATE):
-            back.inbox_create(MY_PERSON, activity)
-        elif activity.has_type(ap.ActivityType.ANNOUNCE):
-            back.inbox_announce(MY_PERSON, activity)
-        elif activity.has_type(ap.ActivityType.LIKE):
-            back.inbox_like(MY_PERSON, activity)
-        elif activity.has_type(ap.ActivityType.FOLLOW):
-            # Reply to a Follow with an Accept
-            accept = ap.Accept(actor=ID, object=activity.to_dict(embed=True))
-            post_to_outbox(accept)
-        elif activity.has_type(ap.ActivityType.UNDO):
-            obj = activity.get_object()
-            if obj.has_type(ap.ActivityType.LIKE):
-                back.inbox_undo_like(MY_PERSON, obj)
-            elif obj.has_type(ap.ActivityType.ANNOUNCE):
-                back.inbox_undo_announce(MY_PERSON, obj)
-            elif obj.has_type(ap.ActivityType.FOLLOW):
-                back.undo_new_follower(MY_PERSON, obj)
-        try:
-            invalidate_cache(activity)
-        except Exception:
-            log.exception("failed to invalidate cache")
-    except (ActivityGoneError, ActivityNotFoundError, NotAnActivityError):
-        log.exception(f"no retry")
-    except Exception as err:
-        log.exception(f"failed to cache attachments for {iri}")
-        self.retry(exc=err, countdown=int(random.uniform(2, 4) ** self.request.retries))
+def cache_deps(activity: ap.BaseActivity, box: Box) -> List[str]:
+    """Returns the dependencies of the cached pages changed by an activity (see `utils.cachedeps`)."""
+    return activity_deps(activity, box == Box.OUTBOX, BASE_URL, _note_deps)
+
+
+def invalidate_cache(activity: ap.BaseActivity, box: Box = Box.INBOX) -> None:
+    PAGE_CACHE.invalidate(cache_deps(activity, box))
 
 
 def post_to_outbox(activity: ap.BaseActivity) -> str:
@@ -398,7 +913,7 @@ def finish_post_to_outbox(self, iri: str) -> None:
         activity = ap.fetch_remote_activity(iri)
         log.info(f"activity={activity!r}")
 
-        recipients = activity.recipients()
+        recipients = outbox_recipients(activity)
 
         if activity.has_type(ap.ActivityType.DELETE):
             back.outbox_delete(MY_PERSON, activity)
@@ -410,6 +925,11 @@ def finish_post_to_outbox(self, iri: str) -> None:
             back.outbox_announce(MY_PERSON, activity)
         elif activity.has_type(ap.ActivityType.LIKE):
             back.outbox_like(MY_PERSON, activity)
+        elif activity.has_type(ap.ActivityType.ACCEPT):
+            back.new_follower(MY_PERSON, activity.get_object())
+        elif activity.has_type(ap.ActivityType.BLOCK):
+            # Every process reloads the blocked actors
+            BLOCKLIST.invalidate()
         elif activity.has_type(ap.ActivityType.UNDO):
             obj = activity.get_object()
             if obj.has_type(ap.ActivityType.LIKE):
@@ -418,16 +938,19 @@ def finish_post_to_outbox(self, iri: str) -> None:
                 back.outbox_undo_announce(MY_PERSON, obj)
             elif obj.has_type(ap.ActivityType.FOLLOW):
                 back.undo_new_following(MY_PERSON, obj)
+            elif obj.has_type(ap.ActivityType.BLOCK):
+                back.outbox_undo_block(MY_PERSON, obj)
+
+        invalidate_cache(activity, Box.OUTBOX)
 
         log.info(f"recipients={recipients}")
         activity = ap.clean_activity(activity.to_dict())
 
-        DB.cache2.remove()
+        if not recipients:
+            return
 
-        payload = json.dumps(activity)
-        for recp in recipients:
-            log.debug(f"posting to {recp}")
-            post_to_remote_inbox.delay(payload, recp)
+        log.debug(f"posting to {recipients}")
+        enqueue_deliveries(save_payload(activity), activity["id"], recipients)
     except (ActivityGoneError, ActivityNotFoundError):
         log.exception(f"no retry")
     except Exception as err:
@@ -435,50 +958,220 @@ def finish_post_to_outbox(self, iri: str) -> None:
         self.retry(exc=err, countdown=int(random.uniform(2, 4) ** self.request.retries))
 
 
+def outbox_recipients(activity: ap.BaseActivity) -> List[str]:
+    """Resolve the inboxes of an outbox activity, our followers are read from the `recipients` collection instead
+    of resolving the followers collection (and each follower actor)."""
+    followers = ID + "/followers"
+    addressed = activity._recipients()
+    if followers not in addressed:
+        return activity.recipients()
+
+    recipients = resolve_inboxes(
+        addressed,
+        back.fetch_iri,
+        back.parse_collection,
+        ignored=[followers, ID, ap.AS_PUBLIC],
+    )
+    for recp in back.followers_as_recipients():
+        if recp not in recipients:
+            recipients.append(recp)
+
+    return recipients
+
+
 @app.task(bind=True, max_retries=MAX_RETRIES)  # noqa:C901
 def forward_activity(self, iri: str) -> None:
     try:
         activity = ap.fetch_remote_activity(iri)
         recipients = back.followers_as_recipients()
         log.debug(f"Forwarding {activity!r} to {recipients}")
-        activity = ap.clean_activity(activity.to_dict())
-        payload = json.dumps(activity)
-        for recp in recipients:
-            log.debug(f"forwarding {activity!r} to {recp}")
-            post_to_remote_inbox.delay(payload, recp)
+        if not recipients:
+            return
+
+        log.debug(f"forwarding {activity!r} to {recipients}")
+        enqueue_deliveries(
+            save_payload(ap.clean_activity(activity.to_dict())), activity.id, recipients
+        )
     except Exception as err:
         log.exception(f"failed to cache attachments for {iri}")
         self.retry(exc=err, countdown=int(random.uniform(2, 4) ** self.request.retries))
 
 
-@app.task(bind=True, max_retries=MAX_RETRIES)
-def post_to_remote_inbox(self, payload: str, to: str) -> None:
-    try:
-        log.info("payload=%s", payload)
-        log.info("generating sig")
-        signed_payload = json.loads(payload)
+def save_payload(activity: Dict[str, Any]) -> str:
+    """Sign and serialize the activity once, the payload is then referenced by all the deliveries."""
 
+    def serialize() -> bytes:
         # Don't overwrite the signature if we're forwarding an activity
-        if "signature" not in signed_payload:
-            generate_signature(signed_payload, KEY)
+        if "signature" not in activity:
+            generate_signature(activity, KEY)
+        return json.dumps(activity).encode("utf-8")
+
+    return str(LEDGER.save_payload(activity["id"], serialize, _body_digest))
+
+
+def enqueue_deliveries(
+    payload_id: str, activity_id: str, recipients: List[str]
+) -> None:
+    """Record the deliveries in the ledger, and spawn a delivery task for each recipient (or let the async delivery
+    worker pick them).
+
+    Enqueuing the deliveries of a payload again (i.e. the task is retried) only spawns the deliveries not spawned yet.
+    """
+    for doc in LEDGER.enqueue(
+        ObjectId(payload_id), activity_id, recipients, delivery_queue, ASYNC_DELIVERY
+    ):
+        post_to_remote_inbox.apply_async(args=[str(doc["_id"])], queue=doc["queue"])
+        LEDGER.spawned(doc["_id"])
+
+
+def record_delivery_attempt(
+    delivery_id: ObjectId,
+    status: DeliveryStatus,
+    status_code: int,
+    duration: float,
+    error: Optional[str] = None,
+) -> None:
+    now = datetime.utcnow()
+    attempt = {"at": now, "status_code": status_code, "duration": duration}
+    if error:
+        attempt["error"] = error
+    DB.deliveries.update_one(
+        {"_id": delivery_id},
+        {
+            "$set": {
+                "status": status.value,
+                "status_code": status_code,
+                "duration": duration,
+                "last_attempt_at": now,
+            },
+            "$inc": {"attempts": 1, "total_duration": duration},
+            "$push": {"history": {"$each": [attempt], "$slice": -(MAX_RETRIES + 1)}},
+        },
+    )
+
+
+@app.task(bind=True, max_retries=MAX_RETRIES)
+def post_to_remote_inbox(self, delivery_id: str) -> None:
+    delivery = DB.deliveries.find_one({"_id": ObjectId(delivery_id)})
+    if not delivery:
+        log.warning(f"delivery {delivery_id} not found")
+        return
+
+    if delivery["status"] in [DeliveryStatus.DONE.value, DeliveryStatus.FAILED.value]:
+        log.info(f"delivery {delivery_id} already {delivery['status']}")
+        return
 
-        log.info("to=%s", to)
-        resp = requests.post(
+    to = delivery["to"]
+    host = delivery["host"]
+    if not DELIVERY_BREAKER.allow(host):
+        log.info(f"{host} is down, parking the delivery to {to}")
+        DB.deliveries.update_one(
+            {"_id": delivery["_id"]},
+            {"$set": {"status": DeliveryStatus.PARKED.value}},
+        )
+        return
+
+    payload = DB.payloads.find_one({"_id": delivery["payload_id"]})
+    if not payload:
+        log.warning(
+            f"payload {delivery['payload_id']} not found, dropping delivery to {to}"
+        )
+        record_delivery_attempt(delivery["_id"], DeliveryStatus.FAILED, 0, 0)
+        return
+
+    # The delivery is failed once the retries are exhausted
+    retry_status = DeliveryStatus.PENDING
+    if self.request.retries >= self.max_retries:
+        retry_status = DeliveryStatus.FAILED
+
+    start = time.monotonic()
+    try:
+        resp = HTTP_CLIENT.post(
             to,
-            data=json.dumps(signed_payload),
-            auth=SigAuth,
-            headers={
-                "Content-Type": HEADERS[1],
-                "Accept": HEADERS[1],
-                "User-Agent": USER_AGENT,
-            },
+            data=payload["body"],
+            auth=HTTPSigDigestAuth(KEY, payload["digest"]),
+            headers={"Content-Type": HEADERS[1], "Accept": HEADERS[1]},
         )
-        log.info("resp=%s", resp)
-        log.info("resp_body=%s", resp.text)
         resp.raise_for_status()
     except HTTPError as err:
-        log.exception("request failed")
-        if 400 >= err.response.status_code >= 499:
+        code = err.response.status_code
+        log.info(f"delivery to {to} failed with {code}")
+        if 400 <= code < 500 and code != 429:
             log.info("client error, no retry")
+            record_delivery_attempt(
+                delivery["_id"], DeliveryStatus.FAILED, code, time.monotonic() - start
+            )
+            record_delivery_success(host)
             return
+        if code >= 500:
+            DELIVERY_BREAKER.record_failure(host)
+        record_delivery_attempt(
+            delivery["_id"], retry_status, code, time.monotonic() - start
+        )
+        self.retry(exc=err, countdown=int(random.uniform(2, 4) ** self.request.retries))
+    except requests.RequestException as err:
+        log.exception(f"delivery to {to} failed")
+        DELIVERY_BREAKER.record_failure(host)
+        record_delivery_attempt(
+            delivery["_id"], retry_status, 0, time.monotonic() - start, repr(err)
+        )
         self.retry(exc=err, countdown=int(random.uniform(2, 4) ** self.request.retries))
+    else:
+        duration = time.monotonic() - start
+        log.info(f"delivered to {to} ({resp.status_code}) in {duration:.3f}s")
+        record_delivery_attempt(
+            delivery["_id"], DeliveryStatus.DONE, resp.status_code, duration
+        )
+        record_delivery_success(host)
+
+
+def record_delivery_success(host: str) -> None:
+    if DELIVERY_BREAKER.record_success(host):
+        replay_parked_deliveries.delay(host)
+
+
+@app.task
+def replay_parked_deliveries(host: str) -> None:
+    q = {"host": host, "status": DeliveryStatus.PARKED.value}
+    if ASYNC_DELIVERY:
+        DB.deliveries.update_many(
+            q,
+            {
+                "$set": {
+                    "status": DeliveryStatus.PENDING.value,
+                    "next_attempt_at": datetime.utcnow(),
+                }
+            },
+        )
+        return
+
+    for doc in DB.deliveries.find(q, projection=["_id"]):
+        DB.deliveries.update_one(
+            {"_id": doc["_id"]}, {"$set": {"status": DeliveryStatus.PENDING.value}}
+        )
+        post_to_remote_inbox.apply_async(
+            args=[str(doc["_id"])], queue=delivery_queue(host)
+        )
+
+
+@app.task
+def probe_open_circuits() -> None:
+    """Release a single parked delivery for each instance due for a probe (the circuit is closed if it succeeds), so
+    the parked deliveries are replayed even if nothing new is sent to the instance."""
+    for host in DELIVERY_BREAKER.probes_due():
+        update: Dict[str, Any] = {"status": DeliveryStatus.PENDING.value}
+        if ASYNC_DELIVERY:
+            update["next_attempt_at"] = datetime.utcnow()
+        doc = DB.deliveries.find_one_and_update(
+            {"host": host, "status": DeliveryStatus.PARKED.value},
+            {"$set": update},
+            projection=["_id"],
+        )
+        if not doc:
+            continue
+
+        log.info(f"probing {host}")
+        if not ASYNC_DELIVERY:
+            post_to_remote_inbox.apply_async(
+                args=[str(doc["_id"])], queue=delivery_queue(host)
+            )
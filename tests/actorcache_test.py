@@ -0,0 +1,109 @@
+from datetime import datetime
+from datetime import timedelta
+
+from utils.actorcache import ActorCache
+
+IRI = "https://remote.example/users/alice"
+ACTOR = {"id": IRI, "type": "Person", "inbox": IRI + "/inbox"}
+
+
+def _age(col, cache, iri, age):
+    """Move the fetch time of the cached actor `age` in the past (and drop it from the L1 cache)."""
+    col.update_one(
+        {"remote_id": iri}, {"$set": {"fetched_at": datetime.utcnow() - age}}
+    )
+    cache.pop(iri)
+
+
+def test_get_set(col):
+    cache = ActorCache(col)
+    assert cache.get(IRI) is None
+
+    cache.set(IRI, ACTOR)
+    assert cache.get(IRI) == ACTOR
+
+    # Served by L2 in another process
+    assert ActorCache(col).get(IRI) == ACTOR
+
+
+def test_served_from_l1(col):
+    cache = ActorCache(col)
+    cache.set(IRI, ACTOR)
+    col.delete_many({})
+    assert cache.get(IRI) == ACTOR
+
+
+def test_hits_are_written_by_batch(col):
+    ActorCache(col).set(IRI, ACTOR)
+    hits = col.find_one({"remote_id": IRI})["hits"]
+
+    cache = ActorCache(col, hits_flush_interval=3600)
+    for _ in range(3):
+        assert cache.get(IRI) == ACTOR
+        cache.pop(IRI)
+    assert col.find_one({"remote_id": IRI})["hits"] == hits
+
+    cache.hits_flush_interval = 0
+    assert cache.get(IRI) == ACTOR
+    assert col.find_one({"remote_id": IRI})["hits"] == hits + 4
+
+
+def test_misses_are_remembered(col):
+    cache = ActorCache(col, miss_ttl=3600)
+    assert cache.get(IRI) is None
+
+    # Cached by another process, not read again before the miss expires
+    ActorCache(col).set(IRI, ACTOR)
+    assert cache.get(IRI) is None
+
+    cache.set(IRI, ACTOR)
+    assert cache.get(IRI) == ACTOR
+
+
+def test_expired(col):
+    cache = ActorCache(col, ttl=3600)
+    cache.set(IRI, ACTOR)
+    _age(col, cache, IRI, timedelta(hours=2))
+    assert cache.get(IRI) is None
+    # Still available for revalidation
+    assert cache.get_validators(IRI) is None
+    cache.set(IRI, ACTOR, {"ETag": "abc"})
+    _age(col, cache, IRI, timedelta(hours=2))
+    assert cache.get_validators(IRI) == ({"ETag": "abc"}, ACTOR)
+
+
+def test_refresh_ahead_once(col):
+    refreshed = []
+    cache = ActorCache(col, ttl=3600)
+    cache.refresh = refreshed.append
+    other = ActorCache(col, ttl=3600)
+    other.refresh = refreshed.append
+
+    cache.set(IRI, ACTOR)
+    assert cache.get(IRI) == ACTOR
+    assert refreshed == []
+
+    # Stale but not expired, still served while it's refreshed (by a single process)
+    _age(col, cache, IRI, timedelta(minutes=50))
+    for _ in range(3):
+        assert cache.get(IRI) == ACTOR
+        assert other.get(IRI) == ACTOR
+    assert refreshed == [IRI]
+
+    # The refresh is done
+    cache.set(IRI, ACTOR)
+    assert cache.get(IRI) == ACTOR
+    assert refreshed == [IRI]
+
+
+def test_warm(col):
+    other = IRI.replace("alice", "bob")
+    ActorCache(col).set(IRI, ACTOR)
+    ActorCache(col).set(other, {**ACTOR, "id": other})
+    # The most referenced actor is loaded first
+    cache = ActorCache(col, maxsize=1, hits_flush_interval=0)
+    cache.get(other)
+    cache = ActorCache(col, maxsize=1)
+    assert cache.warm() == 1
+    col.delete_many({})
+    assert cache.get(other)["id"] == other
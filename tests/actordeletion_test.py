@@ -0,0 +1,132 @@
+from utils.actordeletion import delete_actors_activities
+
+ALICE = "https://remote.example/users/alice"
+BOB = "https://remote.example/users/bob"
+NOTE = "https://me.example/outbox/1/activity"
+OTHER_NOTE = "https://me.example/outbox/2/activity"
+REMOTE_NOTE = "https://remote.example/notes/1"
+
+
+def _insert(col, box, type_, actor, obj, meta=None, remote_id=None):
+    doc = {
+        "box": box,
+        "type": [type_],
+        "remote_id": remote_id or f"{actor}/{type_.lower()}/{col.count_documents({})}",
+        "activity": {"type": type_, "actor": actor, "object": obj},
+        "meta": {"undo": False, "deleted": False, **(meta or {})},
+    }
+    col.insert_one(doc)
+    return doc["remote_id"]
+
+
+def _note(col, note_id, count_like=0, count_boost=0, count_reply=0):
+    _insert(
+        col,
+        "outbox",
+        "Create",
+        "https://me.example",
+        {"id": note_id, "type": "Note"},
+        meta={
+            "count_like": count_like,
+            "count_boost": count_boost,
+            "count_reply": count_reply,
+            "count_direct_reply": count_reply,
+        },
+        remote_id=note_id.replace("/activity", ""),
+    )
+
+
+def _meta(col, remote_id):
+    return col.find_one({"remote_id": remote_id})["meta"]
+
+
+def _note_meta(col, note_id):
+    return col.find_one({"activity.object.id": note_id, "box": "outbox"})["meta"]
+
+
+def test_counters(col):
+    _note(col, NOTE, count_like=2, count_boost=2, count_reply=2)
+    _note(col, OTHER_NOTE, count_like=1)
+
+    _insert(col, "inbox", "Like", ALICE, NOTE)
+    _insert(col, "inbox", "Like", ALICE, OTHER_NOTE)
+    _insert(col, "inbox", "Like", BOB, NOTE)
+    _insert(col, "inbox", "Announce", ALICE, NOTE, meta={"object": {"id": NOTE}})
+    _insert(col, "inbox", "Announce", BOB, NOTE, meta={"object": {"id": NOTE}})
+    _insert(col, "inbox", "Create", ALICE, {"id": REMOTE_NOTE, "inReplyTo": NOTE})
+    _insert(
+        col,
+        "inbox",
+        "Create",
+        BOB,
+        {"id": "https://remote.example/notes/2", "inReplyTo": NOTE},
+    )
+
+    delete_actors_activities(col, [ALICE])
+
+    assert _note_meta(col, NOTE)["count_like"] == 1
+    assert _note_meta(col, NOTE)["count_boost"] == 1
+    assert _note_meta(col, NOTE)["count_reply"] == 1
+    assert _note_meta(col, NOTE)["count_direct_reply"] == 1
+    assert _note_meta(col, OTHER_NOTE)["count_like"] == 0
+
+
+def test_undone_and_pending_activities_are_not_counted(col):
+    _note(col, NOTE, count_like=1, count_boost=0, count_reply=0)
+
+    # Already undone
+    _insert(col, "inbox", "Like", ALICE, NOTE, meta={"undo": True})
+    _insert(col, "inbox", "Like", ALICE, NOTE)
+    # The batch of the Announce is not processed yet
+    _insert(col, "inbox", "Announce", ALICE, NOTE)
+    # Already deleted
+    _insert(
+        col,
+        "inbox",
+        "Create",
+        ALICE,
+        {"id": REMOTE_NOTE, "inReplyTo": NOTE},
+        meta={"deleted": True},
+    )
+
+    delete_actors_activities(col, [ALICE])
+
+    meta = _note_meta(col, NOTE)
+    assert meta["count_like"] == 0
+    assert meta["count_boost"] == 0
+    assert meta["count_reply"] == 0
+
+
+def test_remaining_activities(col):
+    _note(col, NOTE)
+    create = _insert(col, "inbox", "Create", ALICE, {"id": REMOTE_NOTE})
+    like = _insert(col, "inbox", "Like", ALICE, NOTE)
+    follow = _insert(col, "inbox", "Follow", ALICE, "https://me.example")
+    following = _insert(col, "outbox", "Follow", "https://me.example", ALICE)
+    bob_like = _insert(col, "inbox", "Like", BOB, NOTE)
+    bob_following = _insert(col, "outbox", "Follow", "https://me.example", BOB)
+
+    delete_actors_activities(col, [ALICE])
+
+    assert _meta(col, create)["deleted"] is True
+    for remote_id in [like, follow, following]:
+        assert _meta(col, remote_id)["undo"] is True
+        assert _meta(col, remote_id)["extra"] == "actor deleted"
+
+    # The activities of the other actors are untouched
+    for remote_id in [bob_like, bob_following]:
+        assert _meta(col, remote_id) == {"undo": False, "deleted": False}
+    assert _note_meta(col, NOTE)["deleted"] is False
+
+
+def test_batch(col):
+    _note(col, NOTE, count_like=3)
+    _insert(col, "inbox", "Like", ALICE, NOTE)
+    _insert(col, "inbox", "Like", BOB, NOTE)
+    carol_like = _insert(col, "inbox", "Like", "https://remote.example/users/c", NOTE)
+
+    delete_actors_activities(col, [ALICE, BOB])
+
+    assert _note_meta(col, NOTE)["count_like"] == 1
+    assert _meta(col, carol_like)["undo"] is False
+    assert col.count_documents({"meta.undo": True}) == 2
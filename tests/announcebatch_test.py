@@ -0,0 +1,90 @@
+from datetime import datetime
+from datetime import timedelta
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+from utils.announcebatch import AnnounceBatches
+
+OBJECT = "https://remote.example/notes/1"
+
+
+@pytest.fixture
+def col(col):
+    col.create_index("object_id", unique=True)
+    return col
+
+
+def test_coalesced(col):
+    batches = AnnounceBatches(col, window=10)
+    assert batches.add(OBJECT, "https://a.example/announce/1")
+    assert not batches.add(OBJECT, "https://b.example/announce/1")
+    assert not batches.add(OBJECT, "https://b.example/announce/1")
+    assert batches.add("https://remote.example/notes/2", "https://a.example/announce/2")
+
+    batch = batches.take(OBJECT)
+    assert batch["activities"] == [
+        "https://a.example/announce/1",
+        "https://b.example/announce/1",
+    ]
+    assert batch["attempts"] == 0
+    assert batches.take(OBJECT) is None
+
+    # A new batch is started once the previous one is taken
+    assert batches.add(OBJECT, "https://c.example/announce/1")
+
+
+def test_put_back(col):
+    batches = AnnounceBatches(col, window=10)
+    batches.add(OBJECT, "https://a.example/announce/1")
+    batch = batches.take(OBJECT)
+
+    # Received while the batch was processed
+    assert batches.add(OBJECT, "https://b.example/announce/1")
+    batches.put_back(batch, attempts=1, delay=60)
+
+    batch = batches.take(OBJECT)
+    assert sorted(batch["activities"]) == [
+        "https://a.example/announce/1",
+        "https://b.example/announce/1",
+    ]
+    assert batch["attempts"] == 1
+    assert batch["scheduled_at"] > datetime.utcnow() + timedelta(seconds=50)
+
+
+def test_overdue(col):
+    batches = AnnounceBatches(col, window=10)
+    batches.add(OBJECT, "https://a.example/announce/1")
+    assert batches.overdue() == []
+
+    col.update_one(
+        {"object_id": OBJECT},
+        {"$set": {"scheduled_at": datetime.utcnow() - timedelta(minutes=10)}},
+    )
+    assert batches.overdue() == [OBJECT]
+    # Scheduled again
+    assert batches.overdue() == []
+
+
+class RacingCollection(object):
+    """Collection where a concurrent worker creates the batch right before the first upsert."""
+
+    def __init__(self, col):
+        self.col = col
+        self.raced = False
+
+    def update_one(self, q, update, upsert=False):
+        if upsert and not self.raced:
+            self.raced = True
+            self.col.update_one(q, update, upsert=True)
+            raise DuplicateKeyError("E11000 duplicate key error")
+        return self.col.update_one(q, update, upsert=upsert)
+
+
+def test_concurrent_add(col):
+    batches = AnnounceBatches(col, window=10)
+    batches.col = RacingCollection(col)
+    assert not batches.add(OBJECT, "https://a.example/announce/1")
+    assert col.find_one({"object_id": OBJECT})["activities"] == [
+        "https://a.example/announce/1"
+    ]
@@ -0,0 +1,98 @@
+import pytest
+
+from utils import blocklist
+from utils.blocklist import Blocklist
+
+ALICE = "https://remote.example/users/alice"
+BOB = "https://other.example/users/bob"
+
+
+class Loader(object):
+    """Loads the blocked actors from the collection, and counts the loads."""
+
+    def __init__(self, col):
+        self.col = col
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return [doc["actor_id"] for doc in self.col.find()]
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(blocklist.time, "monotonic", clock)
+    return clock
+
+
+def _blocklist(db, **kwargs):
+    loader = Loader(db.blocks)
+    kwargs.setdefault("generations", db.cache_generations)
+    return Blocklist(loader, **kwargs), loader
+
+
+def test_domain_and_subdomains(db):
+    blocks, _ = _blocklist(db, domains=["Blocked.example"])
+    assert blocks.is_domain_blocked("blocked.example")
+    assert blocks.is_domain_blocked("social.BLOCKED.example")
+    assert blocks.is_blocked("https://a.b.blocked.example/users/eve")
+    assert not blocks.is_domain_blocked(None)
+
+
+def test_lookalike_domains(db):
+    blocks, _ = _blocklist(db, domains=["blocked.example"])
+    assert not blocks.is_domain_blocked("notblocked.example")
+    assert not blocks.is_domain_blocked("blocked.example.org")
+    assert not blocks.is_domain_blocked("blocked-example")
+    assert not blocks.is_domain_blocked("example")
+    assert not blocks.is_blocked(ALICE)
+
+
+def test_actors(db):
+    db.blocks.insert_one({"actor_id": ALICE})
+    blocks, _ = _blocklist(db)
+    assert blocks.is_blocked(ALICE)
+    assert not blocks.is_blocked(BOB)
+    assert not blocks.is_blocked(None)
+
+
+def test_reloaded_after_invalidate(db, clock):
+    blocks, loader = _blocklist(db, refresh_interval=3600)
+    other, other_loader = _blocklist(db, refresh_interval=3600)
+    assert not blocks.is_blocked(ALICE)
+    assert not other.is_blocked(ALICE)
+
+    db.blocks.insert_one({"actor_id": ALICE})
+    blocks.invalidate()
+    assert blocks.is_blocked(ALICE)
+    assert loader.calls == 2
+
+    # The other process reloads once the generation counter is checked again
+    assert not other.is_blocked(ALICE)
+    clock.now += 2
+    assert other.is_blocked(ALICE)
+    assert other_loader.calls == 2
+    assert db.cache_generations.find_one({"_id": "blocklist"})["generation"] == 1
+
+
+def test_refresh_interval(db, clock):
+    blocks, loader = _blocklist(db, generations=None, refresh_interval=30)
+    assert not blocks.is_blocked(ALICE)
+    db.blocks.insert_one({"actor_id": ALICE})
+
+    clock.now += 29
+    assert not blocks.is_blocked(ALICE)
+    assert loader.calls == 1
+
+    clock.now += 2
+    assert blocks.is_blocked(ALICE)
+    assert loader.calls == 2
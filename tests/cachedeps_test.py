@@ -0,0 +1,100 @@
+from typing import Any
+from typing import List
+from typing import Optional
+
+from little_boxes import activitypub as ap
+
+from utils.cachedeps import activity_deps
+
+BASE_URL = "https://me.example"
+NOTE = f"{BASE_URL}/outbox/1/activity"
+REMOTE_NOTE = "https://remote.example/notes/1"
+
+
+class FakeActivity(object):
+    """Minimal stand-in for a little_boxes activity (without any backend/fetching)."""
+
+    def __init__(
+        self,
+        type_: ap.ActivityType,
+        obj: Any = None,
+        id: Optional[str] = None,
+        inReplyTo: Optional[str] = None,
+    ) -> None:
+        self.type = type_
+        self.obj = obj
+        self.id = id
+        self.inReplyTo = inReplyTo
+
+    def has_type(self, types: Any) -> bool:
+        if not isinstance(types, list):
+            types = [types]
+        return self.type in types
+
+    def get_object(self) -> "FakeActivity":
+        return self.obj
+
+    def get_object_id(self) -> str:
+        return self.obj if isinstance(self.obj, str) else self.obj.id
+
+
+def _note_deps(object_id: str) -> List[str]:
+    return [object_id, "parent"] if object_id.startswith(BASE_URL) else []
+
+
+def _deps(activity: FakeActivity, outbox: bool) -> List[str]:
+    return activity_deps(activity, outbox, BASE_URL, _note_deps)
+
+
+def test_like():
+    like = FakeActivity(ap.ActivityType.LIKE, NOTE)
+    assert _deps(like, outbox=False) == [NOTE]
+    assert _deps(FakeActivity(ap.ActivityType.LIKE, REMOTE_NOTE), outbox=False) == []
+    assert _deps(FakeActivity(ap.ActivityType.LIKE, REMOTE_NOTE), outbox=True) == [
+        "liked",
+        REMOTE_NOTE,
+    ]
+
+
+def test_announce():
+    announce = FakeActivity(ap.ActivityType.ANNOUNCE, REMOTE_NOTE)
+    assert _deps(announce, outbox=True) == ["outbox", REMOTE_NOTE]
+    assert _deps(announce, outbox=False) == []
+
+
+def test_undo():
+    like = FakeActivity(ap.ActivityType.LIKE, NOTE)
+    assert _deps(FakeActivity(ap.ActivityType.UNDO, like), outbox=False) == [NOTE]
+
+    follow = FakeActivity(ap.ActivityType.FOLLOW, BASE_URL)
+    undo = FakeActivity(ap.ActivityType.UNDO, follow)
+    assert _deps(undo, outbox=False) == ["followers"]
+    assert _deps(undo, outbox=True) == ["following"]
+
+
+def test_accept():
+    accept = FakeActivity(ap.ActivityType.ACCEPT, "https://remote.example/follow")
+    assert _deps(accept, outbox=False) == ["following"]
+    assert _deps(accept, outbox=True) == ["followers"]
+
+
+def test_delete_and_update():
+    delete = FakeActivity(ap.ActivityType.DELETE, NOTE)
+    assert _deps(delete, outbox=False) == [NOTE, "parent"]
+    assert _deps(delete, outbox=True) == [NOTE, "parent", "outbox"]
+    assert _deps(FakeActivity(ap.ActivityType.DELETE, REMOTE_NOTE), False) == []
+
+    update = FakeActivity(ap.ActivityType.UPDATE, f"{BASE_URL}/profile")
+    assert _deps(update, outbox=True) == [f"{BASE_URL}/profile"]
+
+
+def test_create():
+    note = FakeActivity(ap.ActivityType.NOTE, id=NOTE, inReplyTo=REMOTE_NOTE)
+    create = FakeActivity(ap.ActivityType.CREATE, note)
+    assert _deps(create, outbox=True) == ["outbox", NOTE, REMOTE_NOTE]
+
+    reply = FakeActivity(ap.ActivityType.NOTE, id=REMOTE_NOTE, inReplyTo=NOTE)
+    assert _deps(FakeActivity(ap.ActivityType.CREATE, reply), outbox=False) == [NOTE]
+
+    note = FakeActivity(ap.ActivityType.NOTE, id=REMOTE_NOTE)
+    assert _deps(FakeActivity(ap.ActivityType.CREATE, note), outbox=False) == []
@@ -0,0 +1,143 @@
+from datetime import datetime
+from datetime import timedelta
+
+from utils.circuitbreaker import CircuitBreaker
+from utils.circuitbreaker import CircuitState
+
+
+def _state(col, host):
+    return col.find_one({"instance": host})["delivery"]["state"]
+
+
+def _expire(col, host):
+    """Move the opening/probe time of the circuit past the timeout."""
+    past = datetime.utcnow() - timedelta(hours=1)
+    doc = col.find_one({"instance": host})["delivery"]
+    update = {"delivery.opened_at": past}
+    if doc.get("probe_at"):
+        update["delivery.probe_at"] = past
+    col.update_one({"instance": host}, {"$set": update})
+
+
+def test_opens_after_threshold(col):
+    breaker = CircuitBreaker(col, failure_threshold=3)
+    assert breaker.allow("a.example")
+
+    breaker.record_failure("a.example")
+    breaker.record_failure("a.example")
+    assert breaker.allow("a.example")
+
+    breaker.record_failure("a.example")
+    assert _state(col, "a.example") == CircuitState.OPEN.value
+    assert not breaker.allow("a.example")
+    assert breaker.allow("b.example")
+
+
+def test_success_resets_failures(col):
+    breaker = CircuitBreaker(col, failure_threshold=3)
+    breaker.record_failure("a.example")
+    breaker.record_failure("a.example")
+    assert not breaker.record_success("a.example")
+
+    breaker.record_failure("a.example")
+    breaker.record_failure("a.example")
+    assert breaker.allow("a.example")
+
+
+def test_single_probe_once_timeout_is_over(col):
+    breaker = CircuitBreaker(col, failure_threshold=1)
+    breaker.record_failure("a.example")
+    assert breaker.acquire("a.example") is None
+    assert breaker.probes_due() == []
+
+    _expire(col, "a.example")
+    assert breaker.probes_due() == ["a.example"]
+    assert breaker.acquire("a.example") == CircuitState.HALF_OPEN
+    # Only one probe at a time
+    assert breaker.acquire("a.example") is None
+    assert breaker.probes_due() == []
+
+
+def test_probe_success_closes_the_circuit(col):
+    breaker = CircuitBreaker(col, failure_threshold=1)
+    breaker.record_failure("a.example")
+    _expire(col, "a.example")
+    assert breaker.allow("a.example")
+
+    assert breaker.record_success("a.example")
+    assert breaker.acquire("a.example") == CircuitState.CLOSED
+
+
+def test_probe_failure_opens_the_circuit_again(col):
+    breaker = CircuitBreaker(col, failure_threshold=5)
+    for _ in range(5):
+        breaker.record_failure("a.example")
+    _expire(col, "a.example")
+    assert breaker.allow("a.example")
+
+    breaker.record_failure("a.example")
+    assert _state(col, "a.example") == CircuitState.OPEN.value
+    assert not breaker.allow("a.example")
+
+
+def test_admit_single_probe_per_host(col):
+    breaker = CircuitBreaker(col, failure_threshold=1)
+    breaker.record_failure("a.example")
+    breaker.record_failure("b.example")
+    _expire(col, "a.example")
+
+    hosts = ["a.example", "a.example", "b.example", "c.example", "a.example"]
+    assert breaker.admit(hosts) == [True, False, False, True, False]
+    # The probe is in flight
+    assert breaker.admit(hosts) == [False, False, False, True, False]
+
+
+def test_record_batch_counts_a_single_failure_per_host(col):
+    breaker = CircuitBreaker(col, failure_threshold=3)
+    assert breaker.record_batch([("a.example", False)] * 5) == []
+    assert breaker.allow("a.example")
+    assert (
+        col.find_one({"instance": "a.example"})["delivery"]["consecutive_failures"] == 1
+    )
+
+    # An instance that answered to any of the deliveries is alive
+    breaker.record_batch(
+        [("a.example", False), ("a.example", True), ("b.example", None)]
+    )
+    assert (
+        col.find_one({"instance": "a.example"})["delivery"]["consecutive_failures"] == 0
+    )
+    assert col.find_one({"instance": "b.example"}) is None
+
+
+def test_record_batch_returns_the_recovered_hosts(col):
+    breaker = CircuitBreaker(col, failure_threshold=1)
+    breaker.record_batch([("a.example", False), ("b.example", False)])
+    _expire(col, "a.example")
+    _expire(col, "b.example")
+    assert breaker.admit(["a.example", "b.example"]) == [True, True]
+
+    assert breaker.record_batch(
+        [("a.example", True), ("b.example", False), ("c.example", True)]
+    ) == ["a.example"]
+    assert _state(col, "b.example") == CircuitState.OPEN.value
+    assert breaker.admit(["a.example", "b.example"]) == [True, False]
+
+
+def test_success_of_a_healthy_instance_is_not_written_again(col):
+    breaker = CircuitBreaker(col, failure_threshold=3)
+    assert not breaker.record_success("a.example")
+    last_success = col.find_one({"instance": "a.example"})["delivery"]["last_success"]
+
+    assert not breaker.record_success("a.example")
+    assert (
+        col.find_one({"instance": "a.example"})["delivery"]["last_success"]
+        == last_success
+    )
+
+    # A failure is still reset by the next success
+    breaker.record_failure("a.example")
+    breaker.record_success("a.example")
+    assert (
+        col.find_one({"instance": "a.example"})["delivery"]["consecutive_failures"] == 0
+    )
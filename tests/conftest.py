@@ -0,0 +1,14 @@
+import mongomock
+import pytest
+
+
+@pytest.fixture
+def db():
+    """Fresh in-memory database."""
+    return mongomock.MongoClient().db
+
+
+@pytest.fixture
+def col(db):
+    """Collection of the fresh in-memory database (the tested utils are given a single collection)."""
+    return db.col
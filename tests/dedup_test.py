@@ -0,0 +1,21 @@
+from utils.dedup import SeenFilter
+
+
+def test_seen():
+    seen = SeenFilter()
+    assert "https://remote.example/activities/1" not in seen
+    seen.add("https://remote.example/activities/1")
+    assert "https://remote.example/activities/1" in seen
+    assert "https://remote.example/activities/2" not in seen
+
+
+def test_bounded():
+    seen = SeenFilter(maxsize=10)
+    iris = [f"https://remote.example/activities/{i}" for i in range(20)]
+    for iri in iris:
+        seen.add(iri)
+
+    # The oldest IRIs are forgotten, the latest ones are kept
+    assert len(seen._current) + len(seen._previous) <= 10
+    assert all(iri in seen for iri in iris[-5:])
+    assert iris[0] not in seen
@@ -68,6 +68,17 @@ class Instance(object):
 
         return resp.json()
 
+    def drop_recipients(self):
+        """Empties the `recipients` collection (like an instance upgraded from a version without it)."""
+        resp = requests.delete(
+            f"{self.host_url}/api/debug",
+            params={"recipients": 1},
+            headers={**self._auth_headers, "Accept": "application/json"},
+        )
+        resp.raise_for_status()
+
+        return resp.json()
+
     def block(self, actor_url) -> None:
         """Blocks an actor."""
         # Instance1 follows instance2
@@ -607,3 +618,70 @@ def test_post_content_and_post_reply_and_delete() -> None:
     instance1_note = instance1.outbox_get(f"{instance1_create_id}/activity")
     assert "replies" in instance1_note
     assert instance1_note["replies"]["totalItems"] == 0
+
+
+def test_block_unblock_and_post_content():
+    """Instances follow each other, instance2 blocks then unblocks instance1, instance1 creates a new note."""
+    instance1, instance2 = _instances()
+    # Instance1 follows instance2
+    instance1.follow(instance2)
+    instance2.follow(instance1)
+
+    block_id = instance2.block(instance1.docker_url)
+    instance2.undo(block_id)
+
+    create_id = instance1.new_note("hello")
+    instance2_debug = instance2.debug()
+    assert (
+        instance2_debug["inbox"] == 3
+    )  # An Follow, Accept and Create activity should be there
+    assert (
+        instance2_debug["outbox"] == 4
+    )  # We've sent a Accept and a Follow activity + the Block and Undo activities
+
+    # Ensure the post is visible in instance2's stream
+    inbox_stream = instance2.stream_jsonfeed()
+    assert len(inbox_stream["items"]) == 1
+    assert inbox_stream["items"][0]["id"] == create_id
+
+
+def test_post_content_after_upgrade():
+    """Instances follow each other, instance1 loses its recipients (upgraded instance) and creates a note."""
+    instance1, instance2 = _instances()
+    # Instance1 follows instance2
+    instance1.follow(instance2)
+    instance2.follow(instance1)
+
+    instance1.drop_recipients()
+
+    create_id = instance1.new_note("hello")
+    instance2_debug = instance2.debug()
+    assert (
+        instance2_debug["inbox"] == 3
+    )  # An Follow, Accept and Create activity should be there
+
+    # Ensure the post has been delivered to the followers
+    inbox_stream = instance2.stream_jsonfeed()
+    assert len(inbox_stream["items"]) == 1
+    assert inbox_stream["items"][0]["id"] == create_id
+
+
+def test_fast_ack_invalid_activity():
+    """instance2 only stores the inbox requests (fast-ack mode), and rejects the invalid ones right away."""
+    _, instance2 = _instances()
+
+    resp = requests.post(
+        f"{instance2.host_url}/inbox",
+        json=["not", "an", "activity"],
+        headers={"Content-Type": "application/activity+json"},
+    )
+    assert resp.status_code == 400
+
+    resp = requests.post(
+        f"{instance2.host_url}/inbox",
+        json={"type": "Create"},
+        headers={"Content-Type": "application/activity+json"},
+    )
+    assert resp.status_code == 400
+
+    assert instance2.debug()["inbox"] == 0
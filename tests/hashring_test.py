@@ -0,0 +1,29 @@
+from collections import Counter
+
+from utils.hashring import HashRing
+
+KEYS = [f"https://host{i}.example/users/user{i}" for i in range(10000)]
+
+
+def test_stable():
+    ring = HashRing(["inbox.0", "inbox.1"])
+    assert [ring.get_node(k) for k in KEYS[:100]] == [
+        HashRing(["inbox.0", "inbox.1"]).get_node(k) for k in KEYS[:100]
+    ]
+
+
+def test_balanced():
+    for n in [2, 3, 4]:
+        ring = HashRing([f"inbox.{i}" for i in range(n)])
+        counts = Counter(ring.get_node(k) for k in KEYS)
+        assert len(counts) == n
+        for count in counts.values():
+            assert abs(count - len(KEYS) / n) < 0.1 * len(KEYS) / n
+
+
+def test_adding_a_node_only_moves_its_keys():
+    before = HashRing(["inbox.0", "inbox.1"])
+    after = HashRing(["inbox.0", "inbox.1", "inbox.2"])
+    for k in KEYS:
+        node = after.get_node(k)
+        assert node == "inbox.2" or node == before.get_node(k)
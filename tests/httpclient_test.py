@@ -0,0 +1,81 @@
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from typing import Dict
+
+import pytest
+import requests
+import urllib3.util.connection
+
+from utils import httpclient
+from utils.httpclient import HTTPClient
+
+
+class Handler(BaseHTTPRequestHandler):
+    body = b"hello"
+    headers_override: Dict[str, str] = {}
+
+    def do_GET(self):
+        self.send_response(200)
+        headers = {"Content-Length": str(len(self.body))}
+        headers.update(self.headers_override)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://localhost:{httpd.server_port}/"
+    httpd.shutdown()
+    httpd.server_close()
+    httpclient._RESOLVER_CACHE.clear()
+
+
+def test_does_not_patch_urllib3():
+    # The resolution is only cached for the sessions of the HTTP client
+    assert urllib3.util.connection.create_connection.__module__ == (
+        "urllib3.util.connection"
+    )
+
+
+def test_resolution_is_cached(server):
+    client = HTTPClient("test")
+    assert client.get(server).content == b"hello"
+    assert "127.0.0.1" in httpclient._RESOLVER_CACHE["localhost"]
+
+    # Other sessions are left untouched
+    assert requests.get(server).content == b"hello"
+
+
+def test_unreachable_address_is_skipped(server):
+    # 192.0.2.0/24 is reserved for documentation (never reachable)
+    httpclient._RESOLVER_CACHE["localhost"] = ["192.0.2.1", "127.0.0.1"]
+    client = HTTPClient("test", connect_timeout=0.2)
+    assert client.get(server).content == b"hello"
+    # The address that worked is tried first next time
+    assert httpclient._RESOLVER_CACHE["localhost"] == ["127.0.0.1", "192.0.2.1"]
+
+
+@pytest.mark.parametrize("length", ["abc", "-1", ""])
+def test_content_length_is_parsed_defensively(server, monkeypatch, length):
+    monkeypatch.setattr(Handler, "body", b"x" * 20)
+    monkeypatch.setattr(Handler, "headers_override", {"Content-Length": length})
+    client = HTTPClient("test")
+    # The streaming cap still applies
+    with pytest.raises(httpclient.ResponseTooLargeError):
+        client.get(server, max_size=10)
+
+
+def test_announced_size_too_large(server, monkeypatch):
+    monkeypatch.setattr(Handler, "headers_override", {"Content-Length": "100"})
+    client = HTTPClient("test")
+    with pytest.raises(httpclient.ResponseTooLargeError):
+        client.get(server, max_size=10)
@@ -0,0 +1,121 @@
+import json
+
+import pytest
+from little_boxes.key import Key
+from requests.structures import CaseInsensitiveDict
+
+from utils.httpsig import HTTPSigDigestAuth
+from utils.httpsig import PublicKeyStore
+from utils.httpsig import _body_digest
+
+OWNER = "https://remote.example/users/alice"
+INBOX = "https://me.example/inbox"
+BODY = json.dumps({"id": "https://remote.example/activities/1"}).encode("utf-8")
+
+
+def _new_key():
+    k = Key(OWNER)
+    k.new()
+    k.load(k.privkey_pem)
+    return k
+
+
+@pytest.fixture(scope="module")
+def key():
+    return _new_key()
+
+
+@pytest.fixture(scope="module")
+def other_key():
+    return _new_key()
+
+
+class Fetcher(object):
+    """Serves the actor with the given key, and counts the fetches."""
+
+    def __init__(self, key):
+        self.key = key
+        self.calls = 0
+        self.error = None
+
+    def __call__(self, key_id):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return {
+            "id": OWNER,
+            "publicKey": {"id": key_id, "publicKeyPem": self.key.pubkey_pem},
+        }
+
+
+def _signed_headers(key):
+    headers = {"User-Agent": "test", "Content-Type": "application/activity+json"}
+    auth = HTTPSigDigestAuth(key, _body_digest(BODY))
+    return CaseInsensitiveDict(
+        {**headers, **auth.signed_headers("POST", INBOX, headers)}
+    )
+
+
+def _verify(store, headers):
+    return store.verify_request("POST", "/inbox", headers, BODY)
+
+
+def test_key_fetched_once(col, key):
+    fetcher = Fetcher(key)
+    store = PublicKeyStore(col, fetcher)
+    assert _verify(store, _signed_headers(key))
+    assert _verify(store, _signed_headers(key))
+    assert fetcher.calls == 1
+
+    # Loaded from the DB by another process
+    other = PublicKeyStore(col, fetcher)
+    assert other.lookup(key.key_id())
+    assert _verify(other, _signed_headers(key))
+    assert fetcher.calls == 1
+
+
+def test_rotated_key(col, key, other_key):
+    fetcher = Fetcher(key)
+    assert _verify(PublicKeyStore(col, fetcher), _signed_headers(key))
+
+    # The key was rotated, it's fetched again by a process that only has the old one
+    fetcher.key = other_key
+    store = PublicKeyStore(col, fetcher)
+    assert _verify(store, _signed_headers(other_key))
+    assert fetcher.calls == 2
+
+
+def test_bad_signatures_do_not_refetch(col, key, other_key):
+    fetcher = Fetcher(key)
+    store = PublicKeyStore(col, fetcher)
+    assert _verify(store, _signed_headers(key))
+
+    store = PublicKeyStore(col, fetcher)
+    for _ in range(5):
+        assert not _verify(store, _signed_headers(other_key))
+    # Only refetched once within the refetch interval
+    assert fetcher.calls == 2
+
+
+def test_failed_fetch_is_cached(col, key):
+    fetcher = Fetcher(key)
+    fetcher.error = ValueError("gone")
+    store = PublicKeyStore(col, fetcher)
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            _verify(store, _signed_headers(key))
+    assert fetcher.calls == 1
+
+
+def test_verify_cached(col, key, other_key):
+    fetcher = Fetcher(key)
+    store = PublicKeyStore(col, fetcher)
+    headers = _signed_headers(key)
+    # Unknown key, never fetched
+    assert not store.verify_cached("POST", "/inbox", headers, BODY)
+    assert fetcher.calls == 0
+
+    assert _verify(store, headers)
+    assert store.verify_cached("POST", "/inbox", headers, BODY)
+    assert not store.verify_cached("POST", "/inbox", _signed_headers(other_key), BODY)
+    assert not store.verify_cached("POST", "/inbox", headers, b"{}")
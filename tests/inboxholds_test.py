@@ -0,0 +1,94 @@
+from datetime import datetime
+from datetime import timedelta
+
+import pytest
+
+from utils.inboxholds import InboxHolds
+
+ACTOR = "https://remote.example/users/alice"
+LIKE = "https://remote.example/activities/like"
+UNDO = "https://remote.example/activities/undo"
+CREATE = "https://remote.example/activities/create"
+
+
+@pytest.fixture
+def holds(col):
+    holds = InboxHolds(col)
+    holds.spawned = []
+    holds.spawn = lambda actor_id, iri: holds.spawned.append((actor_id, iri))
+    return holds
+
+
+def test_not_held(holds):
+    assert not holds.is_held(ACTOR, LIKE)
+    # Releasing an activity that was never held is a no-op
+    holds.release(ACTOR, LIKE)
+    assert holds.spawned == []
+
+
+def test_hold_queues_the_later_activities(col, holds):
+    holds.hold(ACTOR, LIKE)
+    # The retried activity itself goes through
+    assert not holds.is_held(ACTOR, LIKE)
+    assert holds.is_held(ACTOR, UNDO)
+    assert holds.is_held(ACTOR, CREATE)
+    # Other actors are not held
+    assert not holds.is_held("https://remote.example/users/bob", UNDO)
+
+    assert col.find_one({"actor_id": ACTOR})["pending"] == [UNDO, CREATE]
+
+
+def test_hold_is_kept_on_retry(col, holds):
+    holds.hold(ACTOR, LIKE)
+    holds.is_held(ACTOR, UNDO)
+    holds.hold(ACTOR, LIKE)
+
+    hold = col.find_one({"actor_id": ACTOR})
+    assert hold["iri"] == LIKE
+    assert hold["pending"] == [UNDO]
+
+
+def test_release_hands_the_hold_to_the_next_activity(col, holds):
+    holds.hold(ACTOR, LIKE)
+    holds.is_held(ACTOR, UNDO)
+    holds.is_held(ACTOR, CREATE)
+
+    holds.release(ACTOR, LIKE)
+    assert holds.spawned == [(ACTOR, UNDO)]
+    # The activities received meanwhile still wait
+    assert holds.is_held(ACTOR, "https://remote.example/activities/other")
+    assert not holds.is_held(ACTOR, UNDO)
+
+    holds.release(ACTOR, UNDO)
+    holds.release(ACTOR, CREATE)
+    holds.release(ACTOR, "https://remote.example/activities/other")
+    assert holds.spawned == [
+        (ACTOR, UNDO),
+        (ACTOR, CREATE),
+        (ACTOR, "https://remote.example/activities/other"),
+    ]
+    assert col.count_documents({}) == 0
+
+
+def test_release_by_another_activity_is_ignored(col, holds):
+    holds.hold(ACTOR, LIKE)
+    holds.is_held(ACTOR, UNDO)
+
+    holds.release(ACTOR, CREATE)
+    assert holds.spawned == []
+    assert col.find_one({"actor_id": ACTOR})["iri"] == LIKE
+
+
+def test_expired_hold_requeues_the_held_activities(col, holds):
+    holds.hold(ACTOR, LIKE)
+    holds.is_held(ACTOR, UNDO)
+    holds.is_held(ACTOR, CREATE)
+    col.update_one(
+        {"actor_id": ACTOR},
+        {"$set": {"held_at": datetime.utcnow() - timedelta(hours=2)}},
+    )
+
+    other = "https://remote.example/activities/other"
+    assert not holds.is_held(ACTOR, other)
+    assert holds.spawned == [(ACTOR, UNDO), (ACTOR, CREATE)]
+    assert col.count_documents({}) == 0
@@ -0,0 +1,162 @@
+import json
+from datetime import datetime
+from datetime import timedelta
+
+import pytest
+from bson.objectid import ObjectId
+
+from utils.intake import InboxIntake
+from utils.intake import IntakeStatus
+from utils.intake import parse_body
+
+HEADERS = {"Signature": 'keyId="https://remote.example/users/alice#main-key"'}
+BODY = json.dumps({"id": "https://remote.example/activities/1"}).encode("utf-8")
+
+
+class Handler(object):
+    """Inbox handler dropping the invalid payloads, and raising `error` if set."""
+
+    def __init__(self):
+        self.processed = []
+        self.error = None
+
+    def __call__(self, doc):
+        if self.error:
+            raise self.error
+        data = parse_body(doc["body"])
+        if not data:
+            return False
+        self.processed.append(data["id"])
+        return True
+
+
+@pytest.fixture
+def intake(col):
+    return InboxIntake(col, grace=timedelta(minutes=5), max_retries=2)
+
+
+def _enqueue(intake, body=BODY):
+    return ObjectId(intake.enqueue("POST", "/inbox", HEADERS, body))
+
+
+def _backdate(col, intake_id, field):
+    past = datetime.utcnow() - timedelta(hours=1)
+    col.update_one({"_id": intake_id}, {"$set": {field: past}})
+
+
+def test_parse_body():
+    assert parse_body(BODY) == {"id": "https://remote.example/activities/1"}
+    assert parse_body(b"not json") is None
+    assert parse_body(b"[]") is None
+    assert parse_body(json.dumps({"id": 1}).encode("utf-8")) is None
+
+
+def test_enqueue(col, intake):
+    intake_id = _enqueue(intake)
+    doc = col.find_one({"_id": intake_id})
+    assert doc["status"] == IntakeStatus.PENDING.value
+    assert doc["headers"] == [list(h) for h in HEADERS.items()]
+    assert doc["body"] == BODY
+    assert doc["attempts"] == 0
+    # Not due until the grace delay (the task was spawned)
+    assert intake.due() == []
+
+
+def test_processed_request_is_removed(col, intake):
+    handler = Handler()
+    intake_id = _enqueue(intake)
+    intake.process(intake_id, handler)
+
+    assert handler.processed == ["https://remote.example/activities/1"]
+    assert col.count_documents({}) == 0
+
+    # Processing it again is a no-op
+    intake.process(intake_id, handler)
+    assert handler.processed == ["https://remote.example/activities/1"]
+
+
+def test_invalid_payload_is_dropped(col, intake):
+    handler = Handler()
+    intake.process(_enqueue(intake, b"not json"), handler)
+
+    assert handler.processed == []
+    assert col.count_documents({}) == 0
+
+
+def test_claimed_request_is_not_processed_twice(col, intake):
+    intake_id = _enqueue(intake)
+    calls = []
+
+    def handler(doc):
+        # Processed concurrently by another worker
+        intake.process(intake_id, Handler())
+        calls.append(doc["_id"])
+        return True
+
+    intake.process(intake_id, handler)
+    assert calls == [intake_id]
+    assert col.count_documents({}) == 0
+
+
+def test_failed_request_is_retried(col, intake):
+    handler = Handler()
+    handler.error = ValueError()
+    intake_id = _enqueue(intake)
+    intake.process(intake_id, handler)
+
+    doc = col.find_one({"_id": intake_id})
+    assert doc["status"] == IntakeStatus.PENDING.value
+    assert doc["attempts"] == 1
+    assert doc["next_attempt_at"] > datetime.utcnow()
+    assert intake.due() == []
+
+    # Due once the backoff is over
+    _backdate(col, intake_id, "next_attempt_at")
+    assert [doc["_id"] for doc in intake.due()] == [intake_id]
+    # Not returned again until the grace delay
+    assert intake.due() == []
+
+    handler.error = None
+    intake.process(intake_id, handler)
+    assert col.count_documents({}) == 0
+
+
+def test_gives_up_after_max_retries(col, intake):
+    handler = Handler()
+    handler.error = ValueError()
+    intake_id = _enqueue(intake)
+    for _ in range(3):
+        col.update_one(
+            {"_id": intake_id}, {"$set": {"status": IntakeStatus.PENDING.value}}
+        )
+        intake.process(intake_id, handler)
+
+    doc = col.find_one({"_id": intake_id})
+    assert doc["status"] == IntakeStatus.FAILED.value
+    assert doc["attempts"] == 3
+
+    _backdate(col, intake_id, "next_attempt_at")
+    assert intake.due() == []
+
+
+def test_requeues_the_requests_of_dead_workers(col, intake):
+    intake_id = _enqueue(intake)
+
+    def handler(doc):
+        # The worker dies while processing the request
+        raise SystemExit()
+
+    with pytest.raises(SystemExit):
+        intake.process(intake_id, handler)
+    assert col.find_one({"_id": intake_id})["status"] == IntakeStatus.PROCESSING.value
+    assert intake.due() == []
+
+    _backdate(col, intake_id, "started_at")
+    due = intake.due()
+    assert [doc["_id"] for doc in due] == [intake_id]
+    assert due[0]["headers"] == [list(h) for h in HEADERS.items()]
+    assert col.find_one({"_id": intake_id})["status"] == IntakeStatus.PENDING.value
+
+    handler = Handler()
+    intake.process(intake_id, handler)
+    assert handler.processed == ["https://remote.example/activities/1"]
@@ -0,0 +1,111 @@
+import hashlib
+
+import pytest
+
+from utils.ledger import DeliveryLedger
+from utils.ledger import DeliveryStatus
+
+ACTIVITY = "https://me.example/outbox/1"
+RECIPIENTS = [
+    "https://a.example/inbox",
+    "https://b.example/inbox",
+    "https://b.example/users/bob/inbox",
+]
+
+
+def _queue(host):
+    return f"delivery.{host}"
+
+
+def _digest(body):
+    return hashlib.sha256(body).hexdigest()
+
+
+class Serializer(object):
+    """Counts the signatures of the activity."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return b'{"id": "https://me.example/outbox/1"}'
+
+
+@pytest.fixture
+def ledger(db):
+    db.deliveries.create_index([("payload_id", 1), ("to", 1)], unique=True)
+    return DeliveryLedger(db.payloads, db.deliveries)
+
+
+def test_payload_is_saved_once(db, ledger):
+    serialize = Serializer()
+    payload_id = ledger.save_payload(ACTIVITY, serialize, _digest)
+    assert ledger.save_payload(ACTIVITY, serialize, _digest) == payload_id
+    assert serialize.calls == 1
+
+    payload = db.payloads.find_one()
+    assert payload["activity_id"] == ACTIVITY
+    assert payload["digest"] == _digest(serialize())
+    assert db.payloads.count_documents({}) == 1
+
+    other_id = ledger.save_payload("https://me.example/outbox/2", serialize, _digest)
+    assert other_id != payload_id
+
+
+def test_ledger_rows(db, ledger):
+    payload_id = ledger.save_payload(ACTIVITY, Serializer(), _digest)
+    todo = ledger.enqueue(payload_id, ACTIVITY, RECIPIENTS, _queue, scheduled=False)
+
+    assert len(todo) == 3
+    rows = {doc["to"]: doc for doc in db.deliveries.find()}
+    assert sorted(rows) == sorted(RECIPIENTS)
+    row = rows["https://b.example/users/bob/inbox"]
+    assert row["payload_id"] == payload_id
+    assert row["activity_id"] == ACTIVITY
+    assert row["host"] == "b.example"
+    assert row["queue"] == "delivery.b.example"
+    assert row["status"] == DeliveryStatus.PENDING.value
+    assert row["attempts"] == 0
+    assert "next_attempt_at" not in row
+
+
+def test_enqueue_again_only_returns_the_deliveries_not_spawned(db, ledger):
+    payload_id = ledger.save_payload(ACTIVITY, Serializer(), _digest)
+    todo = ledger.enqueue(payload_id, ACTIVITY, RECIPIENTS, _queue, scheduled=False)
+    # The task fails after spawning the first delivery, which is then sent
+    ledger.spawned(todo[0]["_id"])
+    db.deliveries.update_one(
+        {"_id": todo[0]["_id"]}, {"$set": {"status": DeliveryStatus.DONE.value}}
+    )
+
+    # The task is retried
+    payload_id = ledger.save_payload(ACTIVITY, Serializer(), _digest)
+    todo_again = ledger.enqueue(
+        payload_id, ACTIVITY, RECIPIENTS, _queue, scheduled=False
+    )
+    assert [doc["_id"] for doc in todo_again] == [doc["_id"] for doc in todo[1:]]
+    assert db.deliveries.count_documents({}) == 3
+    assert db.deliveries.find_one({"_id": todo[0]["_id"]})["status"] == "done"
+
+    for doc in todo_again:
+        ledger.spawned(doc["_id"])
+    assert ledger.enqueue(payload_id, ACTIVITY, RECIPIENTS, _queue, False) == []
+
+
+def test_scheduled(db, ledger):
+    payload_id = ledger.save_payload(ACTIVITY, Serializer(), _digest)
+    assert ledger.enqueue(payload_id, ACTIVITY, RECIPIENTS, _queue, True) == []
+    assert ledger.enqueue(payload_id, ACTIVITY, RECIPIENTS, _queue, True) == []
+
+    assert db.deliveries.count_documents({}) == 3
+    for row in db.deliveries.find():
+        assert row["next_attempt_at"] == row["created_at"]
+        assert "spawned" not in row
+
+
+def test_new_recipients_are_added(db, ledger):
+    payload_id = ledger.save_payload(ACTIVITY, Serializer(), _digest)
+    ledger.enqueue(payload_id, ACTIVITY, RECIPIENTS[:1], _queue, True)
+    ledger.enqueue(payload_id, ACTIVITY, RECIPIENTS, _queue, True)
+    assert db.deliveries.count_documents({}) == 3
@@ -0,0 +1,51 @@
+import threading
+
+from utils.memo import Memo
+
+
+def test_outside_of_a_scope():
+    memo = Memo()
+    memo.set("a", 1)
+    assert memo.get("a") is None
+
+
+def test_scope():
+    memo = Memo()
+    memo.start()
+    assert memo.get("a") is None
+    memo.set("a", 1)
+    assert memo.get("a") == 1
+    memo.pop("a")
+    assert memo.get("a") is None
+
+    memo.set("a", 1)
+    memo.end()
+    assert memo.get("a") is None
+
+    # A new scope starts empty
+    memo.start()
+    assert memo.get("a") is None
+    memo.end()
+
+
+def test_threads_are_isolated():
+    memo = Memo()
+    memo.start()
+    memo.set("a", "main")
+
+    seen = []
+
+    def other():
+        seen.append(memo.get("a"))
+        memo.start()
+        memo.set("a", "other")
+        seen.append(memo.get("a"))
+        memo.end()
+
+    t = threading.Thread(target=other)
+    t.start()
+    t.join()
+
+    assert seen == [None, "other"]
+    assert memo.get("a") == "main"
+    memo.end()
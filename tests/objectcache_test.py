@@ -0,0 +1,75 @@
+from utils.objectcache import ObjectCache
+from utils.objectcache import conditional_get
+from utils.objectcache import response_validators
+
+IRI = "https://remote.example/notes/1"
+EMBEDDED = {"id": IRI, "type": "Note", "content": "first version"}
+FETCHED = {"id": IRI, "type": "Note", "content": "edited"}
+
+
+class Response(object):
+    def __init__(self, status_code, data=None, headers=None):
+        self.status_code = status_code
+        self.data = data
+        self.headers = headers or {}
+
+
+class Remote(object):
+    """Serves the queued responses, and records the headers of each request."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent = []
+
+    def __call__(self, headers):
+        self.sent.append(headers)
+        return self.responses.pop(0)
+
+
+def _fetch(cache, remote):
+    resp, cached_data = conditional_get(remote, cache.get_validators(IRI))
+    if cached_data:
+        cache.touch(IRI)
+        return cached_data
+
+    cache.set(IRI, resp.data, response_validators(resp.headers))
+    return resp.data
+
+
+def test_not_modified_returns_the_fetched_copy(db):
+    # An inbox activity embeds an older copy of the object
+    db.activities.insert_one({"box": "inbox", "activity": {"object": EMBEDDED}})
+    cache = ObjectCache(db.objects)
+    remote = Remote(
+        Response(200, FETCHED, {"ETag": '"v2"'}),
+        Response(304),
+    )
+
+    assert _fetch(cache, remote) == FETCHED
+    assert remote.sent[0] == {}
+
+    assert _fetch(cache, remote) == FETCHED
+    assert remote.sent[1] == {"If-None-Match": '"v2"'}
+    # The embedded copy is left untouched
+    assert db.activities.find_one()["activity"]["object"] == EMBEDDED
+
+
+def test_not_modified_without_cached_copy():
+    resp, cached_data = conditional_get(Remote(Response(304)), None)
+    assert resp.status_code == 304
+    assert cached_data is None
+
+
+def test_validators():
+    headers = {"ETag": '"v1"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"}
+    assert response_validators(headers) == {
+        "etag": '"v1"',
+        "last_modified": "Wed, 21 Oct 2015 07:28:00 GMT",
+    }
+    assert response_validators({}) == {}
+
+    remote = Remote(Response(304))
+    conditional_get(remote, (response_validators(headers), FETCHED))
+    assert remote.sent == [
+        {"If-None-Match": '"v1"', "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT"}
+    ]
@@ -0,0 +1,105 @@
+from datetime import datetime
+from datetime import timedelta
+
+from utils.pagecache import PageCache
+
+KEY = ("/", "html", None)
+OTHER_KEY = ("/about", "html", None)
+
+
+def _cache(db, **kwargs):
+    kwargs.setdefault("check_interval", 0)
+    return PageCache(db.cache2, db.cache_generations, db.cache_invalidations, **kwargs)
+
+
+def test_get_set(db):
+    cache = _cache(db)
+    assert cache.get(KEY) is None
+    cache.set(KEY, "page", ["outbox", "note1"])
+    assert cache.get(KEY) == "page"
+
+    # Served by L2 in another process
+    assert _cache(db).get(KEY) == "page"
+
+
+def test_invalidate_deps(db):
+    cache = _cache(db)
+    cache.set(KEY, "page", ["outbox", "note1"])
+    cache.set(OTHER_KEY, "about", ["followers"])
+
+    cache.invalidate(["note2"])
+    assert cache.get(KEY) == "page"
+
+    cache.invalidate(["note1"])
+    assert cache.get(KEY) is None
+    assert cache.get(OTHER_KEY) == "about"
+
+
+def test_invalidate_all(db):
+    cache = _cache(db)
+    cache.set(KEY, "page", ["outbox"])
+    cache.set(OTHER_KEY, "about", ["followers"])
+
+    cache.invalidate()
+    assert cache.get(KEY) is None
+    assert cache.get(OTHER_KEY) is None
+
+
+def test_invalidation_across_processes(db):
+    cache = _cache(db)
+    other = _cache(db)
+    cache.set(KEY, "page", ["note1"])
+    assert other.get(KEY) == "page"
+
+    # Both entries are in L1, the other process must read the invalidation log
+    cache.invalidate(["note1"])
+    assert other.get(KEY) is None
+
+    other.set(KEY, "page2", ["note1"])
+    cache.invalidate()
+    assert other.get(KEY) is None
+
+
+def test_l1_served_until_checked(db):
+    cache = _cache(db, check_interval=3600)
+    other = _cache(db)
+    other.set(KEY, "page", ["note1"])
+    assert cache.get(KEY) == "page"
+
+    other.invalidate(["note1"])
+    assert cache.get(KEY) == "page"
+
+
+def test_invalidated_while_rendering(db):
+    cache = _cache(db)
+    assert cache.get(KEY) is None
+    # The page is being rendered while one of its objects changes
+    _cache(db).invalidate(["note1"])
+    cache.set(KEY, "stale", ["note1"])
+    assert cache.get(KEY) is None
+    assert db.cache2.count_documents({}) == 0
+
+
+def test_misses_are_forgotten_at_the_end_of_the_request(db):
+    cache = _cache(db)
+    assert cache.get(KEY) is None
+    assert cache.get(OTHER_KEY) is None
+    cache.set(KEY, "page", ["outbox"])
+    assert list(cache._misses()) == [OTHER_KEY]
+
+    cache.end()
+    assert cache._misses() == {}
+
+
+def test_entries_expire(db):
+    cache = _cache(db, ttl=3600)
+    cache.set(KEY, "page", ["outbox"])
+    assert cache.get(KEY) == "page"
+
+    # Rendered 2 hours ago, in L1 and in L2 (not removed by the TTL index yet)
+    rendered_at = datetime.utcnow() - timedelta(hours=2)
+    data, deps, _ = cache._cache[KEY]
+    cache._cache[KEY] = (data, deps, rendered_at)
+    db.cache2.update_many({}, {"$set": {"date": rendered_at}})
+    assert cache.get(KEY) is None
+    assert _cache(db, ttl=3600).get(KEY) is None
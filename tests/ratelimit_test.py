@@ -0,0 +1,63 @@
+import pytest
+
+from utils import ratelimit
+from utils.ratelimit import RateLimiter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Fake `time.time()`, advanced by setting `clock.now`."""
+
+    class Clock(object):
+        now = 1000000.0
+
+    c = Clock()
+    monkeypatch.setattr(ratelimit.time, "time", lambda: c.now)
+    return c
+
+
+def test_burst_then_rejected(col, clock):
+    limiter = RateLimiter(col, rate=1, burst=5)
+    for _ in range(5):
+        assert limiter.hit("a.example") == 0
+
+    retry_after = limiter.hit("a.example")
+    assert 0 < retry_after <= 1
+
+
+def test_refills_at_rate(col, clock):
+    limiter = RateLimiter(col, rate=2, burst=2)
+    assert limiter.hit("a.example") == 0
+    assert limiter.hit("a.example") == 0
+    assert limiter.hit("a.example") > 0
+
+    clock.now += 0.5
+    assert limiter.hit("a.example") == 0
+    assert limiter.hit("a.example") > 0
+
+
+def test_per_host(col, clock):
+    limiter = RateLimiter(col, rate=1, burst=1)
+    assert limiter.hit("a.example") == 0
+    assert limiter.hit("a.example") > 0
+    assert limiter.hit("b.example") == 0
+
+
+def test_disabled(col, clock):
+    limiter = RateLimiter(col, rate=0, burst=1)
+    for _ in range(10):
+        assert limiter.hit("a.example") == 0
+
+
+def test_counters(col, clock):
+    limiter = RateLimiter(col, rate=1, burst=2)
+    for _ in range(3):
+        limiter.hit("a.example")
+
+    ingress = col.find_one({"instance": "a.example"})["ingress"]
+    assert ingress["accepted"] == 2
+    assert ingress["rejected"] == 1
+
+    clock.now += 60
+    doc = col.find_one({"instance": "a.example"})
+    assert RateLimiter.requests_per_minute(doc) == 2
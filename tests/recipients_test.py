@@ -0,0 +1,139 @@
+import pytest
+
+from utils.recipients import Recipients
+from utils.recipients import resolve_inboxes
+
+ME = "https://me.example"
+PUBLIC = "https://www.w3.org/ns/activitystreams#Public"
+
+
+def _actor(name, host="remote.example", shared=True):
+    actor = {
+        "id": f"https://{host}/users/{name}",
+        "inbox": f"https://{host}/users/{name}/inbox",
+    }
+    if shared:
+        actor["sharedInbox"] = f"https://{host}/inbox"
+    return actor
+
+
+def _follow(actor, n, cached=True):
+    doc = {"remote_id": f"{actor['id']}/follows/{n}", "meta": {}}
+    if cached:
+        doc["meta"]["actor"] = actor
+    return doc
+
+
+@pytest.fixture
+def recipients(db):
+    db.recipients.create_index("actor_id", unique=True)
+    return Recipients(db.recipients, db.migrations)
+
+
+def test_shared_inbox_collapsing(recipients):
+    recipients.add("f1", _actor("alice"))
+    recipients.add("f2", _actor("bob"))
+    recipients.add("f3", _actor("carol", "other.example", shared=False))
+    recipients.add("f4", _actor("dave", "other.example", shared=False))
+
+    assert sorted(recipients.inboxes()) == [
+        "https://other.example/users/carol/inbox",
+        "https://other.example/users/dave/inbox",
+        "https://remote.example/inbox",
+    ]
+
+
+def test_shared_inbox_covers_the_instance(recipients):
+    # A follower without a shared inbox on an instance that has one
+    recipients.add("f1", _actor("alice", shared=False))
+    recipients.add("f2", _actor("bob"))
+
+    assert recipients.inboxes() == ["https://remote.example/inbox"]
+
+
+def test_add_is_idempotent(db, recipients):
+    recipients.add("f1", _actor("alice", shared=False))
+    # Follows again (with a new Follow), the actor now has a shared inbox
+    recipients.add("f2", _actor("alice"))
+
+    assert db.recipients.count_documents({}) == 1
+    assert db.recipients.find_one()["follow_id"] == "f2"
+    assert recipients.inboxes() == ["https://remote.example/inbox"]
+
+
+def test_remove(recipients):
+    recipients.add("f1", _actor("alice", shared=False))
+    recipients.add("f2", _actor("bob", shared=False))
+    recipients.add("f3", _actor("carol", shared=False))
+
+    recipients.remove_follow("f1")
+    recipients.remove_actors([_actor("bob")["id"]])
+    assert recipients.inboxes() == ["https://remote.example/users/carol/inbox"]
+
+
+def test_rebuild(recipients):
+    alice, bob = _actor("alice"), _actor("bob", "other.example", shared=False)
+    resolved = []
+
+    def resolve(doc):
+        resolved.append(doc["remote_id"])
+        return bob
+
+    # A follower that unfollowed since
+    recipients.add("gone", _actor("carol", "third.example"))
+    assert not recipients.is_built()
+
+    count = recipients.rebuild([_follow(alice, 1), _follow(bob, 2, False)], resolve)
+    assert count == 2
+    assert resolved == [_follow(bob, 2)["remote_id"]]
+    assert recipients.is_built()
+    assert sorted(recipients.inboxes()) == [
+        "https://other.example/users/bob/inbox",
+        "https://remote.example/inbox",
+    ]
+
+
+def test_rebuild_skips_the_unresolved_followers(db, recipients):
+    alice, bob = _actor("alice"), _actor("bob", "other.example")
+    recipients.add(_follow(bob, 2)["remote_id"], bob)
+
+    def resolve(doc):
+        raise ValueError("fetch failed")
+
+    count = recipients.rebuild(
+        [_follow(alice, 1, False), _follow(bob, 2, False)], resolve
+    )
+    assert count == 2
+    # Kept as it was already there
+    assert recipients.inboxes() == ["https://other.example/inbox"]
+    # Recorded as built even if some followers failed (they're retried by the next rebuild)
+    assert recipients.is_built()
+    assert db.migrations.find_one()["failed"] == 2
+
+
+def test_rebuild_without_followers(recipients):
+    assert recipients.rebuild([], lambda doc: None) == 0
+    assert recipients.is_built()
+
+    recipients.drop()
+    assert not recipients.is_built()
+
+
+def test_resolve_inboxes():
+    alice = {**_actor("alice"), "type": "Person", "endpoints": {"sharedInbox": "a"}}
+    bob = {**_actor("bob", shared=False), "type": "Person"}
+    carol = {**_actor("carol", shared=False), "type": "Person"}
+    collection = {
+        "id": "https://remote.example/lists/1",
+        "type": "OrderedCollection",
+        "items": [bob["id"], carol["id"], ME],
+    }
+    docs = {doc["id"]: doc for doc in [alice, bob, carol, collection]}
+
+    inboxes = resolve_inboxes(
+        [PUBLIC, alice["id"], collection["id"], bob["id"], None],
+        lambda iri: docs[iri],
+        lambda raw: raw["items"],
+        ignored=[ME, PUBLIC],
+    )
+    assert inboxes == ["a", bob["inbox"], carol["inbox"]]
@@ -0,0 +1,148 @@
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+
+from utils.singleflight import SingleFlight
+
+KEY = "https://remote.example/users/alice"
+
+
+class Fetcher(object):
+    """Slow call, counting the calls."""
+
+    def __init__(self, result="actor", delay=0.1):
+        self.result = result
+        self.delay = delay
+        self.calls = 0
+        self.error = None
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return self.result
+
+
+def _run_concurrently(n, f):
+    results = []
+    errors = []
+
+    def target():
+        try:
+            results.append(f())
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=target) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, errors
+
+
+def test_concurrent_calls_are_deduplicated(col):
+    flight = SingleFlight(col)
+    fetcher = Fetcher()
+    results, errors = _run_concurrently(10, lambda: flight.do(KEY, fetcher))
+    assert results == ["actor"] * 10
+    assert not errors
+    assert fetcher.calls == 1
+
+
+def test_result_shared_across_processes(col):
+    fetcher = Fetcher(delay=0)
+    assert SingleFlight(col).do(KEY, fetcher) == "actor"
+    # Another process reuses the result while it's fresh
+    assert SingleFlight(col).do(KEY, fetcher) == "actor"
+    assert fetcher.calls == 1
+
+    col.update_one(
+        {"_id": KEY}, {"$set": {"expires_at": datetime.utcnow() - timedelta(seconds=1)}}
+    )
+    assert SingleFlight(col).do(KEY, fetcher) == "actor"
+    assert fetcher.calls == 2
+
+
+def test_waits_for_the_lease_holder(col):
+    # Another process holds the lease
+    col.insert_one(
+        {"_id": KEY, "expires_at": datetime.utcnow() + timedelta(seconds=30)}
+    )
+
+    def release():
+        time.sleep(0.2)
+        col.update_one({"_id": KEY}, {"$set": {"result": "from the other process"}})
+
+    t = threading.Thread(target=release)
+    t.start()
+    fetcher = Fetcher(delay=0)
+    assert SingleFlight(col, poll_interval=0.01).do(KEY, fetcher) == (
+        "from the other process"
+    )
+    t.join()
+    assert fetcher.calls == 0
+
+
+def test_errors_are_propagated(col):
+    flight = SingleFlight(col)
+    fetcher = Fetcher()
+    fetcher.error = ValueError("gone")
+    results, errors = _run_concurrently(5, lambda: flight.do(KEY, fetcher))
+    assert not results
+    assert len(errors) == 5
+    assert all(isinstance(err, ValueError) for err in errors)
+    assert fetcher.calls == 1
+
+    # The lease is released, the next call is made again
+    fetcher.error = None
+    assert flight.do(KEY, fetcher) == "actor"
+    assert fetcher.calls == 2
+
+
+def test_waiters_get_their_own_copy(col):
+    flight = SingleFlight(col)
+    fetcher = Fetcher(result={"id": KEY, "tags": []})
+
+    def fetch_and_mutate():
+        result = flight.do(KEY, fetcher)
+        result["tags"].append("mutated")
+        return result
+
+    results, errors = _run_concurrently(5, fetch_and_mutate)
+    assert not errors
+    assert fetcher.calls == 1
+    assert all(result["tags"] == ["mutated"] for result in results)
+    assert fetcher.result == {"id": KEY, "tags": ["mutated"]}
+
+
+def test_max_wait_in_process(col):
+    flight = SingleFlight(col)
+    slow = Fetcher(result="slow", delay=0.5)
+    t = threading.Thread(target=lambda: flight.do(KEY, slow))
+    t.start()
+    time.sleep(0.05)
+
+    # Doesn't wait for the call in flight
+    fetcher = Fetcher(result="direct", delay=0)
+    start = time.monotonic()
+    assert flight.do(KEY, fetcher, max_wait=0.05) == "direct"
+    assert time.monotonic() - start < 0.4
+    t.join()
+    assert slow.calls == 1
+
+
+def test_max_wait_for_the_lease_holder(col):
+    # Another process holds the lease
+    col.insert_one(
+        {"_id": KEY, "expires_at": datetime.utcnow() + timedelta(seconds=30)}
+    )
+    fetcher = Fetcher(delay=0)
+    start = time.monotonic()
+    assert SingleFlight(col, poll_interval=0.01).do(KEY, fetcher, max_wait=0.1) == (
+        "actor"
+    )
+    assert time.monotonic() - start < 1
+    assert fetcher.calls == 1
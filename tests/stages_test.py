@@ -0,0 +1,107 @@
+import pytest
+
+from utils.stages import StageStatus
+from utils.stages import run_stages
+
+
+class GoneError(Exception):
+    pass
+
+
+class Stage(object):
+    """Stage counting its calls, raising `error` if set."""
+
+    def __init__(self, updates=None):
+        self.updates = updates or {}
+        self.calls = 0
+        self.error = None
+
+    def __call__(self, activity, meta):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return self.updates
+
+
+def _insert(col, stages=None):
+    doc = {"remote_id": "https://remote.example/activities/1", "meta": {}}
+    if stages:
+        doc["meta"]["stages"] = stages
+    col.insert_one(doc)
+    return col.find_one({"_id": doc["_id"]})
+
+
+def _run(col, doc, stages):
+    run_stages(col, doc, None, list(stages.items()), drop_errors=(GoneError,))
+
+
+def _statuses(col):
+    return col.find_one()["meta"]["stages"]
+
+
+def test_records_the_updates(col):
+    stages = {"process": Stage({"stream": True}), "finish": Stage()}
+    _run(col, _insert(col), stages)
+
+    meta = col.find_one()["meta"]
+    assert meta["stream"] is True
+    assert meta["stages"] == {
+        "process": StageStatus.DONE.value,
+        "finish": StageStatus.DONE.value,
+    }
+
+
+def test_skips_the_done_stages(col):
+    stages = {"process": Stage(), "finish": Stage()}
+    doc = _insert(
+        col,
+        {"process": StageStatus.DONE.value, "finish": StageStatus.DROPPED.value},
+    )
+    _run(col, doc, stages)
+
+    assert stages["process"].calls == 0
+    assert stages["finish"].calls == 0
+
+
+def test_dropped(col):
+    stages = {"process": Stage(), "finish": Stage()}
+    stages["process"].error = GoneError()
+    _run(col, _insert(col), stages)
+
+    # The next stages still run
+    assert _statuses(col) == {
+        "process": StageStatus.DROPPED.value,
+        "finish": StageStatus.DONE.value,
+    }
+
+
+def test_error_is_recorded_and_raised(col):
+    stages = {"process": Stage(), "finish": Stage(), "media": Stage()}
+    stages["finish"].error = ValueError()
+    with pytest.raises(ValueError):
+        _run(col, _insert(col), stages)
+
+    assert _statuses(col) == {
+        "process": StageStatus.DONE.value,
+        "finish": StageStatus.ERROR.value,
+    }
+    assert stages["media"].calls == 0
+
+
+def test_retry_resumes_at_the_failed_stage(col):
+    stages = {"process": Stage({"stream": True}), "finish": Stage(), "media": Stage()}
+    stages["finish"].error = ValueError()
+    with pytest.raises(ValueError):
+        _run(col, _insert(col), stages)
+
+    # The retry reads the activity from the DB again
+    stages["finish"].error = None
+    _run(col, col.find_one(), stages)
+
+    assert [stage.calls for stage in stages.values()] == [1, 2, 1]
+    assert _statuses(col) == {
+        "process": StageStatus.DONE.value,
+        "finish": StageStatus.DONE.value,
+        "media": StageStatus.DONE.value,
+    }
+    assert col.find_one()["meta"]["stream"] is True
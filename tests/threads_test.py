@@ -0,0 +1,59 @@
+from utils.threads import find_thread_root
+
+# Thread: root <- a <- b <- c (only the ones in STORED are known locally)
+PARENTS = {"root": None, "a": "root", "b": "a", "c": "b"}
+
+
+class Store(object):
+    def __init__(self, stored, roots=None):
+        self.stored = set(stored)
+        self.roots = roots or {}
+        self.fetched = []
+        self.gone = set()
+
+    def lookup(self, iri):
+        if iri not in self.stored:
+            return None
+        return self.roots.get(iri), PARENTS[iri]
+
+    def fetch(self, iri):
+        self.fetched.append(iri)
+        if iri in self.gone:
+            return None
+        self.stored.add(iri)
+        return iri, PARENTS[iri]
+
+
+def test_known_root():
+    store = Store(["root", "a", "b", "c"], roots={"b": "root"})
+    assert find_thread_root("c", store.lookup, store.fetch, 50) == ("root", [])
+    # Stops at the first ancestor with a known root
+    assert find_thread_root("b", store.lookup, None, 50) == ("root", [])
+
+
+def test_walks_up_to_the_root():
+    store = Store(["root", "a", "b"])
+    assert find_thread_root("b", store.lookup, None, 50) == ("root", [])
+
+
+def test_unknown_ancestor_without_fetch():
+    store = Store(["b", "c"])
+    assert find_thread_root("c", store.lookup, None, 50) is None
+    assert store.fetched == []
+
+
+def test_fetches_the_unknown_ancestors():
+    store = Store(["c", "root"])
+    assert find_thread_root("c", store.lookup, store.fetch, 50) == ("root", ["b", "a"])
+    assert store.fetched == ["b", "a"]
+
+
+def test_gone_ancestor():
+    store = Store(["c"])
+    store.gone.add("a")
+    assert find_thread_root("c", store.lookup, store.fetch, 50) == ("a", ["b"])
+
+
+def test_max_ancestors():
+    store = Store(["c"])
+    assert find_thread_root("c", store.lookup, store.fetch, 2) == ("b", ["b"])
@@ -0,0 +1,211 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+from cachetools import LRUCache
+from cachetools import TTLCache
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# A refresh that did not complete within this delay is scheduled again
+REFRESH_TIMEOUT = timedelta(minutes=10)
+
+
+class ActorCache(object):
+    """Two-tier actor cache: an in-process LRU (L1) in front of the `actors` collection (L2).
+
+    Actors are considered fresh for `ttl` seconds after being fetched. Once an actor is older than
+    `refresh_ratio * ttl`, it's still returned from the cache but `refresh` (set by the tasks) is called to fetch it
+    again in the background.
+
+    The IRIs not found in the collection (i.e. objects that are not actors) are remembered for `miss_ttl` seconds, and
+    the lookups that hit are counted in-process (written every `hits_flush_interval` seconds, `warm` loads the most
+    referenced actors).
+    """
+
+    def __init__(
+        self,
+        col: Any,
+        maxsize: int = 1024,
+        ttl: int = 3600 * 24,
+        refresh_ratio: float = 0.8,
+        miss_ttl: int = 60,
+        hits_flush_interval: float = 60.0,
+    ) -> None:
+        self.col = col
+        self.ttl = timedelta(seconds=ttl)
+        self.refresh_after = timedelta(seconds=ttl * refresh_ratio)
+        self.refresh: Optional[Callable[[str], None]] = None
+        self._cache: LRUCache = LRUCache(maxsize=maxsize)
+        # Actors whose refresh was scheduled (by this process or another one), kept in the L1 cache meanwhile
+        self._refreshing: TTLCache = TTLCache(
+            maxsize=maxsize, ttl=REFRESH_TIMEOUT.total_seconds()
+        )
+        self._misses: TTLCache = TTLCache(maxsize=maxsize * 4, ttl=miss_ttl)
+        self.hits_flush_interval = hits_flush_interval
+        self._hits: Dict[str, int] = {}
+        self._hits_flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def get(self, iri: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            cached: Optional[Tuple[datetime, Dict[str, Any]]] = self._cache.get(iri)
+            if not cached and iri in self._misses:
+                return None
+
+        if cached:
+            fetched_at, data = cached
+        else:
+            doc = self.col.find_one(
+                {"remote_id": iri, "data": {"$exists": True}},
+                projection=["data", "fetched_at"],
+            )
+            if not doc or not doc.get("fetched_at"):
+                with self._lock:
+                    self._misses[iri] = True
+                return None
+
+            fetched_at, data = doc["fetched_at"], doc["data"]
+            with self._lock:
+                self._cache[iri] = (fetched_at, data)
+
+        age = datetime.utcnow() - fetched_at
+        if age > self.ttl:
+            return None
+        if age > self.refresh_after:
+            self._refresh_ahead(iri, fetched_at)
+
+        self._hit(iri)
+        return data
+
+    def _hit(self, iri: str) -> None:
+        """Count a lookup that hit, the counts are written by batch (no write for each read)."""
+        with self._lock:
+            self._hits[iri] = self._hits.get(iri, 0) + 1
+            if time.monotonic() - self._hits_flushed_at < self.hits_flush_interval:
+                return
+            hits, self._hits = self._hits, {}
+            self._hits_flushed_at = time.monotonic()
+
+        try:
+            self.col.bulk_write(
+                [
+                    UpdateOne({"remote_id": iri}, {"$inc": {"hits": count}})
+                    for iri, count in hits.items()
+                ],
+                ordered=False,
+            )
+        except Exception:
+            logger.exception("failed to record the actors cache hits")
+
+    def set(
+        self,
+        iri: str,
+        data: Dict[str, Any],
+        validators: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """Cache a fetched actor, along with the `ETag`/`Last-Modified` of the response."""
+        now = datetime.utcnow()
+        self.col.update_one(
+            {"remote_id": iri},
+            {
+                "$set": {
+                    "remote_id": iri,
+                    "data": data,
+                    "validators": validators,
+                    "fetched_at": now,
+                    "refresh_at": None,
+                },
+                "$inc": {"hits": 1},
+            },
+            upsert=True,
+        )
+        with self._lock:
+            self._cache[iri] = (now, data)
+            self._refreshing.pop(iri, None)
+            self._misses.pop(iri, None)
+
+    def touch(self, iri: str, data: Dict[str, Any]) -> None:
+        """Mark a cached actor as fresh (i.e. it was revalidated)."""
+        now = datetime.utcnow()
+        self.col.update_one(
+            {"remote_id": iri},
+            {"$set": {"fetched_at": now, "refresh_at": None}, "$inc": {"hits": 1}},
+        )
+        with self._lock:
+            self._cache[iri] = (now, data)
+            self._refreshing.pop(iri, None)
+            self._misses.pop(iri, None)
+
+    def get_validators(
+        self, iri: str
+    ) -> Optional[Tuple[Dict[str, str], Dict[str, Any]]]:
+        """Returns the validators and the cached actor (even if expired), for revalidating it."""
+        doc = self.col.find_one(
+            {"remote_id": iri, "data": {"$exists": True}, "validators": {"$ne": None}},
+            projection=["data", "validators"],
+        )
+        if not doc:
+            return None
+
+        return doc["validators"], doc["data"]
+
+    def pop(self, iri: str) -> None:
+        with self._lock:
+            self._cache.pop(iri, None)
+            self._misses.pop(iri, None)
+
+    def warm(self) -> int:
+        """Load the most used fresh actors in the L1 cache, returns the number of actors loaded."""
+        q = {
+            "data": {"$exists": True},
+            "fetched_at": {"$gt": datetime.utcnow() - self.ttl},
+        }
+        count = 0
+        for doc in (
+            self.col.find(q, projection=["remote_id", "data", "fetched_at"])
+            .sort("hits", -1)
+            .limit(self._cache.maxsize)
+        ):
+            with self._lock:
+                self._cache[doc["remote_id"]] = (doc["fetched_at"], doc["data"])
+            count += 1
+
+        logger.info(f"{count} actors loaded in the cache")
+        return count
+
+    def _refresh_ahead(self, iri: str, fetched_at: datetime) -> None:
+        if not self.refresh:
+            return
+
+        with self._lock:
+            if iri in self._refreshing:
+                return
+            self._refreshing[iri] = True
+            # The actor may have been refreshed by another process, it's read again from the DB on the next call
+            # (then kept in the L1 cache until the refresh is done or times out)
+            self._cache.pop(iri, None)
+
+        # Only one process schedules the refresh
+        res = self.col.update_one(
+            {
+                "remote_id": iri,
+                "fetched_at": fetched_at,
+                "$or": [
+                    {"refresh_at": None},
+                    {"refresh_at": {"$lt": datetime.utcnow() - REFRESH_TIMEOUT}},
+                ],
+            },
+            {"$set": {"refresh_at": datetime.utcnow()}},
+        )
+        if res.modified_count:
+            logger.info(f"scheduling the refresh of {iri}")
+            self.refresh(iri)
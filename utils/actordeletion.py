@@ -0,0 +1,102 @@
+"""Cleanup of the activities of deleted remote actors (see `MicroblogPubBackend.delete_actors`)."""
+
+from collections import Counter
+from typing import Any
+from typing import List
+
+from little_boxes import activitypub as ap
+from little_boxes.activitypub import _to_list
+from pymongo import UpdateOne
+
+# `activitypub.Box` values
+INBOX = "inbox"
+OUTBOX = "outbox"
+
+
+def _decrement_counters(col: Any, actor_ids: List[str]) -> None:
+    """Decrement the counters of the objects liked, boosted and replied to by the deleted actors (like
+    `inbox_undo_like`, `inbox_undo_announce` and `_handle_replies_delete` do)."""
+    likes: Counter = Counter()
+    boosts: Counter = Counter()
+    replies: Counter = Counter()
+    q = {"box": INBOX, "activity.actor": {"$in": actor_ids}}
+    for doc in col.find(
+        {
+            **q,
+            "type": {
+                "$in": [ap.ActivityType.LIKE.value, ap.ActivityType.ANNOUNCE.value]
+            },
+            "meta.undo": {"$ne": True},
+        },
+        projection=["type", "activity.object", "meta.object"],
+    ):
+        obj = doc["activity"]["object"]
+        obj_id = obj.get("id") if isinstance(obj, dict) else obj
+        if ap.ActivityType.LIKE.value in _to_list(doc["type"]):
+            likes[obj_id] += 1
+        elif doc.get("meta", {}).get("object"):
+            # Announce are only counted once their batch is processed
+            boosts[obj_id] += 1
+
+    for doc in col.find(
+        {
+            **q,
+            "type": ap.ActivityType.CREATE.value,
+            "meta.deleted": {"$ne": True},
+            "activity.object.inReplyTo": {"$ne": None},
+        },
+        projection=["activity.object.inReplyTo"],
+    ):
+        replies[doc["activity"]["object"]["inReplyTo"]] += 1
+
+    updates = [
+        UpdateOne(
+            {"box": OUTBOX, "activity.object.id": obj_id},
+            {"$inc": {"meta.count_like": -count}},
+        )
+        for obj_id, count in likes.items()
+    ]
+    updates.extend(
+        UpdateOne(
+            {"activity.object.id": obj_id}, {"$inc": {"meta.count_boost": -count}}
+        )
+        for obj_id, count in boosts.items()
+    )
+    updates.extend(
+        UpdateOne(
+            {"activity.object.id": obj_id},
+            {"$inc": {"meta.count_reply": -count, "meta.count_direct_reply": -count}},
+        )
+        for obj_id, count in replies.items()
+    )
+    if updates:
+        col.bulk_write(updates, ordered=False)
+
+
+def delete_actors_activities(col: Any, actor_ids: List[str]) -> None:
+    """Delete the notes of the deleted actors, and undo their follows/likes/boosts (and our follows of them)."""
+    _decrement_counters(col, actor_ids)
+    col.update_many(
+        {
+            "box": INBOX,
+            "type": ap.ActivityType.CREATE.value,
+            "activity.actor": {"$in": actor_ids},
+        },
+        {"$set": {"meta.deleted": True}},
+    )
+    col.update_many(
+        {
+            "box": INBOX,
+            "type": {"$ne": ap.ActivityType.CREATE.value},
+            "activity.actor": {"$in": actor_ids},
+        },
+        {"$set": {"meta.undo": True, "meta.extra": "actor deleted"}},
+    )
+    col.update_many(
+        {
+            "box": OUTBOX,
+            "type": ap.ActivityType.FOLLOW.value,
+            "activity.object": {"$in": actor_ids},
+        },
+        {"$set": {"meta.undo": True, "meta.extra": "actor deleted"}},
+    )
@@ -0,0 +1,93 @@
+import logging
+from datetime import datetime
+from datetime import timedelta
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+
+class AnnounceBatches(object):
+    """Batches of the Announce of the same object (one document per object in `col`, unique on `object_id`).
+
+    A batch is processed at once `window` seconds after its first Announce (so the object is only fetched once). A
+    batch whose processing failed is put back (merged with the Announce received since), with its attempts counter.
+    """
+
+    def __init__(self, col: Any, window: int) -> None:
+        self.col = col
+        self.window = window
+
+    def _upsert(
+        self, object_id: str, update: Dict[str, Any], on_insert: Dict[str, Any]
+    ) -> bool:
+        """Returns True if the batch was created."""
+        for _ in range(3):
+            try:
+                res = self.col.update_one(
+                    {"object_id": object_id},
+                    {**update, "$setOnInsert": {"object_id": object_id, **on_insert}},
+                    upsert=True,
+                )
+                return bool(res.upserted_id)
+            except DuplicateKeyError:
+                # The batch was created by a concurrent worker in between, update it (unless it's already processed)
+                res = self.col.update_one({"object_id": object_id}, update)
+                if res.matched_count:
+                    return False
+
+        raise RuntimeError(f"failed to update the Announce batch of {object_id}")
+
+    def add(self, object_id: str, announce_id: str) -> bool:
+        """Add the Announce to the batch of its object, returns True if the batch was created (its processing must
+        then be scheduled in `window` seconds)."""
+        now = datetime.utcnow()
+        return self._upsert(
+            object_id,
+            {"$addToSet": {"activities": announce_id}},
+            {
+                "created_at": now,
+                "attempts": 0,
+                "scheduled_at": now + timedelta(seconds=self.window),
+            },
+        )
+
+    def take(self, object_id: str) -> Optional[Dict[str, Any]]:
+        """Remove the batch of the object for processing it (None if it was already taken)."""
+        return self.col.find_one_and_delete({"object_id": object_id})
+
+    def put_back(self, batch: Dict[str, Any], attempts: int, delay: int) -> None:
+        """Put back a batch whose processing failed, to be processed again in `delay` seconds."""
+        self._upsert(
+            batch["object_id"],
+            {
+                "$addToSet": {"activities": {"$each": batch["activities"]}},
+                "$max": {"attempts": attempts},
+                "$set": {"scheduled_at": datetime.utcnow() + timedelta(seconds=delay)},
+            },
+            {"created_at": batch["created_at"]},
+        )
+
+    def overdue(self, delay: timedelta = timedelta(minutes=5)) -> List[str]:
+        """Returns the objects whose batch should have been processed `delay` ago (i.e. the task was lost), they are
+        scheduled again (and not returned by the next calls before `delay`)."""
+        now = datetime.utcnow()
+        cutoff = now - delay
+        q = {
+            "$or": [
+                {"scheduled_at": {"$lt": cutoff}},
+                {"scheduled_at": {"$exists": False}, "created_at": {"$lt": cutoff}},
+            ]
+        }
+        out = []
+        for batch in self.col.find(q, projection=["object_id"]):
+            res = self.col.update_one(
+                {"_id": batch["_id"], "$or": q["$or"]}, {"$set": {"scheduled_at": now}}
+            )
+            if res.modified_count:
+                out.append(batch["object_id"])
+        return out
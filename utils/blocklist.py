@@ -0,0 +1,99 @@
+import logging
+import time
+from typing import Any
+from typing import Callable
+from typing import FrozenSet
+from typing import Iterable
+from typing import Optional
+from urllib.parse import urlparse
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+
+class Blocklist(object):
+    """In-memory set of the blocked actors and domains.
+
+    The blocked actors are reloaded using `loader` at most every `refresh_interval` seconds. `invalidate` bumps a
+    generation counter (stored in `generations`, and checked at most every `check_interval` seconds), so every
+    process reloads the list right after a (un)block. Blocking a domain also blocks its subdomains.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[], Iterable[str]],
+        domains: Iterable[str] = (),
+        generations: Any = None,
+        refresh_interval: int = 30,
+        check_interval: float = 1.0,
+    ) -> None:
+        self.loader = loader
+        self.domains: FrozenSet[str] = frozenset(d.lower() for d in domains)
+        self.generations = generations
+        self.refresh_interval = refresh_interval
+        self.check_interval = check_interval
+        self._actors: FrozenSet[str] = frozenset()
+        self._loaded_at: Optional[float] = None
+        self._checked_at = 0.0
+        self._generation = 0
+
+    def invalidate(self) -> None:
+        self._loaded_at = None
+        if self.generations is None:
+            return
+
+        doc = self.generations.find_one_and_update(
+            {"_id": "blocklist"},
+            {"$inc": {"generation": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        self._generation = doc["generation"]
+        self._checked_at = time.monotonic()
+
+    def _generation_changed(self, now: float) -> bool:
+        if self.generations is None or now - self._checked_at < self.check_interval:
+            return False
+
+        self._checked_at = now
+        doc = self.generations.find_one({"_id": "blocklist"})
+        generation = doc["generation"] if doc else 0
+        changed = generation != self._generation
+        self._generation = generation
+        return changed
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if (
+            not self._generation_changed(now)
+            and self._loaded_at is not None
+            and now - self._loaded_at < self.refresh_interval
+        ):
+            return
+
+        self._actors = frozenset(self.loader())
+        self._loaded_at = now
+        logger.debug(f"blocklist reloaded, {len(self._actors)} actors blocked")
+
+    def is_domain_blocked(self, host: Optional[str]) -> bool:
+        if not host or not self.domains:
+            return False
+
+        host = host.lower()
+        parts = host.split(".")
+        for i in range(len(parts) - 1):
+            if ".".join(parts[i:]) in self.domains:
+                return True
+
+        return False
+
+    def is_blocked(self, actor_id: Optional[str]) -> bool:
+        if not actor_id:
+            return False
+
+        if self.is_domain_blocked(urlparse(actor_id).hostname):
+            return True
+
+        self._maybe_reload()
+        return actor_id in self._actors
@@ -0,0 +1,52 @@
+"""Dependencies of the cached pages (see `utils.pagecache`) changed by an activity."""
+
+from typing import Callable
+from typing import List
+
+from little_boxes import activitypub as ap
+
+
+def activity_deps(
+    activity: ap.BaseActivity,
+    outbox: bool,
+    base_url: str,
+    note_deps: Callable[[str], List[str]],
+) -> List[str]:
+    """Returns the dependencies of the cached pages changed by an activity: the IDs of the objects (whose counters
+    changed) and the names of the collections (`outbox`, `followers`, `following`, `liked`).
+
+    `note_deps` returns the dependencies of a stored note (the note and its parent, or nothing if it's unknown).
+    """
+    if activity.has_type([ap.ActivityType.LIKE, ap.ActivityType.ANNOUNCE]):
+        if outbox:
+            if activity.has_type(ap.ActivityType.LIKE):
+                return ["liked", activity.get_object_id()]
+            return ["outbox", activity.get_object_id()]
+        if activity.get_object_id().startswith(base_url):
+            return [activity.get_object_id()]
+    elif activity.has_type(ap.ActivityType.UNDO):
+        obj = activity.get_object()
+        if obj.has_type(ap.ActivityType.FOLLOW):
+            return ["following" if outbox else "followers"]
+        if obj.has_type([ap.ActivityType.LIKE, ap.ActivityType.ANNOUNCE]):
+            return activity_deps(obj, outbox, base_url, note_deps)
+    elif activity.has_type(ap.ActivityType.DELETE):
+        deps = note_deps(activity.get_object_id())
+        if outbox:
+            deps.append("outbox")
+        return deps
+    elif activity.has_type(ap.ActivityType.UPDATE):
+        if outbox:
+            # Either a note or the profile
+            return [activity.get_object_id()]
+        return note_deps(activity.get_object_id())
+    elif activity.has_type(ap.ActivityType.CREATE):
+        note = activity.get_object()
+        if outbox:
+            return ["outbox", note.id, note.inReplyTo]
+        if note.inReplyTo and note.inReplyTo.startswith(base_url):
+            return [note.inReplyTo]
+    elif activity.has_type(ap.ActivityType.ACCEPT):
+        return ["followers" if outbox else "following"]
+
+    return []
@@ -0,0 +1,188 @@
+import logging
+from datetime import datetime
+from datetime import timedelta
+from enum import Enum
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker(object):
+    """Per-instance delivery health, stored in the `delivery` field of the instance document.
+
+    After `failure_threshold` consecutive failures, the circuit is opened and the deliveries to the instance are
+    parked. After `open_timeout`, a single delivery is allowed (half-open): the circuit is closed if it succeeds,
+    and opened again if it fails.
+    """
+
+    def __init__(
+        self,
+        col: Any,
+        failure_threshold: int = 10,
+        open_timeout: timedelta = timedelta(minutes=30),
+        success_interval: timedelta = timedelta(minutes=1),
+    ) -> None:
+        self.col = col
+        self.failure_threshold = failure_threshold
+        self.open_timeout = open_timeout
+        # The last success of a healthy instance is only updated once per interval
+        self.success_interval = success_interval
+
+    def allow(self, host: str) -> bool:
+        return self.acquire(host) is not None
+
+    def acquire(self, host: str) -> Optional[CircuitState]:
+        """Returns `CLOSED` if the deliveries are allowed, `HALF_OPEN` if a single delivery (the probe) is allowed, and
+        None if the deliveries must be parked."""
+        doc = self.col.find_one({"instance": host}, projection=["delivery"]) or {}
+        delivery = doc.get("delivery", {})
+        state = delivery.get("state", CircuitState.CLOSED.value)
+        if state == CircuitState.CLOSED.value:
+            return CircuitState.CLOSED
+
+        # Let a single probe go through once the timeout is over (or if the last probe never completed)
+        since = delivery.get("probe_at") or delivery.get("opened_at")
+        if since and datetime.utcnow() - since < self.open_timeout:
+            return None
+
+        res = self.col.update_one(
+            {
+                "instance": host,
+                "delivery.state": state,
+                "delivery.probe_at": delivery.get("probe_at"),
+            },
+            {
+                "$set": {
+                    "delivery.state": CircuitState.HALF_OPEN.value,
+                    "delivery.probe_at": datetime.utcnow(),
+                }
+            },
+        )
+        return CircuitState.HALF_OPEN if res.modified_count else None
+
+    def admit(self, hosts: List[str]) -> List[bool]:
+        """Returns, for each of the (batched) deliveries to `hosts`, whether it can be sent.
+
+        The circuit of each instance is only checked once; if it's half-open, only the first delivery is sent (the
+        probe), the other ones must be parked.
+        """
+        states = {host: self.acquire(host) for host in set(hosts)}
+        out = []
+        for host in hosts:
+            state = states[host]
+            out.append(state is not None)
+            if state == CircuitState.HALF_OPEN:
+                states[host] = None
+        return out
+
+    def record_batch(self, outcomes: List[Tuple[str, Optional[bool]]]) -> List[str]:
+        """Record the outcomes of a batch of deliveries (`(host, alive)`, `alive` being None if the delivery neither
+        succeeded nor failed), returns the instances that recovered.
+
+        A batch counts as a single failure per instance (a batch may hold many deliveries to the same instance, all
+        sent at the same time), and an instance that answered to any of them is alive.
+        """
+        alive: Dict[str, bool] = {}
+        for host, ok in outcomes:
+            if ok is not None:
+                alive[host] = alive.get(host, False) or ok
+
+        recovered = []
+        for host, ok in alive.items():
+            if ok:
+                if self.record_success(host):
+                    recovered.append(host)
+            else:
+                self.record_failure(host)
+        return recovered
+
+    def probes_due(self) -> List[str]:
+        """Returns the instances whose circuit is not closed, and that are due for a probe."""
+        cutoff = datetime.utcnow() - self.open_timeout
+        q = {
+            "delivery.state": {
+                "$in": [CircuitState.OPEN.value, CircuitState.HALF_OPEN.value]
+            },
+            "$or": [
+                {"delivery.probe_at": {"$lt": cutoff}},
+                {"delivery.probe_at": None, "delivery.opened_at": {"$lt": cutoff}},
+            ],
+        }
+        return [doc["instance"] for doc in self.col.find(q, projection=["instance"])]
+
+    def record_success(self, host: str) -> bool:
+        """Returns True if the circuit was not closed (i.e. the instance recovered).
+
+        Nothing is written if the circuit is already closed without failures (and the last success is recent).
+        """
+        doc = self.col.find_one({"instance": host}, projection=["delivery"]) or {}
+        delivery = doc.get("delivery") or {}
+        last_success = delivery.get("last_success")
+        if (
+            delivery.get("state") == CircuitState.CLOSED.value
+            and not delivery.get("consecutive_failures")
+            and last_success
+            and datetime.utcnow() - last_success < self.success_interval
+        ):
+            return False
+
+        doc = self.col.find_one_and_update(
+            {"instance": host},
+            {
+                "$set": {
+                    "delivery.state": CircuitState.CLOSED.value,
+                    "delivery.consecutive_failures": 0,
+                    "delivery.last_success": datetime.utcnow(),
+                    "delivery.probe_at": None,
+                }
+            },
+            projection=["delivery"],
+            upsert=True,
+        )
+        state = ((doc or {}).get("delivery") or {}).get("state")
+        recovered = state not in [None, CircuitState.CLOSED.value]
+        if recovered:
+            logger.info(f"{host} recovered, closing the circuit")
+        return recovered
+
+    def record_failure(self, host: str, count: int = 1) -> None:
+        now = datetime.utcnow()
+        doc = self.col.find_one_and_update(
+            {"instance": host},
+            {
+                "$inc": {"delivery.consecutive_failures": count},
+                "$set": {"delivery.last_failure": now},
+            },
+            projection=["delivery"],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        delivery = doc.get("delivery", {})
+        state = delivery.get("state", CircuitState.CLOSED.value)
+        if state == CircuitState.HALF_OPEN.value or (
+            state == CircuitState.CLOSED.value
+            and delivery["consecutive_failures"] >= self.failure_threshold
+        ):
+            logger.warning(f"opening the circuit for {host}")
+            self.col.update_one(
+                {"instance": host},
+                {
+                    "$set": {
+                        "delivery.state": CircuitState.OPEN.value,
+                        "delivery.opened_at": now,
+                        "delivery.probe_at": None,
+                    }
+                },
+            )
@@ -0,0 +1,31 @@
+import hashlib
+from typing import Set
+
+
+def _hash(iri: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(iri.encode("utf-8"), digest_size=8).digest(), "big"
+    )
+
+
+class SeenFilter(object):
+    """Bounded in-memory set of recently seen IRIs.
+
+    IRIs are stored as 64-bit hashes in two generations: when the current generation is full, it replaces the
+    previous one (and the oldest IRIs are forgotten).
+    """
+
+    def __init__(self, maxsize: int = 100000) -> None:
+        self.maxsize = maxsize
+        self._current: Set[int] = set()
+        self._previous: Set[int] = set()
+
+    def __contains__(self, iri: str) -> bool:
+        h = _hash(iri)
+        return h in self._current or h in self._previous
+
+    def add(self, iri: str) -> None:
+        if len(self._current) >= self.maxsize // 2:
+            self._previous = self._current
+            self._current = set()
+        self._current.add(_hash(iri))
@@ -0,0 +1,29 @@
+import bisect
+import hashlib
+from typing import List
+from typing import Tuple
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big"
+    )
+
+
+class HashRing(object):
+    """Consistent hashing ring, maps a key to one of the nodes.
+
+    Each node is placed `replicas` times on the ring so the keys are evenly distributed, and adding/removing a node
+    only moves the keys of this node.
+    """
+
+    def __init__(self, nodes: List[str], replicas: int = 1024) -> None:
+        self.nodes = nodes
+        self._ring: List[Tuple[int, str]] = sorted(
+            (_hash(f"{node}-{i}"), node) for node in nodes for i in range(replicas)
+        )
+        self._keys = [h for h, _ in self._ring]
+
+    def get_node(self, key: str) -> str:
+        idx = bisect.bisect(self._keys, _hash(key)) % len(self._ring)
+        return self._ring[idx][1]
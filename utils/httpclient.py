@@ -0,0 +1,250 @@
+"""Shared outbound HTTP client."""
+
+import logging
+import socket
+import threading
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from urllib.parse import urlparse
+
+import requests
+import urllib3.util.connection
+from cachetools import TTLCache
+from pymongo import UpdateOne
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connection import HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.connectionpool import HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError
+from urllib3.exceptions import NewConnectionError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 5 * 1024 * 1024
+
+
+class ResponseTooLargeError(requests.RequestException):
+    pass
+
+
+_RESOLVER_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=300)
+_RESOLVER_LOCK = threading.Lock()
+
+
+def _resolve(host: str, port: int) -> List[str]:
+    """Returns the addresses of the host (in the order returned by the resolver, restricted like urllib3 does)."""
+    family = urllib3.util.connection.allowed_gai_family()
+    addresses: List[str] = []
+    for res in socket.getaddrinfo(host, port, family, socket.SOCK_STREAM):
+        ip = str(res[4][0])
+        if ip not in addresses:
+            addresses.append(ip)
+    return addresses
+
+
+class _CachedResolverMixin(object):
+    """Caches the DNS resolution of the connections (the TLS SNI/cert still uses the hostname).
+
+    Each address is tried in turn (like urllib3 does), the one that worked is tried first next time.
+    """
+
+    _dns_host: str
+    port: int
+
+    def _new_conn(self) -> socket.socket:
+        host = self._dns_host
+        with _RESOLVER_LOCK:
+            addresses = _RESOLVER_CACHE.get(host)
+
+        if not addresses:
+            try:
+                addresses = _resolve(host, self.port)
+            except socket.gaierror:
+                addresses = []
+            if not addresses:
+                # Let urllib3 resolve it (and raise the resolution error)
+                return super()._new_conn()  # type: ignore
+            with _RESOLVER_LOCK:
+                _RESOLVER_CACHE[host] = addresses
+
+        err: Optional[Exception] = None
+        for ip in addresses:
+            self._dns_host = ip
+            try:
+                conn = super()._new_conn()  # type: ignore
+            except (NewConnectionError, ConnectTimeoutError) as e:
+                err = e
+                continue
+            finally:
+                self._dns_host = host
+
+            if ip != addresses[0]:
+                with _RESOLVER_LOCK:
+                    _RESOLVER_CACHE[host] = [ip] + [a for a in addresses if a != ip]
+            return conn
+
+        # The addresses may have changed, resolve them again next time
+        with _RESOLVER_LOCK:
+            _RESOLVER_CACHE.pop(host, None)
+        assert err is not None
+        raise err
+
+
+class _HTTPConnection(_CachedResolverMixin, HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_CachedResolverMixin, HTTPSConnection):
+    pass
+
+
+class _HTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _HTTPConnection
+
+
+class _HTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _HTTPSConnection
+
+
+class CachedResolverAdapter(HTTPAdapter):
+    """Transport adapter whose connections cache the DNS resolution (only for the sessions it's mounted on)."""
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _HTTPConnectionPool,
+            "https": _HTTPSConnectionPool,
+        }
+
+
+def _content_length(resp: requests.Response) -> Optional[int]:
+    """Returns the announced size of the response, None if it's unknown (or invalid, the size is then only checked
+    while streaming the body)."""
+    try:
+        length = int(resp.headers.get("Content-Length") or "")
+    except ValueError:
+        return None
+    return length if length >= 0 else None
+
+
+class HTTPClient(object):
+    """HTTP client shared by all the outbound requests (deliveries, fetches, media, OG metadata).
+
+    Keeps a pool of keep-alive connections per host, enforces connect/read timeouts and a response size limit, and
+    records per-host latency (periodically flushed to the `egress` field of the instance document).
+    """
+
+    def __init__(
+        self,
+        user_agent: str,
+        stats_col: Any = None,
+        connect_timeout: float = 5,
+        read_timeout: float = 15,
+        max_size: int = DEFAULT_MAX_SIZE,
+        pool_connections: int = 500,
+        pool_maxsize: int = 10,
+        flush_interval: int = 30,
+    ) -> None:
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_size = max_size
+        self.stats_col = stats_col
+        self.flush_interval = flush_interval
+
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = user_agent
+        adapter = CachedResolverAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._stats_lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    def request(
+        self, method: str, url: str, max_size: Optional[int] = None, **kwargs: Any
+    ) -> requests.Response:
+        """Performs the request, the body is read (up to `max_size` bytes) before returning."""
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlparse(url).hostname or ""
+        start = time.monotonic()
+        try:
+            resp = self.session.request(method, url, stream=True, **kwargs)
+            with resp:
+                self._read(resp, max_size or self.max_size)
+        except requests.RequestException:
+            self._record(host, time.monotonic() - start, error=True)
+            raise
+
+        self._record(host, time.monotonic() - start, error=resp.status_code >= 500)
+        return resp
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def _read(self, resp: requests.Response, max_size: int) -> None:
+        url = resp.url
+        length = _content_length(resp)
+        if length is not None and length > max_size:
+            raise ResponseTooLargeError(f"{url} is too large")
+
+        size = 0
+        chunks = []
+        for chunk in resp.iter_content(64 * 1024):
+            size += len(chunk)
+            if size > max_size:
+                raise ResponseTooLargeError(f"{url} is too large")
+            chunks.append(chunk)
+
+        resp._content = b"".join(chunks)
+
+    def _record(self, host: str, duration: float, error: bool) -> None:
+        with self._stats_lock:
+            stats = self._stats.setdefault(
+                host, {"requests": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0}
+            )
+            stats["requests"] += 1
+            stats["errors"] += int(error)
+            stats["total_time"] += duration
+            stats["max_time"] = max(stats["max_time"], duration)
+
+            if time.monotonic() - self._flushed_at < self.flush_interval:
+                return
+
+            pending, self._stats = self._stats, {}
+            self._flushed_at = time.monotonic()
+
+        self._flush(pending)
+
+    def _flush(self, pending: Dict[str, Dict[str, float]]) -> None:
+        updates = [
+            UpdateOne(
+                {"instance": host},
+                {
+                    "$inc": {
+                        "egress.requests": stats["requests"],
+                        "egress.errors": stats["errors"],
+                        "egress.total_time": stats["total_time"],
+                    },
+                    "$max": {"egress.max_time": stats["max_time"]},
+                },
+                upsert=True,
+            )
+            for host, stats in pending.items()
+            if host
+        ]
+        if self.stats_col is None or not updates:
+            return
+
+        try:
+            self.stats_col.bulk_write(updates, ordered=False)
+        except Exception:
+            logger.exception("failed to save the HTTP client stats")
@@ -0,0 +1,212 @@
+"""HTTP Signatures helpers (backed by a public key store)."""
+
+import base64
+import logging
+from datetime import datetime
+from datetime import timedelta
+from email.utils import formatdate
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+from urllib.parse import urlparse
+
+from cachetools import TTLCache
+from Crypto.Hash import SHA256
+from Crypto.Signature import PKCS1_v1_5
+from little_boxes.httpsig import _body_digest
+from little_boxes.httpsig import _build_signed_string
+from little_boxes.httpsig import _parse_sig_header
+from little_boxes.httpsig import _verify_h
+from little_boxes.key import Key
+from requests.auth import AuthBase
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+
+def _load_key(key_id: str, data: Dict[str, Any]) -> Tuple[str, str]:
+    """Returns the owner and the PEM of the requested key from a dereferenced keyId (an actor or a `Key`)."""
+    if data.get("type") == "Key":
+        if data["id"] != key_id:
+            raise ValueError(
+                f"failed to fetch requested key {key_id}: got {data['id']}"
+            )
+        return data["owner"], data["publicKeyPem"]
+
+    pub = data["publicKey"]
+    if pub["id"] != key_id:
+        raise ValueError(f"failed to fetch requested key {key_id}: got {pub['id']}")
+    return data["id"], pub["publicKeyPem"]
+
+
+class PublicKeyStore(object):
+    """Public keys used for verifying HTTP signatures, cached in-process and in the `actors` collection.
+
+    A key is fetched at most once every `refetch_interval` seconds (whether the fetch failed or not), so requests
+    with bad signatures cannot trigger a fetch of the key each time.
+    """
+
+    def __init__(
+        self,
+        col: Any,
+        fetcher: Callable[[str], Dict[str, Any]],
+        maxsize: int = 1024,
+        ttl: int = 3600 * 24,
+        refetch_interval: int = 300,
+    ) -> None:
+        self.col = col
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._fetched: TTLCache = TTLCache(maxsize=maxsize, ttl=refetch_interval)
+
+    def _fetch(self, key_id: str) -> Key:
+        if key_id in self._fetched:
+            raise ValueError(f"{key_id} was fetched recently")
+        self._fetched[key_id] = True
+
+        owner, pem = _load_key(key_id, self.fetcher(key_id))
+        k = Key(owner)
+        k.load_pub(pem)
+
+        self.col.update_one(
+            {"remote_id": owner},
+            {
+                "$set": {
+                    "remote_id": owner,
+                    "public_key": {
+                        "id": key_id,
+                        "owner": owner,
+                        "pem": pem,
+                        "fetched_at": datetime.utcnow(),
+                    },
+                }
+            },
+            upsert=True,
+        )
+        self.cache[key_id] = k
+        return k
+
+    def get(self, key_id: str, refresh: bool = False) -> Tuple[Key, bool]:
+        """Returns the key and whether it was already cached."""
+        if refresh:
+            return self._fetch(key_id), False
+
+        k = self.lookup(key_id)
+        if k:
+            return k, True
+
+        return self._fetch(key_id), False
+
+    def lookup(self, key_id: str) -> Optional[Key]:
+        """Returns the key if it's cached (without fetching it)."""
+        k = self.cache.get(key_id)
+        if k:
+            return k
+
+        doc = self.col.find_one(
+            {
+                "public_key.id": key_id,
+                "public_key.fetched_at": {
+                    "$gt": datetime.utcnow() - timedelta(seconds=self.ttl)
+                },
+            }
+        )
+        if not doc:
+            return None
+
+        k = Key(doc["public_key"]["owner"])
+        k.load_pub(doc["public_key"]["pem"])
+        self.cache[key_id] = k
+        return k
+
+    def verify_cached(self, method: str, path: str, headers: Any, body: bytes) -> bool:
+        """Returns True if the request is signed by an already known key (the key is never fetched, so this is cheap
+        enough to be done before the request is accepted)."""
+        hsig = _parse_sig_header(headers.get("Signature"))
+        if not hsig or not hsig.get("keyId"):
+            return False
+
+        k = self.lookup(hsig["keyId"])
+        if not k:
+            return False
+
+        signed_string = _build_signed_string(
+            hsig["headers"], method, path, headers, _body_digest(body)
+        )
+        try:
+            signature = base64.b64decode(hsig["signature"])
+            return _verify_h(signed_string, signature, k.pubkey)
+        except Exception:
+            logger.exception("failed to verify the signature")
+            return False
+
+    def verify_request(self, method: str, path: str, headers: Any, body: bytes) -> bool:
+        hsig = _parse_sig_header(headers.get("Signature"))
+        if not hsig:
+            logger.debug("no signature in header")
+            return False
+        logger.debug(f"hsig={hsig}")
+
+        signed_string = _build_signed_string(
+            hsig["headers"], method, path, headers, _body_digest(body)
+        )
+        signature = base64.b64decode(hsig["signature"])
+
+        k, cached = self.get(hsig["keyId"])
+        if _verify_h(signed_string, signature, k.pubkey):
+            return True
+
+        if not cached or hsig["keyId"] in self._fetched:
+            return False
+
+        # The key may have been rotated since we cached it, re-fetch it once
+        logger.info(
+            f"failed to verify request with cached key {hsig['keyId']}, refreshing it"
+        )
+        k, _ = self.get(hsig["keyId"], refresh=True)
+        return _verify_h(signed_string, signature, k.pubkey)
+
+
+class HTTPSigDigestAuth(AuthBase):
+    """Requests auth for signing a request with HTTP signatures, using the precomputed `Digest` of the body (so the
+    body is only hashed once when sent to multiple recipients)."""
+
+    SIGNED_HEADERS = "(request-target) user-agent host date digest content-type"
+
+    def __init__(self, key: Key, digest: str) -> None:
+        self.key = key
+        self.digest = digest
+
+    def signed_headers(self, method: str, url: str, headers: Any) -> Dict[str, str]:
+        """Returns the Digest/Date/Host/Signature headers for the request (`headers` must contain the User-Agent
+        and the Content-Type)."""
+        parsed = urlparse(url)
+        path = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+        out = {
+            "Digest": self.digest,
+            "Date": formatdate(usegmt=True),
+            "Host": parsed.netloc,
+        }
+        signed_string = _build_signed_string(
+            self.SIGNED_HEADERS,
+            method,
+            path,
+            CaseInsensitiveDict({**headers, **out}),
+            self.digest,
+        )
+        h = SHA256.new()
+        h.update(signed_string.encode("utf-8"))
+        sig = base64.b64encode(PKCS1_v1_5.new(self.key.privkey).sign(h)).decode("utf-8")
+
+        out["Signature"] = (
+            f'keyId="{self.key.key_id()}",algorithm="rsa-sha256",'
+            f'headers="{self.SIGNED_HEADERS}",signature="{sig}"'
+        )
+        return out
+
+    def __call__(self, r):
+        r.headers.update(self.signed_headers(r.method, r.url, r.headers))
+        return r
@@ -0,0 +1,83 @@
+import logging
+from datetime import datetime
+from datetime import timedelta
+from typing import Any
+from typing import Callable
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class InboxHolds(object):
+    """Per-actor holds, ordering the processing of the inbox activities of an actor.
+
+    While an activity of an actor is retried, the later activities of the actor are queued behind it (so an `Undo` is
+    never processed before its `Like`), and processed one by one once it's done. A hold older than `timeout` is
+    released (the queued activities are then processed out of order).
+
+    Only used with `INBOX_SHARDS`: the activities of an actor are processed by a single worker, so the holds of an
+    actor are only updated by this worker. `spawn` (set by the tasks) processes a queued activity of an actor.
+    """
+
+    def __init__(self, col: Any, timeout: timedelta = timedelta(hours=1)) -> None:
+        self.col = col
+        self.timeout = timeout
+        self.spawn: Optional[Callable[[str, str], None]] = None
+
+    def is_held(self, actor_id: str, iri: str) -> bool:
+        """Returns True if an earlier activity of the actor is being retried, the activity is then queued behind it."""
+        hold = self.col.find_one({"actor_id": actor_id})
+        if not hold or hold["iri"] == iri:
+            return False
+
+        if hold["held_at"] < datetime.utcnow() - self.timeout:
+            logger.warning(
+                f"{hold['iri']} is blocking {actor_id} for too long, releasing"
+            )
+            self.col.delete_one({"_id": hold["_id"]})
+            for pending in hold["pending"]:
+                self._spawn(actor_id, pending)
+            return False
+
+        logger.info(f"{actor_id} is held by {hold['iri']}, queuing {iri}")
+        self.col.update_one({"_id": hold["_id"]}, {"$push": {"pending": iri}})
+        return True
+
+    def hold(self, actor_id: str, iri: str) -> None:
+        """Hold the later activities of the actor while `iri` is retried."""
+        self.col.update_one(
+            {"actor_id": actor_id},
+            {
+                "$setOnInsert": {
+                    "actor_id": actor_id,
+                    "iri": iri,
+                    "pending": [],
+                    "held_at": datetime.utcnow(),
+                }
+            },
+            upsert=True,
+        )
+
+    def release(self, actor_id: str, iri: str) -> None:
+        """Hand the hold to the next queued activity of the actor (so the ones received meanwhile still wait)."""
+        hold = self.col.find_one({"actor_id": actor_id, "iri": iri})
+        if not hold:
+            return
+
+        if not hold["pending"]:
+            self.col.delete_one({"_id": hold["_id"]})
+            return
+
+        next_iri = hold["pending"][0]
+        self.col.update_one(
+            {"_id": hold["_id"]},
+            {
+                "$set": {"iri": next_iri, "held_at": datetime.utcnow()},
+                "$pop": {"pending": -1},
+            },
+        )
+        self._spawn(actor_id, next_iri)
+
+    def _spawn(self, actor_id: str, iri: str) -> None:
+        if self.spawn:
+            self.spawn(actor_id, iri)
@@ -0,0 +1,148 @@
+import json
+import logging
+import random
+from datetime import datetime
+from datetime import timedelta
+from enum import Enum
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class IntakeStatus(Enum):
+    PENDING = "pending"
+    PROCESSING = "processing"
+    # Kept for inspection (removed with the other intake requests after a week)
+    FAILED = "failed"
+
+
+def parse_body(body: bytes) -> Optional[Dict[str, Any]]:
+    """Returns the activity of an inbox request, None if it's not a JSON object with an ID."""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("id"), str):
+        return None
+
+    return data
+
+
+class InboxIntake(object):
+    """Raw inbox requests (stored by /inbox in fast-ack mode), verified and processed by the workers.
+
+    A request is claimed (`PROCESSING`) by the worker processing it, and removed once processed. A failed request is
+    retried with a backoff (`PENDING`), up to `max_retries` times (`FAILED`). The requests not picked up (or whose
+    worker died) within `grace` are returned by `due`.
+    """
+
+    def __init__(
+        self, col: Any, grace: timedelta = timedelta(minutes=5), max_retries: int = 9
+    ) -> None:
+        self.col = col
+        self.grace = grace
+        self.max_retries = max_retries
+
+    def enqueue(
+        self, method: str, path: str, headers: Any, body: bytes, verified: bool = False
+    ) -> str:
+        now = datetime.utcnow()
+        return str(
+            self.col.insert_one(
+                {
+                    "method": method,
+                    "path": path,
+                    # Stored as a list as headers name are not valid MongoDB keys
+                    "headers": list(headers.items()),
+                    "body": body,
+                    "verified": verified,
+                    "status": IntakeStatus.PENDING.value,
+                    "received_at": now,
+                    "attempts": 0,
+                    "next_attempt_at": now + self.grace,
+                }
+            ).inserted_id
+        )
+
+    def process(
+        self, intake_id: Any, handler: Callable[[Dict[str, Any]], bool]
+    ) -> None:
+        """Claim the request and process it with `handler` (which returns False if the request cannot be verified,
+        it's then dropped)."""
+        doc = self.col.find_one_and_update(
+            {"_id": intake_id, "status": IntakeStatus.PENDING.value},
+            {
+                "$set": {
+                    "status": IntakeStatus.PROCESSING.value,
+                    "started_at": datetime.utcnow(),
+                }
+            },
+        )
+        if not doc:
+            logger.info(f"intake {intake_id} already processed")
+            return
+
+        try:
+            if not handler(doc):
+                logger.info(
+                    f"dropping intake {intake_id}, failed to verify the request"
+                )
+            self.col.delete_one({"_id": doc["_id"]})
+        except Exception:
+            logger.exception(f"failed to process intake {intake_id}")
+            attempts = doc.get("attempts", 0) + 1
+            if attempts > self.max_retries:
+                logger.warning(
+                    f"giving up on intake {intake_id} after {attempts} attempts"
+                )
+                status = IntakeStatus.FAILED
+            else:
+                status = IntakeStatus.PENDING
+            self.col.update_one(
+                {"_id": doc["_id"]},
+                {
+                    "$set": {
+                        "status": status.value,
+                        "attempts": attempts,
+                        "next_attempt_at": datetime.utcnow()
+                        + timedelta(seconds=int(random.uniform(2, 4) ** attempts)),
+                    }
+                },
+            )
+
+    def due(self) -> List[Dict[str, Any]]:
+        """Returns the requests that are due for a retry, that were never picked up (or whose worker died).
+
+        They are not returned again until the grace delay (processing a request that was already processed is a
+        no-op)."""
+        now = datetime.utcnow()
+        q = {
+            "$or": [
+                {
+                    "status": IntakeStatus.PENDING.value,
+                    "next_attempt_at": {"$lte": now},
+                },
+                {
+                    "status": IntakeStatus.PROCESSING.value,
+                    "started_at": {"$lt": now - self.grace},
+                },
+            ]
+        }
+        out = []
+        for doc in self.col.find(q, projection=["_id", "headers"]):
+            res = self.col.update_one(
+                {"_id": doc["_id"], "$or": q["$or"]},
+                {
+                    "$set": {
+                        "status": IntakeStatus.PENDING.value,
+                        "next_attempt_at": now + self.grace,
+                    }
+                },
+            )
+            if res.modified_count:
+                out.append(doc)
+        return out
@@ -0,0 +1,111 @@
+from datetime import datetime
+from enum import Enum
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from urllib.parse import urlparse
+
+from pymongo import UpdateOne
+
+
+class DeliveryStatus(Enum):
+    PENDING = "pending"
+    PROCESSING = "processing"
+    DONE = "done"
+    FAILED = "failed"
+    # Waiting for the instance to recover
+    PARKED = "parked"
+
+
+class DeliveryLedger(object):
+    """Signed payloads of the outgoing activities, and the deliveries ledger (one delivery per payload and recipient).
+
+    Saving the payload of an activity, and enqueuing its deliveries, can be done again (i.e. when the task is retried)
+    without sending the activity twice to the same inbox.
+    """
+
+    def __init__(self, payloads: Any, deliveries: Any) -> None:
+        self.payloads = payloads
+        self.deliveries = deliveries
+
+    def save_payload(
+        self,
+        activity_id: str,
+        serialize: Callable[[], bytes],
+        digest: Callable[[bytes], str],
+    ) -> Any:
+        """Returns the ID of the payload of the activity, `serialize` (which signs the activity) is only called if the
+        payload is not saved yet.
+
+        The payload of an activity is only saved by the task sending it (an activity is never sent by concurrent
+        tasks), so no unique index is needed.
+        """
+        doc = self.payloads.find_one({"activity_id": activity_id}, projection=["_id"])
+        if doc:
+            return doc["_id"]
+
+        body = serialize()
+        return self.payloads.insert_one(
+            {
+                "activity_id": activity_id,
+                "body": body,
+                "digest": digest(body),
+                "created_at": datetime.utcnow(),
+            }
+        ).inserted_id
+
+    def enqueue(
+        self,
+        payload_id: Any,
+        activity_id: str,
+        recipients: List[str],
+        queue: Callable[[Optional[str]], Optional[str]],
+        scheduled: bool,
+    ) -> List[Dict[str, Any]]:
+        """Record the deliveries of the payload (a recipient already in the ledger is left untouched).
+
+        With `scheduled`, the deliveries are sent by the async delivery worker once due. Otherwise, the deliveries whose
+        task is not spawned yet are returned (`spawned` must be called once their task is spawned).
+        """
+        now = datetime.utcnow()
+        updates = []
+        for recp in recipients:
+            host = urlparse(recp).hostname
+            doc = {
+                "payload_id": payload_id,
+                "activity_id": activity_id,
+                "to": recp,
+                "host": host,
+                "queue": queue(host),
+                "status": DeliveryStatus.PENDING.value,
+                "attempts": 0,
+                "created_at": now,
+            }
+            if scheduled:
+                doc["next_attempt_at"] = now
+            else:
+                doc["spawned"] = False
+            updates.append(
+                UpdateOne(
+                    {"payload_id": payload_id, "to": recp},
+                    {"$setOnInsert": doc},
+                    upsert=True,
+                )
+            )
+        if updates:
+            self.deliveries.bulk_write(updates, ordered=False)
+
+        if scheduled:
+            return []
+
+        return list(
+            self.deliveries.find(
+                {"payload_id": payload_id, "spawned": False},
+                projection=["_id", "queue"],
+            )
+        )
+
+    def spawned(self, delivery_id: Any) -> None:
+        self.deliveries.update_one({"_id": delivery_id}, {"$set": {"spawned": True}})
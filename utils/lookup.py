@@ -6,8 +6,10 @@ import requests
 from little_boxes.errors import NotAnActivityError
 from little_boxes.webfinger import get_actor_url
 
+from .httpclient import HTTPClient
 
-def lookup(url: str) -> ap.BaseActivity:
+
+def lookup(url: str, client: HTTPClient) -> ap.BaseActivity:
     """Try to find an AP object related to the given URL."""
     try:
         if url.startswith('@'):
@@ -21,13 +23,7 @@ def lookup(url: str) -> ap.BaseActivity:
         # when performing the lookup.
         pass
 
-    backend = ap.get_backend()
-    resp = requests.get(
-        url,
-        timeout=15,
-        allow_redirects=False,
-        headers={"User-Agent": backend.user_agent()},
-    )
+    resp = client.get(url, allow_redirects=False)
     resp.raise_for_status()
 
     # If the page is HTML, maybe it contains an alternate link pointing to an AP object
@@ -7,19 +7,21 @@ from typing import Any
 
 import gridfs
 import piexif
-import requests
 from PIL import Image
 
+from .httpclient import HTTPClient
 
-def load(url, user_agent):
+MAX_MEDIA_SIZE = 25 * 1024 * 1024
+
+
+def load(url: str, client: HTTPClient):
     """Initializes a `PIL.Image` from the URL."""
-    with requests.get(url, stream=True, headers={"User-Agent": user_agent}) as resp:
-        resp.raise_for_status()
-        if not resp.headers.get('content-type').startswith('image/'):
-            raise ValueError(f"bad content-type {resp.headers.get('content-type')}")
+    resp = client.get(url, max_size=MAX_MEDIA_SIZE)
+    resp.raise_for_status()
+    if not (resp.headers.get("content-type") or "").startswith("image/"):
+        raise ValueError(f"bad content-type {resp.headers.get('content-type')}")
 
-        resp.raw.decode_content = True
-        return Image.open(BytesIO(resp.raw.read()))
+    return Image.open(BytesIO(resp.content))
 
 
 def to_data_uri(img):
@@ -38,14 +40,14 @@ class Kind(Enum):
 
 
 class MediaCache(object):
-    def __init__(self, gridfs_db: str, user_agent: str) -> None:
+    def __init__(self, gridfs_db: str, client: HTTPClient) -> None:
         self.fs = gridfs.GridFS(gridfs_db)
-        self.user_agent = user_agent
+        self.client = client
 
     def cache_og_image(self, url: str) -> None:
         if self.fs.find_one({"url": url, "kind": Kind.OG_IMAGE.value}):
             return
-        i = load(url, self.user_agent)
+        i = load(url, self.client)
         # Save the original attachment (gzipped)
         i.thumbnail((100, 100))
         with BytesIO() as buf:
@@ -69,7 +71,7 @@ class MediaCache(object):
             or url.endswith(".jpeg")
             or url.endswith(".gif")
         ):
-            i = load(url, self.user_agent)
+            i = load(url, self.client)
             # Save the original attachment (gzipped)
             with BytesIO() as buf:
                 f1 = GzipFile(mode="wb", fileobj=buf)
@@ -99,28 +101,24 @@ class MediaCache(object):
             return
 
         # The attachment is not an image, download and save it anyway
-        with requests.get(
-            url, stream=True, headers={"User-Agent": self.user_agent}
-        ) as resp:
-            resp.raise_for_status()
-            with BytesIO() as buf:
-                with GzipFile(mode="wb", fileobj=buf) as f1:
-                    for chunk in resp.iter_content():
-                        if chunk:
-                            f1.write(chunk)
-                buf.seek(0)
-                self.fs.put(
-                    buf,
-                    url=url,
-                    size=None,
-                    content_type=mimetypes.guess_type(url)[0],
-                    kind=Kind.ATTACHMENT.value,
-                )
+        resp = self.client.get(url, max_size=MAX_MEDIA_SIZE)
+        resp.raise_for_status()
+        with BytesIO() as buf:
+            with GzipFile(mode="wb", fileobj=buf) as f1:
+                f1.write(resp.content)
+            buf.seek(0)
+            self.fs.put(
+                buf,
+                url=url,
+                size=None,
+                content_type=mimetypes.guess_type(url)[0],
+                kind=Kind.ATTACHMENT.value,
+            )
 
     def cache_actor_icon(self, url: str) -> None:
         if self.fs.find_one({"url": url, "kind": Kind.ACTOR_ICON.value}):
             return
-        i = load(url, self.user_agent)
+        i = load(url, self.client)
         for size in [50, 80]:
             t1 = i.copy()
             t1.thumbnail((size, size))
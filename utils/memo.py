@@ -0,0 +1,41 @@
+import threading
+from typing import Any
+from typing import Dict
+from typing import Hashable
+from typing import Optional
+
+
+class Memo(object):
+    """Cache scoped to a single request or task (one per thread).
+
+    Values are only cached between `start` and `end` (called when the request/task starts and ends), outside of a
+    scope `get` always returns None.
+    """
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+
+    def _values(self) -> Optional[Dict[Hashable, Any]]:
+        return getattr(self._local, "values", None)
+
+    def start(self) -> None:
+        self._local.values = {}
+
+    def end(self) -> None:
+        self._local.values = None
+
+    def get(self, key: Hashable) -> Any:
+        values = self._values()
+        if values is None:
+            return None
+        return values.get(key)
+
+    def set(self, key: Hashable, value: Any) -> None:
+        values = self._values()
+        if values is not None:
+            values[key] = value
+
+    def pop(self, key: Hashable) -> None:
+        values = self._values()
+        if values is not None:
+            values.pop(key, None)
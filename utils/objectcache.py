@@ -0,0 +1,78 @@
+from datetime import datetime
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+Cached = Tuple[Dict[str, str], Dict[str, Any]]
+
+
+def response_validators(headers: Any) -> Dict[str, str]:
+    """Returns the `ETag`/`Last-Modified` of a response."""
+    validators = {}
+    if headers.get("ETag"):
+        validators["etag"] = headers["ETag"]
+    if headers.get("Last-Modified"):
+        validators["last_modified"] = headers["Last-Modified"]
+    return validators
+
+
+def conditional_get(
+    get: Callable[[Dict[str, str]], Any], cached: Optional[Cached]
+) -> Tuple[Any, Optional[Dict[str, Any]]]:
+    """Send the request (`get` takes the extra headers) with the validators of the cached copy.
+
+    Returns the response, and the cached copy if it was not modified (i.e. 304).
+    """
+    headers = {}
+    if cached:
+        validators, _ = cached
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    resp = get(headers)
+    if resp.status_code == 304 and cached:
+        return resp, cached[1]
+
+    return resp, None
+
+
+class ObjectCache(object):
+    """Remote objects (other than actors) fetched with an `ETag`/`Last-Modified`, stored along with their validators.
+
+    The copy returned on a 304 is always the one the validators were sent with (and not a copy embedded in an
+    activity, that may be older).
+    """
+
+    def __init__(self, col: Any) -> None:
+        self.col = col
+
+    def get_validators(self, iri: str) -> Optional[Cached]:
+        """Returns the validators and the stored object, for revalidating it."""
+        doc = self.col.find_one({"remote_id": iri}, projection=["data", "validators"])
+        if not doc:
+            return None
+
+        return doc["validators"], doc["data"]
+
+    def set(self, iri: str, data: Dict[str, Any], validators: Dict[str, str]) -> None:
+        self.col.update_one(
+            {"remote_id": iri},
+            {
+                "$set": {
+                    "data": data,
+                    "validators": validators,
+                    "fetched_at": datetime.utcnow(),
+                }
+            },
+            upsert=True,
+        )
+
+    def touch(self, iri: str) -> None:
+        """Mark a stored object as fresh (i.e. it was revalidated)."""
+        self.col.update_one(
+            {"remote_id": iri}, {"$set": {"fetched_at": datetime.utcnow()}}
+        )
@@ -1,12 +1,12 @@
 import logging
 import opengraph
-import requests
 from bs4 import BeautifulSoup
 from little_boxes import activitypub as ap
 from little_boxes.errors import NotAnActivityError
 from little_boxes.urlutils import check_url
 from little_boxes.urlutils import is_url_valid
 
+from .httpclient import HTTPClient
 from .lookup import lookup
 
 logger = logging.getLogger(__name__)
@@ -29,22 +29,22 @@ def links_from_note(note):
     return links
 
 
-def fetch_og_metadata(user_agent, links):
+def fetch_og_metadata(client: HTTPClient, links):
     res = []
     for l in links:
         check_url(l)
 
         # Remove any AP actor from the list
         try:
-            p = lookup(l)
+            p = lookup(l, client)
             if p.has_type(ap.ACTOR_TYPES):
                 continue
         except NotAnActivityError:
             pass
 
-        r = requests.get(l, headers={"User-Agent": user_agent}, timeout=15)
+        r = client.get(l)
         r.raise_for_status()
-        if not r.headers.get("content-type").startswith("text/html"):
+        if not (r.headers.get("content-type") or "").startswith("text/html"):
             logger.debug(f"skipping {l}")
             continue
 
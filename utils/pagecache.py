@@ -0,0 +1,196 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from typing import Any
+from typing import Dict
+from typing import FrozenSet
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+
+from cachetools import LRUCache
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+Key = Tuple[str, str, Optional[str]]
+
+
+class PageCache(object):
+    """Two-tier cache of the rendered pages: an in-process LRU (L1) in front of the `cache2` collection (L2).
+
+    Each entry records its dependencies (the IDs of the objects shown, and the names of the collections counted), and
+    `invalidate(deps)` only removes the entries depending on one of them. The invalidations are recorded in the
+    `invalidations` log, read by each process (at most every `check_interval` seconds) to drop its own entries.
+
+    `invalidate()` (without dependencies) removes everything, by bumping a global generation counter (stored in
+    `generations`): entries of older generations are ignored.
+
+    Entries expire `ttl` seconds after being rendered (the pages show relative times), as `cache2` does with its TTL
+    index.
+    """
+
+    def __init__(
+        self,
+        col: Any,
+        generations: Any,
+        invalidations: Any,
+        maxsize: int = 256,
+        check_interval: float = 1.0,
+        ttl: int = 3600 * 12,
+    ) -> None:
+        self.col = col
+        self.ttl = timedelta(seconds=ttl)
+        self.generations = generations
+        self.invalidations = invalidations
+        self.check_interval = check_interval
+        # Invalidations are read again for a while, in case they were logged out of order by the other processes
+        self.log_window = timedelta(seconds=max(check_interval * 5, 5))
+        self._cache: LRUCache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._generation = 0
+        self._checked_at = 0.0
+        self._log_checked_at = datetime.utcnow()
+        self._applied: Dict[Any, datetime] = {}
+
+    def generation(self) -> int:
+        now = time.monotonic()
+        if now - self._checked_at > self.check_interval:
+            self._checked_at = now
+            doc = self.generations.find_one({"_id": "cache2"})
+            self._set_generation(doc["generation"] if doc else 0)
+            self._apply_invalidations()
+        return self._generation
+
+    def _set_generation(self, generation: int) -> None:
+        with self._lock:
+            if generation != self._generation:
+                self._cache.clear()
+                self._generation = generation
+
+    def _apply_invalidations(self) -> None:
+        now = datetime.utcnow()
+        since = self._log_checked_at - self.log_window
+        self._log_checked_at = now
+        for doc in self.invalidations.find({"at": {"$gte": since}}):
+            if doc["_id"] not in self._applied:
+                self._applied[doc["_id"]] = doc["at"]
+                self._drop(doc["deps"])
+
+        self._applied = {k: at for k, at in self._applied.items() if at >= since}
+
+    def _drop(self, deps: Iterable[str]) -> None:
+        deps = set(deps)
+        with self._lock:
+            for key in [k for k, (_, d, _) in self._cache.items() if d & deps]:
+                del self._cache[key]
+
+    def get(self, key: Key) -> Optional[str]:
+        generation = self.generation()
+        now = datetime.utcnow()
+        with self._lock:
+            cached: Optional[Tuple[str, FrozenSet[str], datetime]] = self._cache.get(
+                key
+            )
+            if cached and now - cached[2] > self.ttl:
+                del self._cache[key]
+                cached = None
+        if cached:
+            return cached[0]
+
+        # Invalidations from now on may concern the page that's about to be rendered
+        self._misses()[key] = datetime.utcnow()
+
+        path, type_, arg = key
+        doc = self.col.find_one(
+            {
+                "path": path,
+                "type": type_,
+                "arg": arg,
+                "generation": generation,
+                "deps": {"$exists": True},
+            }
+        )
+        if not doc:
+            return None
+
+        # The TTL index only removes the expired entries periodically
+        rendered_at = doc["date"].replace(tzinfo=None)
+        if now - rendered_at > self.ttl:
+            return None
+
+        with self._lock:
+            if generation == self._generation:
+                self._cache[key] = (
+                    doc["response_data"],
+                    frozenset(doc["deps"]),
+                    rendered_at,
+                )
+        return doc["response_data"]
+
+    def _misses(self) -> Dict[Key, datetime]:
+        if not hasattr(self._local, "misses"):
+            self._local.misses = {}
+        return self._local.misses
+
+    def end(self) -> None:
+        """Forget the misses of the current request (called when the request ends, the pages not cached are not
+        rendered anymore)."""
+        self._local.misses = {}
+
+    def set(self, key: Key, data: str, deps: Iterable[str]) -> None:
+        generation = self.generation()
+        deps = list(set(deps))
+        now = datetime.now(timezone.utc)
+        missed_at = self._misses().pop(key, datetime.utcnow())
+        path, type_, arg = key
+        # An invalidation may have happened during the rendering, the entry will then be ignored
+        self.col.update_one(
+            {"path": path, "type": type_, "arg": arg},
+            {
+                "$set": {
+                    "response_data": data,
+                    "deps": deps,
+                    "generation": generation,
+                    "date": now,
+                }
+            },
+            upsert=True,
+        )
+        if self.invalidations.find_one(
+            {"at": {"$gte": missed_at}, "deps": {"$in": deps}}
+        ):
+            self.col.delete_one({"path": path, "type": type_, "arg": arg})
+            return
+
+        with self._lock:
+            if generation == self._generation:
+                self._cache[key] = (data, frozenset(deps), now.replace(tzinfo=None))
+
+    def invalidate(self, deps: Optional[Iterable[str]] = None) -> None:
+        """Remove the entries depending on one of `deps` (all the entries if not set)."""
+        if deps is None:
+            doc = self.generations.find_one_and_update(
+                {"_id": "cache2"},
+                {"$inc": {"generation": 1}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            self.col.delete_many({"generation": {"$lt": doc["generation"]}})
+            self._set_generation(doc["generation"])
+            logger.info(f"cache invalidated (generation={doc['generation']})")
+            return
+
+        deps = [dep for dep in set(deps) if dep]
+        if not deps:
+            return
+
+        # Logged before removing the entries, so a page rendered in between isn't cached
+        self.invalidations.insert_one({"deps": deps, "at": datetime.utcnow()})
+        res = self.col.delete_many({"deps": {"$in": deps}})
+        self._drop(deps)
+        logger.info(f"cache invalidated for {deps} ({res.deleted_count} entries)")
@@ -0,0 +1,95 @@
+import logging
+import time
+from typing import Any
+from typing import Dict
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    """Per-instance rate limiter for the inbox requests.
+
+    Implements GCRA (equivalent to a token bucket refilled at `rate` tokens per second, holding up to `burst`
+    tokens). The state is stored in the `ingress` field of the instance document, so the limit is shared by all the
+    workers, along with per-minute counters (displayed in the admin).
+    """
+
+    def __init__(self, col: Any, rate: float, burst: int) -> None:
+        self.col = col
+        self.rate = rate
+        self.burst = burst
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def hit(self, host: str) -> float:
+        """Returns 0 if the request is allowed, or the number of seconds to wait before retrying."""
+        if not self.enabled:
+            return 0
+
+        interval = 1.0 / self.rate
+        now = time.time()
+        window = int(now // 60) * 60
+        for _ in range(3):
+            doc = self.col.find_one({"instance": host}, projection=["ingress"]) or {}
+            ingress = doc.get("ingress", {})
+
+            tat = max(ingress.get("tat") or now, now)
+            allow_at = tat + interval - interval * self.burst
+            if allow_at > now:
+                self.col.update_one(
+                    {"instance": host},
+                    {
+                        "$inc": {"ingress.rejected": 1},
+                        "$set": {"ingress.last_seen": now},
+                    },
+                    upsert=True,
+                )
+                return allow_at - now
+
+            update: Dict[str, Any] = {
+                "ingress.tat": tat + interval,
+                "ingress.last_seen": now,
+            }
+            if ingress.get("window") == window:
+                update["ingress.count"] = ingress.get("count", 0) + 1
+            else:
+                update["ingress.window"] = window
+                update["ingress.count"] = 1
+                update["ingress.last_count"] = (
+                    ingress.get("count", 0)
+                    if ingress.get("window") == window - 60
+                    else 0
+                )
+
+            # Only apply the update if no other worker updated the state in between
+            try:
+                res = self.col.update_one(
+                    {"instance": host, "ingress.tat": ingress.get("tat")},
+                    {"$set": update, "$inc": {"ingress.accepted": 1}},
+                    upsert=True,
+                )
+            except DuplicateKeyError:
+                continue
+
+            if res.matched_count or res.upserted_id:
+                return 0
+
+        logger.warning(
+            f"failed to update the rate limit state of {host}, allowing the request"
+        )
+        return 0
+
+    @staticmethod
+    def requests_per_minute(doc: Dict[str, Any]) -> int:
+        """Returns the number of accepted requests during the last complete minute."""
+        ingress = doc.get("ingress", {})
+        window = int(time.time() // 60) * 60
+        if ingress.get("window") == window:
+            return ingress.get("last_count", 0)
+        elif ingress.get("window") == window - 60:
+            return ingress.get("count", 0)
+        return 0
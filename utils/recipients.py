@@ -0,0 +1,159 @@
+import logging
+from datetime import datetime
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from urllib.parse import urlparse
+
+from little_boxes import activitypub as ap
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# ID of the flag document recording that the collection was built
+MIGRATION_ID = "recipients"
+
+
+def actor_inbox(raw_actor: Dict[str, Any]) -> Optional[str]:
+    """Returns the shared inbox of the actor, or its inbox."""
+    return (raw_actor.get("endpoints") or {}).get("sharedInbox") or raw_actor.get(
+        "inbox"
+    )
+
+
+def resolve_inboxes(
+    iris: List[str],
+    fetch: Callable[[str], Dict[str, Any]],
+    parse_collection: Callable[[Dict[str, Any]], List[str]],
+    ignored: List[str],
+) -> List[str]:
+    """Resolve the inboxes of the addressed actors and collections (each inbox is returned once), the `ignored` IRIs
+    (us, the public collection...) are skipped."""
+    inboxes: List[str] = []
+    for iri in iris:
+        if not iri or iri in ignored:
+            continue
+        raw = fetch(iri)
+        if raw["type"] in [
+            ap.ActivityType.COLLECTION.value,
+            ap.ActivityType.ORDERED_COLLECTION.value,
+        ]:
+            actors = [
+                fetch(item) for item in parse_collection(raw) if item not in ignored
+            ]
+        else:
+            actors = [raw]
+        for actor in actors:
+            inbox = actor_inbox(actor)
+            if inbox and inbox not in inboxes:
+                inboxes.append(inbox)
+
+    return inboxes
+
+
+class Recipients(object):
+    """Materialized inboxes of the followers (one document per follower), so the outbox activities are sent without
+    resolving the followers collection (and each follower actor).
+
+    Instances upgraded from a version without the collection build it once (recorded in `migrations`), see
+    `rebuild`.
+    """
+
+    def __init__(self, col: Any, migrations: Any) -> None:
+        self.col = col
+        self.migrations = migrations
+
+    def add(self, follow_id: str, actor: Dict[str, Any]) -> None:
+        """Materialize the inboxes of a new follower (`actor` is the meta built by `_actor_to_meta`)."""
+        shared_inbox = actor.get("sharedInbox")
+        update = {
+            "$set": {
+                "actor_id": actor["id"],
+                "follow_id": follow_id,
+                "inbox": actor["inbox"],
+                "shared_inbox": shared_inbox,
+                "host": urlparse(shared_inbox or actor["inbox"]).hostname,
+            }
+        }
+        try:
+            self.col.update_one({"actor_id": actor["id"]}, update, upsert=True)
+        except DuplicateKeyError:
+            # Concurrent upsert of the same follower
+            self.col.update_one({"actor_id": actor["id"]}, update)
+
+    def remove_follow(self, follow_id: str) -> None:
+        self.col.delete_one({"follow_id": follow_id})
+
+    def remove_actors(self, actor_ids: List[str]) -> None:
+        self.col.delete_many({"actor_id": {"$in": actor_ids}})
+
+    def inboxes(self) -> List[str]:
+        """Inboxes of the followers, one shared inbox per instance."""
+        shared_inboxes: Dict[str, str] = {}
+        inboxes: Dict[str, List[str]] = {}
+        for doc in self.col.find({}, projection=["host", "inbox", "shared_inbox"]):
+            if doc.get("shared_inbox"):
+                shared_inboxes[doc["host"]] = doc["shared_inbox"]
+            else:
+                inboxes.setdefault(doc["host"], []).append(doc["inbox"])
+
+        recipients = list(shared_inboxes.values())
+        for host, host_inboxes in inboxes.items():
+            # The shared inbox of the instance already dispatches to all its local followers
+            if host not in shared_inboxes:
+                recipients.extend(host_inboxes)
+
+        return recipients
+
+    def is_built(self) -> bool:
+        return bool(self.migrations.find_one({"_id": MIGRATION_ID}))
+
+    def rebuild(
+        self,
+        follows: Iterable[Dict[str, Any]],
+        resolve: Callable[[Dict[str, Any]], Dict[str, Any]],
+    ) -> int:
+        """Rebuild the collection from the inbox Follows, returns the number of followers.
+
+        `resolve` returns the actor meta (with its inboxes) of a Follow whose actor was not cached with its inboxes.
+        The followers that cannot be resolved are skipped (kept in the collection if they were already there), they're
+        retried on the next rebuild (i.e. `/migration6`).
+        """
+        follow_ids = []
+        failed = 0
+        for doc in follows:
+            follow_ids.append(doc["remote_id"])
+            actor = doc.get("meta", {}).get("actor")
+            if not actor or not actor.get("inbox"):
+                try:
+                    actor = resolve(doc)
+                except Exception:
+                    logger.exception(
+                        f"failed to fetch the follower of {doc['remote_id']}"
+                    )
+                    failed += 1
+                    continue
+            self.add(doc["remote_id"], actor)
+
+        # Removed at the end (instead of starting from scratch), the collection stays usable while it's rebuilt
+        self.col.delete_many({"follow_id": {"$nin": follow_ids}})
+        self.migrations.update_one(
+            {"_id": MIGRATION_ID},
+            {
+                "$set": {
+                    "done_at": datetime.utcnow(),
+                    "followers": len(follow_ids),
+                    "failed": failed,
+                }
+            },
+            upsert=True,
+        )
+        return len(follow_ids)
+
+    def drop(self) -> None:
+        """Empty the collection, as for an instance upgraded from a version without it."""
+        self.col.delete_many({})
+        self.migrations.delete_one({"_id": MIGRATION_ID})
@@ -0,0 +1,139 @@
+import copy
+import logging
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Optional
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+
+class _Call(object):
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[Exception] = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """Deduplicates concurrent calls for the same key.
+
+    Within a process, callers wait for the call in flight. Across processes, the caller holding the lease (a document
+    in `col`) makes the call and stores the result for `result_ttl` seconds, the other ones wait for it (or make the
+    call themselves if the lease is released without a result, or after `lease` seconds).
+
+    Each caller gets its own copy of the result. With `max_wait`, a caller doesn't wait longer than `max_wait` seconds
+    for the call of another caller, it then makes the call itself (for the web requests, which cannot wait for a whole
+    lease).
+    """
+
+    def __init__(
+        self,
+        col: Any,
+        lease: int = 30,
+        result_ttl: int = 5,
+        poll_interval: float = 0.1,
+    ) -> None:
+        self.col = col
+        self.lease = timedelta(seconds=lease)
+        self.result_ttl = timedelta(seconds=result_ttl)
+        self.poll_interval = poll_interval
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(
+        self, key: str, f: Callable[[], Any], max_wait: Optional[float] = None
+    ) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            if not call.done.wait(max_wait):
+                logger.info(f"{key} is still in flight, calling it directly")
+                return f()
+            if call.error:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            result = self._do_leased(key, f, max_wait)
+            call.result = result
+            return result
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            # No waiter can join anymore, they copy a private copy (the leader may mutate its result meanwhile)
+            if call.waiters and call.error is None:
+                call.result = copy.deepcopy(call.result)
+            call.done.set()
+
+    def _acquire(self, key: str) -> bool:
+        now = datetime.utcnow()
+        # Remove the lease of a process that died (the TTL monitor only runs every minute)
+        self.col.delete_one({"_id": key, "expires_at": {"$lt": now}})
+        try:
+            self.col.insert_one({"_id": key, "expires_at": now + self.lease})
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def _wait(self, key: str, max_wait: Optional[float] = None) -> Any:
+        """Returns the result of the lease holder (None if there's no result within `max_wait` seconds)."""
+        deadline = time.monotonic() + max_wait if max_wait is not None else None
+        while True:
+            doc = self.col.find_one({"_id": key})
+            if not doc or doc["expires_at"] < datetime.utcnow():
+                return None
+            if "result" in doc:
+                return doc["result"]
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.info(f"{key} is still leased, calling it directly")
+                return None
+            time.sleep(self.poll_interval)
+
+    def _do_leased(
+        self, key: str, f: Callable[[], Any], max_wait: Optional[float] = None
+    ) -> Any:
+        if not self._acquire(key):
+            result = self._wait(key, max_wait)
+            if result is not None:
+                logger.debug(f"{key} fetched by another process")
+                return result
+            return f()
+
+        try:
+            result = f()
+        except Exception:
+            self.col.delete_one({"_id": key})
+            raise
+
+        try:
+            self.col.update_one(
+                {"_id": key},
+                {
+                    "$set": {
+                        "result": result,
+                        "expires_at": datetime.utcnow() + self.result_ttl,
+                    }
+                },
+            )
+        except Exception:
+            logger.exception(f"failed to share the result for {key}")
+            self.col.delete_one({"_id": key})
+
+        return result
@@ -0,0 +1,61 @@
+"""Staged processing of the inbox activities (see `tasks.process_inbox`)."""
+
+import logging
+from enum import Enum
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Sequence
+from typing import Tuple
+from typing import Type
+
+logger = logging.getLogger(__name__)
+
+# A stage returns the updates of the activity meta
+Stage = Callable[[Any, Dict[str, Any]], Dict[str, Any]]
+
+
+class StageStatus(Enum):
+    DONE = "done"
+    DROPPED = "dropped"
+    ERROR = "error"
+
+
+def run_stages(
+    col: Any,
+    doc: Dict[str, Any],
+    activity: Any,
+    stages: Sequence[Tuple[str, Stage]],
+    drop_errors: Tuple[Type[Exception], ...] = (),
+) -> None:
+    """Run the stages that are not done yet, recording the status of each stage in `meta.stages`.
+
+    A stage raising one of `drop_errors` is dropped (and never run again), any other error is recorded and raised, so
+    a retry resumes at the failed stage.
+    """
+    meta = doc["meta"]
+    statuses = meta.setdefault("stages", {})
+    for name, stage in stages:
+        if statuses.get(name) in [StageStatus.DONE.value, StageStatus.DROPPED.value]:
+            continue
+
+        try:
+            updates = stage(activity, meta)
+            status = StageStatus.DONE
+        except drop_errors:
+            logger.exception(f"stage {name} dropped for {doc.get('remote_id')}")
+            updates = {}
+            status = StageStatus.DROPPED
+        except Exception:
+            statuses[name] = StageStatus.ERROR.value
+            col.update_one(
+                {"_id": doc["_id"]},
+                {"$set": {f"meta.stages.{name}": StageStatus.ERROR.value}},
+            )
+            raise
+
+        meta.update(updates)
+        statuses[name] = status.value
+        update = {f"meta.{k}": v for k, v in updates.items()}
+        update[f"meta.stages.{name}"] = status.value
+        col.update_one({"_id": doc["_id"]}, {"$set": update})
@@ -0,0 +1,53 @@
+"""Thread root resolution (see `MicroblogPubBackend.resolve_ancestors`)."""
+
+import logging
+from typing import Callable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+logger = logging.getLogger(__name__)
+
+# (root of the thread if known, parent)
+Ancestor = Tuple[Optional[str], Optional[str]]
+
+
+def find_thread_root(
+    in_reply_to: str,
+    lookup: Callable[[str], Optional[Ancestor]],
+    fetch: Optional[Callable[[str], Optional[Tuple[str, Optional[str]]]]],
+    max_ancestors: int,
+) -> Optional[Tuple[str, List[str]]]:
+    """Go up the thread from `in_reply_to` until an ancestor with a known root (or the root itself, or
+    `max_ancestors`), returns the root and the IDs of the ancestors fetched on the way.
+
+    `lookup` returns the known root and the parent of a stored note (None if it's unknown). `fetch` fetches and stores
+    an unknown ancestor, returning its ID and its parent (None if it's gone); if it's not set, None is returned when
+    an unknown ancestor is reached.
+    """
+    fetched: List[str] = []
+    iri = root = in_reply_to
+    for _ in range(max_ancestors):
+        root = iri
+        known = lookup(iri)
+        if known:
+            known_root, parent = known
+            if known_root:
+                root = known_root
+                break
+        elif not fetch:
+            return None
+        else:
+            reply = fetch(iri)
+            if not reply:
+                break
+            reply_id, parent = reply
+            fetched.append(reply_id)
+
+        if not parent:
+            break
+        iri = parent
+    else:
+        logger.info(f"thread is too deep, stopping at {root}")
+
+    return root, fetched